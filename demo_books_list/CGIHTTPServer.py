@@ -16,6 +16,20 @@ SECURITY WARNING: DON'T USE THIS CODE UNLESS YOU ARE INSIDE A FIREWALL
 
 Note that status code 200 is sent prior to execution of a CGI script, so
 scripts cannot send other status codes such as 302 (redirect).
+
+Zygote mode (run with --zygote, fork platforms only): the modules that
+Python CGI scripts import (e.g. spods, sqlite3) are imported once, by the
+server itself. Each request is then handled by a forked copy of the server,
+which already has them loaded, instead of a brand new interpreter. The
+script itself only runs in the forked copy, so database connections are
+never shared between processes. Scripts still see the usual CGI
+environment, standard input and standard output.
+
+Only modules the server can find are imported up front, so put the
+directory holding SPODS's modules on PYTHONPATH (e.g. PYTHONPATH=../spods
+for the demos, whose scripts import base, table_linker, etc.).  A module
+that can't be imported is reported on stderr, and each child then imports
+it (or fails to) itself.
 """
 
 
@@ -47,6 +61,9 @@ class CGIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     have_popen2 = hasattr(os, 'popen2')
     have_popen3 = hasattr(os, 'popen3')
 
+    # Fork warm copies of the server for Python scripts (see zygote_script)
+    zygote = False
+
     # Make rfile unbuffered -- we need to read one line and then pass
     # the rest to a subprocess, so we can't use buffered input.
     rbufsize = 0
@@ -220,6 +237,12 @@ class CGIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
         self.send_response(200, "Script output follows")
 
+        warm = self.zygote and ispy and self.have_fork
+        if warm:
+            # import (or re-import, if changed) the script's modules in the
+            # parent, so every child forked from here on has them ready
+            zygote_script(scriptfile)
+
         decoded_query = query.replace('+', ' ')
 
         if self.have_fork:
@@ -248,6 +271,9 @@ class CGIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                     pass
                 os.dup2(self.rfile.fileno(), 0)
                 os.dup2(self.wfile.fileno(), 1)
+                if warm:
+                    run_warm_script(scriptfile, env)
+                    os._exit(0)
                 os.execve(scriptfile, args, env)
             except:
                 self.server.handle_error(self.request, self.client_address)
@@ -365,10 +391,93 @@ def executable(path):
     return st.st_mode & 0111 != 0
 
 
+warm_scripts = {}
+
+def script_imports(scriptfile):
+    """Return the names of the modules a Python script imports (without
+    running it)."""
+    import ast
+    f = open(scriptfile)
+    try:
+        tree = ast.parse(f.read(), scriptfile)
+    finally:
+        f.close()
+
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+    return names
+
+def zygote_script(scriptfile):
+    """Import the modules a CGI script imports into the server process
+    (once, or again if the script has changed on disk).  The script itself
+    isn't run here: its database connections must be opened by each child,
+    as SQLite connections can't be used on both sides of a fork."""
+    mtime = os.stat(scriptfile).st_mtime
+    if warm_scripts.get(scriptfile) == mtime:
+        return
+
+    directory = os.path.dirname(scriptfile)
+    sys.path.insert(0, directory)
+    try:
+        for name in script_imports(scriptfile):
+            try:
+                __import__(name)
+            except Exception, e:
+                # e.g. the script changes sys.path first: the child will
+                # import it (or report the error) itself
+                sys.stderr.write("zygote: couldn't pre-import %s for %s "
+                                 "(%s: %s); each request will import it\n"
+                                 % (name, scriptfile, type(e).__name__, e))
+    finally:
+        sys.path.remove(directory)
+
+    warm_scripts[scriptfile] = mtime
+
+def run_warm_script(scriptfile, env):
+    """Run a CGI script whose modules are already imported, in a forked
+    child whose stdin and stdout are the client connection."""
+    os.environ.clear()
+    os.environ.update(env)
+    sys.argv = [scriptfile]
+    sys.path.insert(0, os.path.dirname(scriptfile))
+
+    # opens (and links) the script's database connections in this process
+    import imp
+    module = imp.load_source('_zygote_script', scriptfile)
+    if hasattr(module, 'application'):
+        # a WSGI application, e.g. from spods.wsgi_app()
+        from wsgiref.handlers import CGIHandler
+        CGIHandler().run(module.application)
+    else:
+        # no application: run the script's __main__ code
+        import runpy
+        runpy.run_path(scriptfile, run_name='__main__')
+    sys.stdout.flush()
+
+
+def preload_scripts(HandlerClass = CGIHTTPRequestHandler):
+    """Import the Python scripts in the CGI directories up front."""
+    for directory in HandlerClass.cgi_directories:
+        directory = os.path.join(os.getcwd(), directory.lstrip('/'))
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if os.path.splitext(name)[1].lower() in (".py", ".pyw"):
+                zygote_script(os.path.join(directory, name))
+
+
 def test(HandlerClass = CGIHTTPRequestHandler,
          ServerClass = BaseHTTPServer.HTTPServer):
     SimpleHTTPServer.test(HandlerClass, ServerClass)
 
 
 if __name__ == '__main__':
+    if '--zygote' in sys.argv:
+        sys.argv.remove('--zygote')
+        CGIHTTPRequestHandler.zygote = True
+        preload_scripts()
     test()
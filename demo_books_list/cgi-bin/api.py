@@ -9,6 +9,7 @@ sys.path.append("C:/Users/Sasha/Dropbox/Programming/Python MySQL Serializer/spod
 from base import Field, Table
 from table_linker import link_table
 from json_api import handle_request, serve_api
+from wsgi import wsgi_app
 ###
 
 import sqlite3
@@ -43,6 +44,9 @@ def check_credit(**kw):
         credit_sum += int(digit)
     return {'sum': credit_sum}
 
+# for long-lived servers (e.g. python -m spods.serve cgi-bin/api.py)
+application = wsgi_app(Book, Person, check_credit)
+
 if __name__ == "__main__":
     print serve_api(Book, Person, check_credit)
     
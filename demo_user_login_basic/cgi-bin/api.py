@@ -9,6 +9,7 @@ sys.path.append("C:/Users/Sasha/Dropbox/Programming/Python MySQL Serializer/spod
 from base import Field, Table
 from table_linker import link_table
 from json_api import handle_request, serve_api
+from wsgi import wsgi_app
 ###
 
 import sqlite3
@@ -29,7 +30,7 @@ fields = [
     Field('key', str, default=generate_key),
     Field('ip', str, default=get_ip)
 ]
-sessions_table = Table('session', fields)
+sessions_table = Table('session', fields, ttl=30 * 24 * 60 * 60)
 Session = link_table(sessions_table, con, session_field='key', force_session=True)
 
 
@@ -85,6 +86,9 @@ def logout(**kw):
     # their cookie doesn't need to be updated, since we didn't change the session itself
     return True
 
+# for long-lived servers (e.g. python -m spods.serve cgi-bin/api.py)
+application = wsgi_app(Session, User, login, logout)
+
 if __name__ == "__main__":
     print serve_api(Session, User, login, logout)
     
@@ -6,7 +6,7 @@ setup(
     version = "0.4",
     scripts = [],
 
-    packages=['spods'],
+    packages=['spods', 'spods.bench'],
     namespace_packages=['spods'],
     package_dir={'spods': 'spods'},    
 
@@ -1,4 +1,13 @@
-
 from base import Field, Table
-from table_linker import link_table
-from json_api import handle_request, serve_api
+from table_linker import link_table, transaction
+from json_api import handle_request, serve_api, write_api, cache_responses, expose_metrics
+from migrate import plan_migration, migrate
+from wsgi import wsgi_app
+from cache import ResponseCache, DiskCache
+from registry import ApiRegistry
+from metrics import Metrics, share_metrics, render_metrics
+from tracing import trace_to, MemoryExporter, JsonlExporter
+from profiling import profile_memory, MemoryLimitExceeded
+from changes import ChangesCompacted
+from sharding import ShardSpec
+from push import limit_subscribers
@@ -1,7 +1,16 @@
-import json
+import time
 
 blank_fn = lambda s: s
 
+def now():
+    """Returns the current time in whole seconds (the default for a table's ttl_field)."""
+    return int(time.time())
+
+def to_json(x):
+    # json is only imported when a tuple field is actually stored
+    from json import dumps
+    return dumps(x)
+
 # TODO: this is duplicately defined in table_linker. Put them both in a common include
 is_function = lambda f: hasattr(f, '__call__')
 
@@ -12,7 +21,7 @@ class Field(object):
         str: ("TEXT", str),
         int: ("INTEGER", int),
         bool: ("INTEGER", lambda x: {True: 1, False: 0}[x]),
-        tuple: ("TEXT", json.dumps)
+        tuple: ("TEXT", to_json)
     }
     
     def __init__(self, title, python_type=None, null=None, default=None, pk=None, fk=None, in_mask=blank_fn, out_mask=blank_fn):
@@ -54,11 +63,20 @@ class Field(object):
 class Table(object):
     """The class representing an unlinked table.
 
-    A table consists of 1 or more fields, and exactly one primary key."""
+    A table consists of 1 or more fields, and exactly one primary key.
+
+    If ttl is a number of seconds, rows expire that long after the time in their ttl_field
+    (which is added, and set when each row is made, if it isn't one of the fields). Expired
+    rows are left out of queries, and removed a few at a time (see purge_expired)."""
     
-    def __init__(self, title, fields=[]):
+    def __init__(self, title, fields=[], ttl=None, ttl_field='created'):
         self.title = title
         self.fields = fields
+        self.ttl = ttl
+        self.ttl_field = ttl_field
+
+        if ttl and not self.is_field(ttl_field):
+            fields.append(Field(ttl_field, int, default=now))
 
         # create the ID field, if no primary key was specified
         # TODO: ensure only 1 primary key was specified
@@ -0,0 +1,10 @@
+"""Benchmarks for SPODS.
+
+Run the whole suite (see suite.py) with:
+
+    python -m spods.bench
+
+or a single benchmark module with python -m, e.g.:
+
+    python -m spods.bench.cold_start
+"""
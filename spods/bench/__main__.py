@@ -0,0 +1,7 @@
+"""Runs the benchmark suite: python -m spods.bench (see spods.bench.suite)."""
+
+import sys
+
+from spods.bench.suite import main
+
+main(sys.argv[1:])
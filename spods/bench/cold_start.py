@@ -0,0 +1,94 @@
+"""Measures the cold start cost of a CGI-style API request, in milliseconds.
+
+Each run happens in a fresh interpreter (just like a CGI script does), and times:
+    * import, for importing spods
+    * link, for linking the tables (and their relations)
+    * request, for serving the first API request
+    * total, for all of the above
+
+Usage:
+    python -m spods.bench.cold_start [--runs N] [--tables N] [--eager]
+"""
+
+import os
+import subprocess
+import sys
+
+# the script run in each fresh interpreter: prints import, link & request times
+SCRIPT = r'''
+import time
+start = time.time()
+
+import spods
+
+imported = time.time()
+
+import sqlite3
+con = sqlite3.connect(%(db)r)
+
+classes = []
+for i in range(%(tables)d):
+    fields = [
+        spods.Field('id', int, pk=True),
+        spods.Field('title', str),
+        spods.Field('count', int)
+    ]
+    classes.append(spods.link_table(spods.Table('table%%d' %% i, fields), con, lazy=%(lazy)r))
+for i in range(1, %(tables)d):
+    classes[i].has_one(classes[i - 1])
+
+linked = time.time()
+
+import os
+os.environ['QUERY_STRING'] = 'obj=table0'
+os.environ['REQUEST_METHOD'] = 'GET'
+spods.serve_api(*classes)
+
+served = time.time()
+print imported - start, linked - imported, served - linked
+'''
+
+def run_once(db, tables, lazy):
+    """Runs a single cold start in a fresh interpreter, and returns its
+    (import, link, request) times in seconds."""
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = package_dir + os.pathsep + env.get('PYTHONPATH', '')
+
+    script = SCRIPT % {'db': db, 'tables': tables, 'lazy': lazy}
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return tuple(float(x) for x in output.split())
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(args):
+    import optparse
+    import tempfile
+
+    parser = optparse.OptionParser(usage="python -m spods.bench.cold_start [options]")
+    parser.add_option('--runs', type='int', default=20, help="number of fresh interpreters to time")
+    parser.add_option('--tables', type='int', default=5, help="number of tables to link")
+    parser.add_option('--eager', action='store_true', default=False, help="link tables eagerly (lazy=False)")
+    options, args = parser.parse_args(args)
+
+    handle, db = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    try:
+        # warm up the OS caches, and create the tables
+        run_once(db, options.tables, not options.eager)
+
+        times = [run_once(db, options.tables, not options.eager) for i in range(options.runs)]
+    finally:
+        os.remove(db)
+
+    print "%-10s %10s" % ("stage", "median ms")
+    for i, stage in enumerate(('import', 'link', 'request')):
+        print "%-10s %10.2f" % (stage, median([t[i] for t in times]) * 1000)
+    print "%-10s %10.2f" % ('total', median([sum(t) for t in times]) * 1000)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
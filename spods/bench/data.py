@@ -0,0 +1,41 @@
+"""Synthetic data for the benchmarks: a library of authors and books."""
+
+import random
+
+import spods
+from spods.table_linker import transaction
+
+def make_library(db, books=1000, authors=100, seed=0):
+    """Given a database connection, (re)creates an author table and a book table (each book
+    has one author), fills them with the given numbers of random rows, and returns the
+    (Author, Book) linked classes.
+
+    The same seed always makes the same rows. Book titles are unique ('book 0', 'book 1', ...)."""
+
+    rng = random.Random(seed)
+
+    author_fields = [
+        spods.Field('id', int, pk=True),
+        spods.Field('name', str),
+        spods.Field('born', int)
+    ]
+    Author = spods.link_table(spods.Table('author', author_fields), db, clear_existing=True, lazy=False)
+
+    book_fields = [
+        spods.Field('id', int, pk=True),
+        spods.Field('title', str),
+        spods.Field('pages', int),
+        spods.Field('price', int)
+    ]
+    Book = spods.link_table(spods.Table('book', book_fields), db, clear_existing=True)
+    Book.has_one(Author)
+    Book.link()
+
+    with transaction(db):
+        db.executemany("INSERT INTO author (name, born) VALUES (?, ?)",
+                       (("author %d" % i, rng.randint(1800, 2000)) for i in range(authors)))
+        db.executemany("INSERT INTO book (title, pages, price, author_id) VALUES (?, ?, ?, ?)",
+                       (("book %d" % i, rng.randint(20, 1000), rng.randint(100, 5000), rng.randint(1, authors))
+                        for i in xrange(books)))
+
+    return Author, Book
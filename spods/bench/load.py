@@ -0,0 +1,375 @@
+"""An HTTP load test for the demo apps, to compare ways of serving the API on one machine.
+
+Copies a demo (e.g. demo_user_login) to a temporary directory, starts it on localhost, and
+drives a mix of API calls from many concurrent clients (each with its own cookies) for a while.
+Reports the throughput, the latency percentiles (overall and per call), the error rates, and how
+much the demo's database file grew.
+
+The server is one of:
+    * cgi, the demo's CGIHTTPServer.py (a new Python process per request)
+    * zygote, CGIHTTPServer.py --zygote (a forked, pre-loaded process per request)
+    * serve, python -m spods.serve cgi-bin/api.py (a pool of threads in one process)
+
+The calls are:
+    * view, a page of the demo's main table
+    * new, adding a row to it
+    * edit, changing one of the rows added
+    * login and logout (for the login demos), as a test user made at the start; a client
+      that is already logged in logs out instead, and vice versa
+
+Errors are counted as api (a non-zero status in the JSON), locked (an API error saying the
+database is locked), http (a response that isn't JSON, e.g. '503 Service Unavailable') or
+connection (no response at all).
+
+Usage:
+    python -m spods.bench.load [--demo demo_user_login] [--server cgi|zygote|serve]
+                               [--clients N] [--duration S] [--mix view=60,new=15,...]
+                               [--workers N] [--port N] [--json]
+
+Note: when run as root, CGIHTTPServer.py runs scripts as nobody, who must be able to read
+SPODS and write to the copied demo.
+"""
+
+import httplib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+# where to find the demos, and the spods package (for the API scripts' imports)
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SPODS_DIR = os.path.join(PACKAGE_DIR, 'spods')
+
+# the table each demo's view/new/edit calls use, one of its text fields, and whether it has login
+DEMOS = {
+    'demo_books_list': { 'table': 'book', 'field': 'title', 'login': False },
+    'demo_user_login': { 'table': 'book', 'field': 'title', 'login': True },
+    'demo_user_login_basic': { 'table': 'user', 'field': 'favourite_color', 'login': True }
+}
+
+SERVERS = ('cgi', 'zygote', 'serve')
+
+DEFAULT_MIX = 'view=60,new=15,edit=15,login=5,logout=5'
+DEFAULT_CLIENTS = 8
+DEFAULT_DURATION = 10.0
+DEFAULT_PORT = 8765
+
+# rows added before the test starts, for edit calls to change
+SEED_ROWS = 20
+
+# the test user, for login calls
+TEST_USERNAME = 'load_test'
+TEST_PASSWORD = 'load_test'
+
+API_PATH = '/cgi-bin/api.py'
+
+# most common error messages to print
+TOP_ERRORS = 5
+
+def server_command(server, port, workers):
+    """Returns the command line that starts the given kind of server."""
+    if server == 'cgi':
+        return [sys.executable, 'CGIHTTPServer.py', str(port)]
+    if server == 'zygote':
+        return [sys.executable, 'CGIHTTPServer.py', '--zygote', str(port)]
+    return [sys.executable, '-m', 'spods.serve', '--port', str(port), '--workers', str(workers), 'cgi-bin/api.py']
+
+def wait_for_port(port, timeout=15.0):
+    """Waits until something is listening on the given local port."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("The server didn't start listening on port %d" % port)
+
+def db_size(directory):
+    """Returns the total size of the demo's database files, in bytes."""
+    total = 0
+    for suffix in ('', '-wal', '-journal'):
+        path = os.path.join(directory, 'test.db' + suffix)
+        if os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+def percentile(values, fraction):
+    """Given a sorted list of numbers, returns the value at the given fraction of the way
+    through it (or 0 for an empty list)."""
+    if not values:
+        return 0.0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+class Client(object):
+    """The class representing a single user of the API, with their own connection and cookies."""
+
+    def __init__(self, port):
+        self.connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.cookies = {}
+        self.logged_in = False
+
+    def call(self, **params):
+        """Makes an API call, and returns the parsed JSON response (or raises an exception)."""
+
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % item for item in self.cookies.items())
+
+        try:
+            self.connection.request('GET', API_PATH + '?' + urllib.urlencode(params), headers=headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            # try again next time with a new connection
+            self.connection.close()
+            raise
+
+        for header in (response.msg.getheaders('set-cookie') or []):
+            name, _, value = header.split(';')[0].partition('=')
+            self.cookies[name.strip()] = value.strip()
+
+        return json.loads(body)
+
+class LoadTest(object):
+    """The class representing a single load test of a demo."""
+
+    def __init__(self, demo, server, clients, duration, mix, port=DEFAULT_PORT, workers=4):
+        if demo not in DEMOS:
+            raise ValueError("Unknown demo %s (try one of %s)" % (demo, ", ".join(sorted(DEMOS))))
+        if server not in SERVERS:
+            raise ValueError("Unknown server %s (try one of %s)" % (server, ", ".join(SERVERS)))
+
+        self.demo = demo
+        self.config = DEMOS[demo]
+        self.server = server
+        self.clients = clients
+        self.duration = duration
+        self.port = port
+        self.workers = workers
+
+        # login and logout need a login demo
+        self.mix = dict((op, weight) for op, weight in mix.items()
+                        if weight > 0 and (self.config['login'] or op not in ('login', 'logout')))
+
+        # (op, seconds, outcome) for each call, and how often each error message was seen
+        self.calls = []
+        self.messages = {}
+        self.lock = threading.Lock()
+
+        # primary keys of the rows edit calls can change
+        self.row_ids = []
+
+    def choose_op(self, rng):
+        """Returns a random call, following the mix."""
+        point = rng.uniform(0, sum(self.mix.values()))
+        for op, weight in sorted(self.mix.items()):
+            point -= weight
+            if point <= 0:
+                return op
+        return op
+
+    def make_call(self, client, op, rng, n):
+        """Makes a single call of the given kind, returning the (possibly changed) kind of
+        call and its response."""
+
+        table, field = self.config['table'], self.config['field']
+
+        if op in ('login', 'logout'):
+            # alternate, so the calls are valid
+            op = 'logout' if client.logged_in else 'login'
+            if op == 'login':
+                response = client.call(obj='login', username=TEST_USERNAME, password=TEST_PASSWORD)
+            else:
+                response = client.call(obj='logout')
+            if response.get('status') == 0:
+                client.logged_in = (op == 'login')
+            return op, response
+
+        if op == 'new':
+            return op, client.call(obj=table, action='new', **{ field: 'load %d' % n })
+        if op == 'edit':
+            pk = rng.choice(self.row_ids)
+            return op, client.call(obj=table, action='edit', fetch='one', **{ 'id*': pk, field: 'edited %d' % n })
+        return op, client.call(obj=table, limit=25)
+
+    def run_client(self, number, stop_at):
+        rng = random.Random(number)
+        client = Client(self.port)
+        n = 0
+        while time.time() < stop_at:
+            op = self.choose_op(rng)
+            n += 1
+            start = time.time()
+            message = None
+            try:
+                op, response = self.make_call(client, op, rng, number * 1000000 + n)
+                if response.get('status') == 0:
+                    outcome = 'ok'
+                else:
+                    message = "%s: %s" % (op, response.get('error'))
+                    outcome = 'locked' if 'database is locked' in message else 'api'
+            except ValueError:
+                # not JSON
+                outcome = 'http'
+            except (httplib.HTTPException, socket.error), e:
+                message = "%s: %s" % (op, e)
+                outcome = 'connection'
+            elapsed = time.time() - start
+
+            with self.lock:
+                self.calls.append((op, elapsed, outcome))
+                if message:
+                    self.messages[message] = self.messages.get(message, 0) + 1
+
+    def seed(self):
+        """Adds the rows for edit calls, and the test user for login calls."""
+        client = Client(self.port)
+        table, field = self.config['table'], self.config['field']
+        for i in range(SEED_ROWS):
+            try:
+                response = client.call(obj=table, action='new', **{ field: 'seed %d' % i })
+            except ValueError:
+                raise RuntimeError("The server isn't answering with JSON (can the API script run?)")
+            if response.get('status') != 0:
+                raise RuntimeError("Couldn't add rows to %s: %s" % (table, response.get('error')))
+            self.row_ids.append(response['data'][0]['id'])
+        if self.config['login']:
+            client.call(obj='user', action='new', username=TEST_USERNAME, password=TEST_PASSWORD)
+
+    def run(self):
+        """Runs the load test, and returns a dictionary of results."""
+
+        directory = tempfile.mkdtemp(prefix='spods-load-')
+        process = None
+        try:
+            demo_dir = os.path.join(directory, self.demo)
+            shutil.copytree(os.path.join(PACKAGE_DIR, self.demo), demo_dir)
+            if os.getuid() == 0:
+                # CGI scripts run as nobody
+                for path, dirs, files in os.walk(directory):
+                    os.chmod(path, 0777)
+                    for name in files:
+                        os.chmod(os.path.join(path, name), 0777)
+
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join([SPODS_DIR, PACKAGE_DIR, env.get('PYTHONPATH', '')])
+            with open(os.devnull, 'w') as devnull:
+                process = subprocess.Popen(server_command(self.server, self.port, self.workers),
+                                           cwd=demo_dir, env=env, stdout=devnull, stderr=devnull)
+            wait_for_port(self.port)
+
+            self.seed()
+            size_before = db_size(demo_dir)
+
+            stop_at = time.time() + self.duration
+            threads = [threading.Thread(target=self.run_client, args=(i, stop_at)) for i in range(self.clients)]
+            started = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - started
+
+            size_after = db_size(demo_dir)
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        return self.summarise(elapsed, size_before, size_after)
+
+    def summarise(self, elapsed, size_before, size_after):
+        """Returns a dictionary of results from the calls made."""
+
+        def latencies(calls):
+            times = sorted(c[1] for c in calls)
+            return {
+                'calls': len(times),
+                'p50_ms': percentile(times, 0.5) * 1000,
+                'p90_ms': percentile(times, 0.9) * 1000,
+                'p99_ms': percentile(times, 0.99) * 1000
+            }
+
+        total = len(self.calls)
+        errors = {}
+        for kind in ('api', 'locked', 'http', 'connection'):
+            count = len([c for c in self.calls if c[2] == kind])
+            errors[kind] = { 'count': count, 'rate': float(count) / total if total else 0.0 }
+
+        ops = {}
+        for op in sorted(set(c[0] for c in self.calls)):
+            ops[op] = latencies([c for c in self.calls if c[0] == op])
+
+        return {
+            'demo': self.demo,
+            'server': self.server,
+            'clients': self.clients,
+            'seconds': elapsed,
+            'calls': total,
+            'calls_per_sec': total / elapsed if elapsed else 0.0,
+            'latency': latencies(self.calls),
+            'ops': ops,
+            'errors': errors,
+            'error_messages': self.messages,
+            'db_bytes_before': size_before,
+            'db_bytes_after': size_after
+        }
+
+def print_results(results):
+    print "%s with %s, %d clients for %.1fs" % (results['demo'], results['server'], results['clients'], results['seconds'])
+    print "%d calls, %.1f calls/sec" % (results['calls'], results['calls_per_sec'])
+    print
+    print "%-10s %8s %10s %10s %10s" % ("call", "calls", "p50 ms", "p90 ms", "p99 ms")
+    rows = sorted(results['ops'].items()) + [('all', results['latency'])]
+    for op, latency in rows:
+        print "%-10s %8d %10.2f %10.2f %10.2f" % (op, latency['calls'], latency['p50_ms'], latency['p90_ms'], latency['p99_ms'])
+    print
+    print "%-10s %8s %10s" % ("errors", "count", "rate")
+    for kind in ('api', 'locked', 'http', 'connection'):
+        error = results['errors'][kind]
+        print "%-10s %8d %9.2f%%" % (kind, error['count'], error['rate'] * 100)
+    messages = sorted(results['error_messages'].items(), key=lambda item: -item[1])
+    for message, count in messages[:TOP_ERRORS]:
+        print "%8d x %s" % (count, message)
+    print
+    growth = results['db_bytes_after'] - results['db_bytes_before']
+    print "database grew by %d bytes (%d --> %d)" % (growth, results['db_bytes_before'], results['db_bytes_after'])
+
+def main(args):
+    import optparse
+
+    parser = optparse.OptionParser(usage="python -m spods.bench.load [options]")
+    parser.add_option('--demo', default='demo_user_login', help="demo to serve (%s)" % ", ".join(sorted(DEMOS)))
+    parser.add_option('--server', default='cgi', help="how to serve it (%s)" % ", ".join(SERVERS))
+    parser.add_option('--clients', type='int', default=DEFAULT_CLIENTS, help="concurrent clients")
+    parser.add_option('--duration', type='float', default=DEFAULT_DURATION, help="seconds to run for")
+    parser.add_option('--mix', default=DEFAULT_MIX, help="relative weights of the calls")
+    parser.add_option('--workers', type='int', default=4, help="worker threads (for spods.serve)")
+    parser.add_option('--port', type='int', default=DEFAULT_PORT, help="local port to serve on")
+    parser.add_option('--json', action='store_true', default=False, help="print the results as JSON")
+    options, args = parser.parse_args(args)
+
+    mix = {}
+    for item in options.mix.split(','):
+        op, _, weight = item.partition('=')
+        mix[op.strip()] = float(weight or 1)
+
+    test = LoadTest(options.demo, options.server, options.clients, options.duration, mix, options.port, options.workers)
+    results = test.run()
+
+    if options.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print_results(results)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
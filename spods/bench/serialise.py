@@ -0,0 +1,76 @@
+"""Compares serialising a page of results with compiled row serialisers against building a
+dictionary per object (the way views used to be serialised), in milliseconds per page.
+
+Each page is timed:
+    * dicts, as get_all(), dict() of each object, then json.dumps
+    * compiled, as iter_serialised() straight from the cursor, then encode
+
+with and without an out mask on one of the fields.
+
+Usage:
+    python -m spods.bench.serialise [--rows N] [--fields N] [--repeat N]
+"""
+
+import sqlite3
+import sys
+import time
+from json import dumps, loads
+
+import spods
+from spods.base import blank_fn
+from spods.serialiser import encode
+
+def make_class(rows, fields, masked):
+    """Returns a linked class (in a new in-memory DB) with the given number of rows and text
+    fields, and an out mask on the first field if masked is True."""
+
+    db = sqlite3.connect(':memory:')
+    table_fields = [spods.Field('id', int, pk=True), spods.Field('count', int)]
+    for i in range(fields):
+        out_mask = (lambda s: s.upper()) if masked and i == 0 else blank_fn
+        table_fields.append(spods.Field('field%d' % i, str, out_mask=out_mask))
+    cls = spods.link_table(spods.Table('item', table_fields), db, lazy=False)
+
+    names = ", ".join(['count'] + ['field%d' % i for i in range(fields)])
+    marks = ", ".join(['?'] * (fields + 1))
+    db.executemany("INSERT INTO item (%s) VALUES (%s)" % (names, marks),
+                   [[n] + [u'value %d of row %d' % (i, n) for i in range(fields)] for n in range(rows)])
+    return cls
+
+def with_dicts(cls, rows):
+    return dumps([dict(o) for o in cls.get_all(_limit=rows)])
+
+def compiled(cls, rows):
+    return encode(list(cls.iter_serialised(_limit=rows)))
+
+def best_time(fn, repeat):
+    """Returns the fastest of repeat calls to fn, in seconds."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+def main(args):
+    import optparse
+
+    parser = optparse.OptionParser(usage="python -m spods.bench.serialise [options]")
+    parser.add_option('--rows', type='int', default=1000, help="rows per page")
+    parser.add_option('--fields', type='int', default=8, help="text fields per row")
+    parser.add_option('--repeat', type='int', default=20, help="times to serialise each page")
+    options, args = parser.parse_args(args)
+
+    print "%-10s %12s %12s %10s" % ("out masks", "dicts ms", "compiled ms", "speedup")
+    for masked in (False, True):
+        cls = make_class(options.rows, options.fields, masked)
+
+        # both give the same JSON
+        assert loads(with_dicts(cls, options.rows)) == loads(compiled(cls, options.rows))
+
+        old = best_time(lambda: with_dicts(cls, options.rows), options.repeat)
+        new = best_time(lambda: compiled(cls, options.rows), options.repeat)
+        print "%-10s %12.2f %12.2f %9.1fx" % ("yes" if masked else "no", old * 1000, new * 1000, old / new)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
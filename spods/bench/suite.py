@@ -0,0 +1,255 @@
+"""The SPODS benchmark suite: times the core and the JSON API over synthetic data (see
+spods.bench.data), with both an in-memory and a file-backed database.
+
+For each scenario, reports operations per second, and the median (p50) and 99th percentile
+(p99) time of a single operation, in milliseconds. The scenarios are:
+    * create, making a new object
+    * set, setting a field of an object
+    * get_all_N, finding one row by an unindexed field, in a table of N rows
+    * fk, following a relation (book['author'])
+    * expand, viewing a page of books with their authors through the API
+    * api_view, api_edit and api_delete, viewing, editing and deleting through the API
+    * link, linking a table (with a relation) eagerly
+
+Results can be saved as a baseline, and later runs compared against it: any scenario whose
+operations per second drop by more than the tolerance is flagged as a regression (and the
+exit status is 1). Baselines are only comparable on the same machine.
+
+Usage:
+    python -m spods.bench [--sizes 1000,100000,1000000] [--ops N] [--seconds S]
+                          [--db memory,file] [--only name,...]
+                          [--save-baseline FILE] [--baseline FILE] [--tolerance 0.2]
+"""
+
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import spods
+from spods.bench.data import make_library
+from spods.json_api import FormValue, handle_request
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+# most operations timed per scenario, and most seconds spent on one
+DEFAULT_OPS = 500
+DEFAULT_SECONDS = 2.0
+
+# books and authors in the table used by the scenarios that aren't about table size
+LIBRARY_BOOKS = 1000
+LIBRARY_AUTHORS = 100
+
+# fraction that operations per second can drop by before it counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+def request(**params):
+    """Returns CGI-style form data for the given request parameters."""
+    return dict((k, FormValue(str(v))) for k, v in params.items())
+
+def setup_create(db):
+    Author, Book = make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    return lambda i: Book(title="new book %d" % i, pages=100, author_id=1)
+
+def setup_set(db):
+    Author, Book = make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    book = Book.get_one(id=1)
+    def op(i):
+        book['pages'] = i
+    return op
+
+def setup_get_all(size):
+    def setup(db):
+        Author, Book = make_library(db, size, LIBRARY_AUTHORS)
+        return lambda i: Book.get_all(title="book %d" % (i * 7919 % size))
+    return setup
+
+def setup_fk(db):
+    Author, Book = make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    books = Book.get_all(_limit=100)
+    return lambda i: books[i % len(books)]['author']
+
+def setup_expand(db):
+    Author, Book = make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    return lambda i: handle_request({}, request(obj='book', expand='author', start=i % 900), {}, [Book, Author])
+
+def setup_api_view(db):
+    Author, Book = make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    return lambda i: handle_request({}, request(obj='book', start=i % 900), {}, [Book, Author])
+
+def setup_api_edit(db):
+    Author, Book = make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    return lambda i: handle_request({}, request(obj='book', action='edit', fetch='one', price=i, **{'id*': i % LIBRARY_BOOKS + 1}), {}, [Book, Author])
+
+def setup_api_delete(db):
+    # enough books that every operation has one to delete
+    Author, Book = make_library(db, LIBRARY_BOOKS * 10, LIBRARY_AUTHORS)
+    return lambda i: handle_request({}, request(obj='book', action='delete', id=i + 1), {}, [Book, Author])
+
+def setup_link(db):
+    make_library(db, LIBRARY_BOOKS, LIBRARY_AUTHORS)
+    def op(i):
+        Author = spods.link_table(spods.Table('author', [spods.Field('id', int, pk=True), spods.Field('name', str), spods.Field('born', int)]), db)
+        Book = spods.link_table(spods.Table('book', [spods.Field('id', int, pk=True), spods.Field('title', str), spods.Field('pages', int), spods.Field('price', int)]), db)
+        Book.has_one(Author)
+        Book.link()
+    return op
+
+def scenarios(sizes):
+    """Given the table sizes for get_all, returns a list of (name, setup function) tuples.
+
+    Each setup function is given a database connection, and returns the operation to time
+    (a function given the operation's number)."""
+
+    result = [('create', setup_create), ('set', setup_set)]
+    for size in sizes:
+        result.append(('get_all_%d' % size, setup_get_all(size)))
+    result += [
+        ('fk', setup_fk),
+        ('expand', setup_expand),
+        ('api_view', setup_api_view),
+        ('api_edit', setup_api_edit),
+        ('api_delete', setup_api_delete),
+        ('link', setup_link)
+    ]
+    return result
+
+def percentile(values, fraction):
+    """Given a sorted list of numbers, returns the value at the given fraction of the way
+    through it."""
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def run_scenario(setup, db, ops, seconds):
+    """Given a scenario's setup function and a database connection, times up to ops operations
+    (stopping early after the given number of seconds). Returns a dictionary of results."""
+
+    op = setup(db)
+
+    # warm up (e.g. prepare statements)
+    op(0)
+
+    times = []
+    started = time.time()
+    for i in range(1, ops + 1):
+        start = time.time()
+        op(i)
+        times.append(time.time() - start)
+        if time.time() - started > seconds:
+            break
+
+    times.sort()
+    return {
+        'ops': len(times),
+        'ops_per_sec': len(times) / sum(times) if sum(times) else float('inf'),
+        'p50_ms': percentile(times, 0.5) * 1000,
+        'p99_ms': percentile(times, 0.99) * 1000
+    }
+
+def connect(kind, directory, name):
+    """Returns a new database connection: in memory, or to a new file in the directory."""
+    if kind == 'memory':
+        return sqlite3.connect(':memory:')
+    return sqlite3.connect(os.path.join(directory, name + '.db'))
+
+def run_suite(sizes=DEFAULT_SIZES, ops=DEFAULT_OPS, seconds=DEFAULT_SECONDS, kinds=('memory', 'file'), only=None, report=None):
+    """Runs each scenario against each kind of database ('memory' or 'file'), and returns a
+    dictionary of 'kind:scenario' --> results. If report is a function, it is called with the
+    key and results of each scenario as it finishes."""
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix='spods-bench-')
+    try:
+        for kind in kinds:
+            for name, setup in scenarios(sizes):
+                if only and name not in only:
+                    continue
+                db = connect(kind, directory, name)
+                try:
+                    key = "%s:%s" % (kind, name)
+                    results[key] = run_scenario(setup, db, ops, seconds)
+                    if report:
+                        report(key, results[key])
+                finally:
+                    db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def environment():
+    """Returns a description of where the benchmarks ran, to store alongside a baseline."""
+    return {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'system': platform.system()
+    }
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Given results and a baseline (from a previous run), returns a dictionary of
+    'kind:scenario' --> change in operations per second (e.g. -0.25 for 25% fewer), and a
+    list of the keys that regressed by more than the tolerance."""
+
+    changes = {}
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]['ops_per_sec']
+        changes[key] = result['ops_per_sec'] / before - 1 if before else 0.0
+        if changes[key] < -tolerance:
+            regressions.append(key)
+    return changes, sorted(regressions)
+
+def main(args):
+    import optparse
+
+    parser = optparse.OptionParser(usage="python -m spods.bench [options]")
+    parser.add_option('--sizes', default=",".join(str(s) for s in DEFAULT_SIZES), help="table sizes for get_all")
+    parser.add_option('--ops', type='int', default=DEFAULT_OPS, help="most operations per scenario")
+    parser.add_option('--seconds', type='float', default=DEFAULT_SECONDS, help="most seconds per scenario")
+    parser.add_option('--db', default='memory,file', help="kinds of database to use")
+    parser.add_option('--only', default='', help="scenarios to run (default: all)")
+    parser.add_option('--save-baseline', metavar='FILE', help="save the results as a baseline")
+    parser.add_option('--baseline', metavar='FILE', help="compare the results against a baseline")
+    parser.add_option('--tolerance', type='float', default=DEFAULT_TOLERANCE, help="allowed drop in ops/sec")
+    options, args = parser.parse_args(args)
+
+    sizes = [int(s) for s in options.sizes.split(',') if s]
+    kinds = [k for k in options.db.split(',') if k]
+    only = [s for s in options.only.split(',') if s] or None
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print "%-24s %6s %12s %10s %10s %9s" % ("scenario", "ops", "ops/sec", "p50 ms", "p99 ms", "change")
+
+    def report(key, result):
+        change = ""
+        if baseline and key in baseline and baseline[key]['ops_per_sec']:
+            change = "%+8.1f%%" % ((result['ops_per_sec'] / baseline[key]['ops_per_sec'] - 1) * 100)
+        print "%-24s %6d %12.1f %10.3f %10.3f %9s" % (key, result['ops'], result['ops_per_sec'], result['p50_ms'], result['p99_ms'], change)
+        sys.stdout.flush()
+
+    results = run_suite(sizes, options.ops, options.seconds, kinds, only, report)
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+        print "Saved baseline to %s" % options.save_baseline
+
+    if baseline:
+        changes, regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print "Regressions (more than %d%% fewer ops/sec): %s" % (options.tolerance * 100, ", ".join(regressions))
+            sys.exit(1)
+        print "No regressions."
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+import os
+import random
+import threading
+import time
+
+from collections import OrderedDict
+
+class ResponseCache(object):
+    """An in-process cache of serialised API responses, keeping the max_entries most
+    recently used. Useful for long-lived servers (see wsgi_app). It can be shared by
+    several threads."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for key, or None."""
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value != None:
+                # most recently used goes last
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class DiskCache(object):
+    """A cache of serialised API responses, stored as files in a directory, so it can be
+    shared between CGI processes.
+
+    Every so often, entries older than max_age seconds are removed."""
+
+    # chance of cleaning out old entries on each set()
+    prune_chance = 0.01
+
+    def __init__(self, directory, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """Returns the value stored for key, or None."""
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def set(self, key, value):
+        # write to a temporary file (of this thread's own), then rename, so readers never see half a file
+        path = os.path.join(self.directory, key)
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        os.rename(temp_path, path)
+
+        if random.random() < self.prune_chance:
+            self.prune()
+
+    def prune(self):
+        """Removes entries older than max_age."""
+        oldest = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                # already gone
+                pass
@@ -0,0 +1,101 @@
+# changes to tracked tables are logged in this table, in order, one row per changed row
+CHANGES_TABLE = "_spods_changes"
+
+# the highest sequence number compacted away, per table
+COMPACTED_TABLE = "_spods_changes_compacted"
+
+# changes kept per table when the log is compacted
+DEFAULT_KEEP = 10000
+
+class ChangesCompacted(Exception):
+    """Raised when asking for changes since a sequence number whose changes have since been
+    compacted away: the whole table needs to be read again."""
+
+def install_change_triggers(db, title, pk):
+    """Given a database connection, a table name and the name of its primary key, adds
+    triggers that log every insert, update and delete on the table (whether it was made
+    through SPODS or not) in the changes table, as (seq, title, pk, op) rows."""
+
+    c = db.cursor()
+
+    # AUTOINCREMENT, so sequence numbers are never reused, even after compaction
+    c.execute("CREATE TABLE IF NOT EXISTS %s (seq INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL, pk INTEGER, op TEXT NOT NULL)" % CHANGES_TABLE)
+    c.execute("CREATE INDEX IF NOT EXISTS %s_title ON %s (title, seq)" % (CHANGES_TABLE, CHANGES_TABLE))
+    c.execute("CREATE TABLE IF NOT EXISTS %s (title TEXT PRIMARY KEY, seq INTEGER NOT NULL)" % COMPACTED_TABLE)
+
+    log = "INSERT INTO %s (title, pk, op) VALUES ('%s', %%s, '%%s');" % (CHANGES_TABLE, title)
+    triggers = [
+        ('insert', "AFTER INSERT ON %s" % title, log % ("NEW.%s" % pk, 'insert')),
+        ('update', "AFTER UPDATE ON %s" % title, log % ("NEW.%s" % pk, 'update')),
+        ('delete', "AFTER DELETE ON %s" % title, log % ("OLD.%s" % pk, 'delete')),
+
+        # a changed primary key means the row with the old one is gone, and one with the new one is new
+        ('rekey', "AFTER UPDATE OF %s ON %s WHEN OLD.%s IS NOT NEW.%s" % (pk, title, pk, pk),
+         log % ("OLD.%s" % pk, 'delete') + log % ("NEW.%s" % pk, 'insert'))
+    ]
+    for name, when, action in triggers:
+        c.execute("CREATE TRIGGER IF NOT EXISTS %s_%s_%s %s BEGIN %s END" % (CHANGES_TABLE, title, name, when, action))
+    c.close()
+
+def changes_since(db, title, since, limit=None):
+    """Given a database connection, a table name and a sequence number, returns a list of
+    (seq, pk, op) tuples for the rows of the table changed since then, in order. Each row is
+    only listed once, with its latest change: 'update' or 'delete', or 'insert' for rows made
+    since then (even if they have been updated since).
+
+    Raises ChangesCompacted if some of the changes since then have been compacted away."""
+
+    c = db.cursor()
+    c.execute("SELECT seq FROM %s WHERE title = ?" % COMPACTED_TABLE, (title, ))
+    row = c.fetchone()
+    if row != None and since < row[0]:
+        c.close()
+        raise ChangesCompacted("Changes to %s since %d are no longer kept; read the whole table again." % (title, since))
+
+    # (with a single MAX(), SQLite takes op from the same row as the latest seq)
+    query = ("SELECT MAX(seq), pk, op, SUM(op = 'insert') FROM %s WHERE title = ? AND seq > ? GROUP BY pk ORDER BY 1"
+             % CHANGES_TABLE)
+    args = (title, since)
+    if limit != None:
+        query += " LIMIT ?"
+        args += (limit, )
+    c.execute(query, args)
+
+    rows = []
+    for seq, pk, op, inserts in c:
+        if inserts and op != 'delete':
+            op = 'insert'
+        rows.append((seq, pk, str(op)))
+    c.close()
+    return rows
+
+def latest_change(db, title):
+    """Given a database connection and a table name, returns the sequence number of the
+    table's latest change (or 0, if it hasn't changed)."""
+
+    c = db.cursor()
+    c.execute("SELECT MAX(seq) FROM %s WHERE title = ?" % CHANGES_TABLE, (title, ))
+    row = c.fetchone()
+    c.execute("SELECT seq FROM %s WHERE title = ?" % COMPACTED_TABLE, (title, ))
+    compacted = c.fetchone()
+    c.close()
+
+    return max(row[0] or 0, compacted[0] if compacted else 0)
+
+def compact_changes(db, title, keep=DEFAULT_KEEP):
+    """Given a database connection and a table name, deletes all but the latest keep changes
+    to the table from the log. Returns the number of changes deleted."""
+
+    c = db.cursor()
+    c.execute("SELECT seq FROM %s WHERE title = ? ORDER BY seq DESC LIMIT 1 OFFSET ?" % CHANGES_TABLE, (title, keep))
+    row = c.fetchone()
+    if row == None:
+        # nothing to compact
+        c.close()
+        return 0
+
+    c.execute("DELETE FROM %s WHERE title = ? AND seq <= ?" % CHANGES_TABLE, (title, row[0]))
+    deleted = c.rowcount
+    c.execute("INSERT OR REPLACE INTO %s (title, seq) VALUES (?, ?)" % COMPACTED_TABLE, (title, row[0]))
+    c.close()
+    return deleted
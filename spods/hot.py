@@ -0,0 +1,218 @@
+"""Keeps small, busy tables (sessions, settings, lookups) in memory, so reading them never goes
+to disk, and writes them back to their database file a little later (see link_table's hot
+parameter).
+
+Each database file with hot tables gets a HotStore: a connection to the file in which every
+hot table has an in-memory TEMP copy (which its queries find before the real one), loaded when
+the table is linked. Every change to a copy is logged, by TEMP triggers, in a journal next to
+the file (e.g. books.db-hot). The journal doesn't wait for the disk the way the file would.
+A thread then copies the journalled rows into the file, in one transaction, every few seconds
+or every FLUSH_ROWS writes, and empties the journal.
+
+If the process stops before a flush, the journal is replayed into the file the next time the
+table is linked. Changes made to the file by other connections to hot tables are not seen,
+and are overwritten when the same rows are flushed.
+
+Every class linked to a hot table in the same file shares its HotStore's connection, however
+many times the table is linked (e.g. once by each of spods.serve's workers). So threads must
+hold lock while using them: wsgi_app does this for every request if it serves a hot table."""
+
+import atexit
+import sqlite3
+import threading
+
+from push import database_file
+
+# added to the database file's name to make the journal's
+JOURNAL_SUFFIX = "-hot"
+
+# journalled rows of each table are kept in this table of the journal, plus the table's name
+JOURNAL_TABLE = "_spods_hot_"
+
+# default seconds between flushes (hot=True), and writes that start a flush early
+FLUSH_INTERVAL = 1.0
+FLUSH_ROWS = 1000
+
+# database file --> HotStore
+stores = {}
+stores_lock = threading.Lock()
+
+# held while using the connection of any HotStore (see the top of this module)
+lock = threading.RLock()
+
+class HotStore(object):
+    """The class representing the hot tables of one database file: their in-memory copies (in
+    db), their journal, and the thread that flushes it into the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.journal = path + JOURNAL_SUFFIX
+
+        # hot tables are queried through this connection; TEMP tables are kept in memory
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.isolation_level = None
+        self.db.execute("PRAGMA temp_store = MEMORY")
+        self.db.execute("ATTACH DATABASE ? AS journal", (self.journal, ))
+
+        # WAL with synchronous=NORMAL: a commit is only written to the journal's log, which
+        # survives the process stopping (only losing power can lose the latest writes)
+        self.db.execute("PRAGMA journal.journal_mode = WAL")
+        self.db.execute("PRAGMA journal.synchronous = NORMAL")
+
+        # title --> (primary key, columns), for each hot table
+        self.tables = {}
+
+        # writes since the last flush, and the longest time between flushes
+        self.writes = 0
+        self.interval = None
+
+        # set to flush straight away
+        self.wake = threading.Event()
+
+        # held while flushing, by the flushing connection
+        self.lock = threading.Lock()
+        self.flush_db = None
+        self.thread = None
+        self.closed = False
+
+    def add_table(self, table, interval, indexed=()):
+        """Given a table (already in the file), the most seconds its writes may wait to be
+        flushed and the fields to index, makes sure the table is in memory and its changes are
+        journalled (only copying it the first time it is added), and that the flushing thread
+        is running."""
+
+        with lock:
+            if table.title not in self.tables:
+                self.copy_table(table, indexed)
+
+            # flush at least as often as the most impatient table needs
+            if self.interval == None or interval < self.interval:
+                self.interval = interval
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, name='spods-hot')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def copy_table(self, table, indexed):
+        """Given a table not yet in memory and the fields to index, replays its journal into
+        the file, then makes its in-memory copy and the triggers that journal its changes."""
+
+        title, pk = table.title, table.pk.title
+        columns = [f.title for f in table.fields]
+        journal_table = JOURNAL_TABLE + title
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS journal.%s (seq INTEGER PRIMARY KEY, deleted INTEGER NOT NULL, %s)"
+                        % (journal_table, ", ".join(columns)))
+        self.tables[title] = (pk, columns)
+
+        # writes that never made it into the file (e.g. the last process stopped)
+        self.flush()
+
+        # the in-memory copy, found before the file's table by every query that doesn't name a schema
+        self.db.execute("CREATE TEMP TABLE %s (%s)" % (title, ",".join(table.field_stmt(f) for f in table.fields)))
+        self.db.execute("INSERT INTO temp.%s (%s) SELECT %s FROM main.%s" % (title, ", ".join(columns), ", ".join(columns), title))
+        for field in indexed:
+            self.db.execute("CREATE INDEX temp.%s%s_%s ON %s (%s)" % (JOURNAL_TABLE, title, field, title, field))
+
+        log = "INSERT INTO %s (deleted, %s) VALUES (%%d, %%s);" % (journal_table, ", ".join(columns))
+        new = ", ".join("NEW.%s" % c for c in columns)
+        old = ", ".join("OLD.%s" % c for c in columns)
+        triggers = [
+            ('insert', "AFTER INSERT ON %s" % title, log % (0, new)),
+            ('update', "AFTER UPDATE ON %s" % title, log % (0, new)),
+            ('delete', "AFTER DELETE ON %s" % title, log % (1, old)),
+
+            # a changed primary key means the row with the old one is gone
+            ('rekey', "AFTER UPDATE OF %s ON %s WHEN OLD.%s IS NOT NEW.%s" % (pk, title, pk, pk), log % (1, old))
+        ]
+        for name, when, action in triggers:
+            self.db.execute("CREATE TEMP TRIGGER %s%s_%s %s BEGIN %s END" % (JOURNAL_TABLE, title, name, when, action))
+
+    def wrote(self):
+        """Called after each write to a hot table: starts a flush once there have been
+        FLUSH_ROWS of them."""
+        self.writes += 1
+        if self.writes >= FLUSH_ROWS:
+            self.wake.set()
+
+    def flush(self, titles=None):
+        """Copies the journalled rows of the given hot tables (or all of them) into the file, one
+        transaction per table, and empties their journals. Returns the number of journalled
+        changes flushed."""
+
+        flushed = 0
+        with self.lock:
+            if self.flush_db == None:
+                self.flush_db = sqlite3.connect(self.path, check_same_thread=False)
+                self.flush_db.isolation_level = None
+                self.flush_db.execute("ATTACH DATABASE ? AS journal", (self.journal, ))
+            db = self.flush_db
+
+            self.writes = 0
+            for title in titles or self.tables.keys():
+                pk, columns = self.tables[title]
+                journal_table = "journal.%s%s" % (JOURNAL_TABLE, title)
+                names = ", ".join(columns)
+
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    upto = db.execute("SELECT MAX(seq) FROM %s" % journal_table).fetchone()[0]
+                    if upto != None:
+                        # each row as it was last journalled (or gone, if it was deleted)
+                        db.execute("DELETE FROM main.%s WHERE %s IN (SELECT %s FROM %s WHERE seq <= ?)"
+                                   % (title, pk, pk, journal_table), (upto, ))
+                        db.execute("INSERT INTO main.%s (%s) SELECT %s FROM %s WHERE deleted = 0 AND seq IN "
+                                   "(SELECT MAX(seq) FROM %s WHERE seq <= ? GROUP BY %s)"
+                                   % (title, names, names, journal_table, journal_table, pk), (upto, ))
+                        flushed += db.execute("DELETE FROM %s WHERE seq <= ?" % journal_table, (upto, )).rowcount
+                except:
+                    db.execute("ROLLBACK")
+                    raise
+                db.execute("COMMIT")
+        return flushed
+
+    def close(self):
+        """Stops the flushing thread, and flushes every hot table for the last time."""
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        if self.thread != None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.closed:
+                break
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # e.g. the file is locked: the journal keeps the rows until next time
+                pass
+
+def hot_store(db):
+    """Given a connection to a database file, returns the file's HotStore, making it if
+    needed."""
+
+    path = database_file(db)
+    if not path:
+        raise Exception("Hot tables need a database file (in-memory databases are already in memory).")
+
+    with stores_lock:
+        if path not in stores:
+            stores[path] = HotStore(path)
+        return stores[path]
+
+def close_stores():
+    """Flushes the journalled writes of every hot table into its database file as the process
+    exits (if it is killed instead, they are replayed when the tables are next linked), once
+    the flushing threads have stopped."""
+    with stores_lock:
+        closing = stores.values()
+    for store in closing:
+        store.close()
+
+atexit.register(close_stores)
@@ -1,25 +1,277 @@
-import json
+from itertools import islice
+from random import random
+from time import time
+
+from metrics import metrics, render_metrics
+from profiling import profiler
+from registry import get_registry
+from serialiser import RawJSON, encode
+from session import load_signed_session, session_cookie_name
+from table_linker import transaction
+from tracing import span
 
 MAX_LIMIT = 25
 
-def handle_request(cookie, data, session, classes):
-    """Given a list of classes, as well as the cookies, session objects and CGI form data,
-    responds to the given request, returning a Python object."""
+# deepest nesting of related object expansions
+MAX_EXPAND_DEPTH = 5
+
+# number of streamed objects whose related objects are loaded together
+EXPAND_BATCH = 100
+
+# most operations allowed in a single batch request
+MAX_BATCH = 50
+
+# chance of deleting a batch of expired rows (see Table's ttl), and compacting the change logs
+# (see link_table's track_changes), on each request
+PURGE_CHANCE = 0.01
+
+# where serialised responses are cached (see cache_responses)
+response_cache = None
+
+# the obj parameter that asks for the metrics (see expose_metrics), and the token it needs
+METRICS_OBJ = '_metrics'
+metrics_token = None
+
+def cache_responses(cache):
+    """Given a cache (such as a spods.cache.ResponseCache or DiskCache), or None, sets where
+    responses to cacheable requests are stored."""
+
+    global response_cache
+    response_cache = cache
+
+def expose_metrics(token):
+    """Given a secret token, or None, sets who can see the metrics (see spods.metrics) with
+    obj=_metrics: only requests with the token (as a token parameter, or an 'Authorization:
+    Bearer' header). With None, the default, obj=_metrics is just an invalid object."""
+
+    global metrics_token
+    metrics_token = token
+
+class FormValue(object):
+    """A single request value, standing in for a CGI MiniFieldStorage (which has a .value)."""
+
+    def __init__(self, value):
+        self.value = value
+
+def resolve_reference(value, results):
+    """Given a value from a batch operation and the results of the earlier operations,
+    returns the value itself, or the value it refers to.
+
+    A reference is a string starting with '$', followed by the index of an earlier operation
+    and a dotted path into its data, e.g. '$0.id' (the id of the first object returned by
+    operation 0) or '$1.2.title' (the title of the third object returned by operation 1).
+    Start a string with '$$' to send a literal '$'."""
+
+    if not isinstance(value, basestring) or not value.startswith('$'):
+        return value
+    if value.startswith('$$'):
+        return value[1:]
+
+    from json import loads
+
+    path = value[1:].split('.')
+    try:
+        current = results[int(path[0])]['data']
+        for key in path[1:]:
+            if isinstance(current, RawJSON):
+                current = loads(current)
+            if isinstance(current, list):
+                if key.isdigit():
+                    current = current[int(key)]
+                    continue
+                # not an index: use the first object
+                current = current[0]
+                if isinstance(current, RawJSON):
+                    current = loads(current)
+            current = current[key]
+    except (ValueError, IndexError, KeyError, TypeError):
+        raise Exception("Invalid reference '%s'." % value)
+
+    return current
+
+def render(o, related):
+    """Given an object and a dictionary of table name --> (related object, its related objects),
+    returns the object's JSON, with the JSON of each related object added under its table's name."""
+
+    json = type(o).serialise(o)
+    if not related:
+        return json
+
+    from json.encoder import encode_basestring_ascii as encode_basestring
+
+    parts = [json[:-1]]
+    for title, (related_o, its_related) in related.items():
+        parts.append(', %s: %s' % (encode_basestring(title), render(related_o, its_related)))
+    parts.append('}')
+    return RawJSON(''.join(parts))
+
+def expand_objects(objs, expandables, depth=MAX_EXPAND_DEPTH, loaded=None):
+    """Given a list of objects and a list of classes to expand, returns a list of the objects'
+    JSON (as RawJSON objects). Each related object of an expanded class is added under its
+    table's name, and expanded in turn, up to depth levels deep.
+
+    Related objects are loaded a level at a time, with one query per class. loaded is an
+    optional dictionary of (table name, primary key) --> object, so each object is only read
+    once per response. An object is never expanded inside itself (a circular reference)."""
+
+    if loaded is None:
+        loaded = {}
+
+    # table name --> (related object, its related objects), for each object
+    related = [{} for o in objs]
+
+    # each node is (object, its related objects, the (table name, primary key) of the objects above it)
+    level = [(o, values, frozenset()) for o, values in zip(objs, related)]
+
+    for i in range(depth):
+        if not level or not expandables:
+            break
+
+        # find the foreign keys on this level, and which objects we don't have yet
+        links = []
+        wanted = {}
+        for o, values, parents in level:
+            parents_below = parents | set([(o.table.title, o.data[o.table.pk.title])])
+            for c in expandables:
+                field = type(o).fk_field(c.table.title)
+                if field == None or not o.data[field.title]:
+                    # not related, or not linked to anything
+                    continue
+
+                key = (c.table.title, o.data[field.title])
+                if key in parents_below:
+                    # circular reference (or the object itself)
+                    continue
+
+                links.append((values, parents_below, c, key))
+                if key not in loaded:
+                    wanted.setdefault(c, set()).add(key[1])
+
+        # load them, one query per class
+        with span('expand', depth=i + 1, tables=sorted(c.table.title for c in wanted)):
+            for c in wanted:
+                for pk, obj in c.get_many(wanted[c]).items():
+                    loaded[(c.table.title, pk)] = obj
+
+        # add them to their parents, ready for the next level
+        next_level = []
+        for values, parents, c, key in links:
+            if key not in loaded:
+                # no such object
+                continue
+            its_related = {}
+            values[c.table.title] = (loaded[key], its_related)
+            next_level.append((loaded[key], its_related, parents))
+        level = next_level
+
+    return [render(o, values) for o, values in zip(objs, related)]
+
+def iter_expanded(objs, expandables, depth=MAX_EXPAND_DEPTH):
+    """Like expand_objects, but given an iterable of objects, returns a generator that expands
+    them EXPAND_BATCH at a time."""
+
+    objs = iter(objs)
+    loaded = {}
+    while True:
+        batch = list(islice(objs, EXPAND_BATCH))
+        if not batch:
+            return
+        for values in expand_objects(batch, expandables, depth, loaded):
+            yield values
+
+def handle_batch(cookie, operations, session, registry):
+    """Given a JSON array of operations (each an object of request parameters, like 'obj' and
+    'action'), runs each in order, inside a single transaction, and returns a Python object
+    whose data is the list of their results.
+
+    If any operation fails, everything is rolled back, and the error is returned along with
+    the results so far (see resolve_reference for referring to earlier results)."""
+
+    from json import loads
 
     result = { 'status': 0, 'error': '', 'data': None }
 
     try:
+        operations = loads(operations)
+    except ValueError:
+        operations = None
+    if not isinstance(operations, list) or not all(isinstance(o, dict) for o in operations):
+        result['status'], result['error'] = (1, 'The batch must be a list of objects.')
+        return result
+    if len(operations) > MAX_BATCH:
+        result['status'], result['error'] = (1, 'Too many operations (the most is %d).' % MAX_BATCH)
+        return result
+
+    # a failed operation rolls back the whole batch
+    class BatchFailed(Exception):
+        pass
+
+    results = []
+    def run_operations(dbs):
+        if dbs:
+            with transaction(dbs[0]):
+                return run_operations(dbs[1:])
+
+        for i, operation in enumerate(operations):
+            if 'batch' in operation:
+                op_result = { 'status': 1, 'error': 'Batches cannot be nested.', 'data': None }
+            else:
+                try:
+                    # null values are left out, just like blank CGI values
+                    data = {}
+                    for k, v in operation.items():
+                        v = resolve_reference(v, results)
+                        if v != None:
+                            data[str(k)] = FormValue(unicode(v))
+                    op_result = handle_request(cookie, data, session, registry)
+                except Exception, e:
+                    op_result = { 'status': 1, 'error': str(e), 'data': None }
+
+            results.append(op_result)
+            if op_result['status'] != 0:
+                result['status'] = op_result['status']
+                result['error'] = "Operation %d: %s" % (i, op_result['error'])
+                raise BatchFailed()
+
+    # make any tables that haven't been yet first, so rolling back doesn't take them away
+    for c in registry.tables.values():
+        c.link()
+
+    # run everything in one transaction per database
+    try:
+        run_operations(registry.databases)
+    except BatchFailed:
+        pass
+
+    result['data'] = results
+    return result
+
+def handle_request(cookie, data, session, classes, stream=False):
+    """Given a list of classes (or an ApiRegistry of them), as well as the cookies, session
+    objects and CGI form data, responds to the given request, returning a Python object.
+
+    If stream is True, the data for a view is a generator, which reads each object from the
+    DB as it is needed (see iter_json), rather than a list."""
+
+    result = { 'status': 0, 'error': '', 'data': None }
+
+    registry = get_registry(classes)
+
+    try:
+
+        # many operations at once?
+        if 'batch' in data:
+            if isinstance(data['batch'], list):
+                result['status'], result['error'] = (1, 'Only one batch can be sent at a time.')
+                return result
+            return handle_batch(cookie, data['batch'].value, session, registry)
 
         # anything to expand?
         expandables = []
         if 'expand' in data:
             for c in data['expand'].value.split(','):
-                # find this class
-                for cl in classes:
-                    if hasattr(cl, 'linkedclass') and cl.table.title == c:
-                        # found it
-                        expandables.append(cl)
-                        break
+                if c in registry.tables:
+                    expandables.append(registry.tables[c])
 
         # check they specified an object
         if 'obj' not in data:
@@ -27,30 +279,26 @@ def handle_request(cookie, data, session, classes):
             return result
 
         # get the class they specified
-        specified_class = None
-        for c in classes:
-            if c.__name__ == data['obj'].value:
-                # custom function
+        specified_class = registry.route(data['obj'].value)
+        if specified_class != None and not hasattr(specified_class, 'linkedclass'):
+            # custom function
 
-                # get other URL params
-                params = {}
-                for field in data:
-                    params[field] = data[field].value
+            # get other URL params
+            params = {}
+            for field in data:
+                params[field] = data[field].value
 
-                # send special params
-                params['_cookie'] = cookie
-                params['_classes'] = classes
-                params['_session'] = session
-                params['_expand'] = expandables
+            # send special params
+            params['_cookie'] = cookie
+            params['_classes'] = registry.classes
+            params['_session'] = session
+            params['_expand'] = expandables
 
-                # call function
-                result['data'] = c(**params)
+            # call function
+            result['data'] = specified_class(**params)
 
-                # done
-                return result
-            elif hasattr(c, 'linkedclass') and c.table.title == data['obj'].value:
-                specified_class = c
-                break
+            # done
+            return result
 
         if specified_class == None:
             # no class found
@@ -70,25 +318,53 @@ def handle_request(cookie, data, session, classes):
                 start = int(data['start'].value)
             if 'limit' in data and data['limit'].value.isdigit() and int(data['limit'].value) >= 0:
                 limit = int(data['limit'].value)
+
+        # how deep to expand
+        depth = MAX_EXPAND_DEPTH
+        if 'depth' in data and data['depth'].value.isdigit():
+            depth = min(int(data['depth'].value), MAX_EXPAND_DEPTH)
             
         action = 0 # view
         if 'action' in data:
             if data['action'].value.lower() == 'new': action = 1 # add
             if data['action'].value.lower() == 'edit': action = 2 # change
             if data['action'].value.lower() == 'delete': action = 3 # delete
+            if data['action'].value.lower() == 'changes': action = 4 # what changed
 
         # find the fields from the remaining arguments
         # TODO: prevent fields from being called fetch, action, obj, etc
         field_values = {}
         field_search_values = {}
-        for field in data:
-            if specified_class.table.is_field(field):
-                field_values[field] = data[field].value
-            elif specified_class.table.is_field(field.strip('*')):
-                field_search_values[field.strip('*')] = data[field].value
+        for param in data:
+            field = registry.field(specified_class.table.title, param)
+            if field == None:
+                continue
+            elif field[1]:
+                field_search_values[field[0]] = data[param].value
+            else:
+                field_values[field[0]] = data[param].value
 
         # perform the specified action
-        if action == 1:
+        if 'action' in data and data['action'].value.lower() == 'subscribe':
+            # only long-lived servers can wait for changes (see spods.push)
+            result['status'], result['error'] = (1, 'Subscriptions need a long-lived server (see wsgi_app).')
+
+        elif action == 4:
+            # the rows changed since the given sequence number (or just the latest one, to start from)
+            if 'since' not in data:
+                result['seq'] = specified_class.latest_change()
+                result['data'] = []
+            elif not data['since'].value.isdigit():
+                result['status'], result['error'] = (1, 'Invalid sequence number.')
+            else:
+                since = int(data['since'].value)
+                serialise = specified_class.serialise
+                changes = specified_class.changes(since, limit)
+                result['data'] = [{ 'seq': seq, 'op': op, 'pk': pk, 'obj': serialise(obj) if obj != None else None }
+                                  for seq, op, pk, obj in changes]
+                result['seq'] = changes[-1][0] if changes else since
+
+        elif action == 1:
             # we're adding: get the fields together and build the object
             new_obj = specified_class(**field_values)
             result['data'] = [dict(new_obj)]
@@ -101,92 +377,63 @@ def handle_request(cookie, data, session, classes):
                 field_values['_start'] = start
                 field_values['_limit'] = limit
                 
-                # use the regular field values
-                objs = specified_class.get_all(**field_values)
-
+                # use the regular field values (reading them as we go, if streaming)
                 if action == 3:
-                    # save the rows
-                    result['data'] = [dict(obj) for obj in objs]
-                    
-                    # delete them
-                    for obj in objs:
-                        del obj[specified_class.table.pk.title]
+                    # delete them all at once, keeping the deleted rows
+                    serialise = specified_class.serialiser()
+                    result['data'] = [serialise(row) for row in specified_class.delete_all(**field_values)]
+
                 else:
-                    # expand any fields we need to
-                    final_objs = []
-
-                    # we need a nice recursive function for this
-                    # (some variables are defined through closure)
-                    def expand_and_serialize(o, seen=[]):
-                        final_o = dict(o)
-                        for expandable_class in expandables:
-                            try:
-                                fk_title = expandable_class.table.title
-                                matched_value = o[fk_title]
-                                if matched_value not in seen:
-                                    final_o[fk_title] = expand_and_serialize(matched_value, seen + [o])
-                            except Exception:
-                                # no matched value for this expandable (or its FK)
-                                continue
-                        return final_o
-                    
-                    for o in objs:
-                        final_objs.append(expand_and_serialize(o))
-
-                    # done
-                    result['data'] = final_objs
-                        
+                    # how many are there in total?
+                    if 'count' in data and data['count'].value.lower() in ('1', 'approx'):
+                        approximate = data['count'].value.lower() == 'approx'
+                        result['count'] = specified_class.count_all(_approximate=approximate, **field_values)
+
+                    if not expandables:
+                        # straight from the rows to JSON
+                        rows = specified_class.iter_serialised(**field_values)
+                        result['data'] = rows if stream else list(rows)
+
+                    else:
+                        # expand any fields we need to
+                        if stream:
+                            result['data'] = iter_expanded(specified_class.iter_all(**field_values), expandables, depth)
+                        else:
+                            result['data'] = expand_objects(specified_class.get_all(**field_values), expandables, depth)
+
             else:
                 field_search_values['_start'] = start
                 field_search_values['_limit'] = limit
                 
-                # use the asterisked fields for searching...
-                objs = specified_class.get_all(**field_search_values)
-
-                # ...and the regular fields for modifying
-                for obj in objs:
-                    for field in field_values:
-                        obj[field] = field_values[field]
+                # use the asterisked fields for searching, and the regular fields for modifying
+                serialise = specified_class.serialiser()
+                rows = specified_class.update_all(field_values, **field_search_values)
 
                 # done
-                result['data'] = [dict(obj) for obj in objs]
+                result['data'] = [serialise(row) for row in rows]
 
     except Exception, e:
         result['status'], result['error'] = 2, "%s: %s" % (type(e).__name__, str(e))
 
     return result
 
-def serve_api(*args):
-    """Given a list of LinkedClasses, reads the cookies and form data from the user and
-    tries to perform the specified request.
-
-    Returns a string, representing the content to print to the screen, which includes the
-    HTTP status response code, the cookie data, and the resulting JSON.
-
-    args is a list of classes (representing the Linked Classes to serve) and functions
-    (representing the custom functions to run).
-    """
-
-    from os import environ
-    from cgi import FieldStorage
-    from Cookie import SimpleCookie
-    from json import dumps
+def load_sessions(cookie, classes):
+    """Given the user's cookie and a list of classes (or an ApiRegistry), returns a dictionary
+    of table name --> session object, for each class that has session storage.
 
-    # TODO: remove this (for debugging only)!
-    from cgitb import enable as enable_debug; enable_debug()
+    New session objects are saved back into the cookie.
 
-    # get cookies
-    cookie = SimpleCookie()
-    cookie_string = environ.get('HTTP_COOKIE')
-    if cookie_string:
-        cookie.load(cookie_string)
+    Classes with a session_secret get a SessionProxy (see spods.session), which only goes to
+    the DB when it is used."""
 
-    # try and get session objects for any of the input classes that have session storage
     session = {}
-    for c in args:
-        if hasattr(c, 'linkedclass') and c.session_field:
+    for c in get_registry(classes).session_classes:
+        if c.session_secret:
+            session[c.table.title] = load_signed_session(c, cookie)
+
+        else:
             # try and match with cookie values
-            session_value = cookie.get(c.table.title + '_' + c.session_field)
+            session_value = cookie.get(session_cookie_name(c))
             session_obj = None
             if session_value:
                 session_obj = c.get_one(**{ c.session_field: session_value.value })
@@ -194,29 +441,325 @@ def serve_api(*args):
             # force a new session object, if needed, and save back to the cookie
             if not session_obj and c.force_session:
                 session_obj = c()
-                cookie[c.table.title + '_' + c.session_field] = session_obj[c.session_field]
+                cookie[session_cookie_name(c)] = session_obj[c.session_field]
 
             # save to session vars
             session[c.table.title] = session_obj
 
+    return session
+
+def iter_json(result):
+    """Given a result from handle_request, returns a generator of strings which together
+    make up its JSON.
+
+    If the result's data is a generator (see handle_request), each object is encoded as it
+    comes, so the whole response is never held in memory at once. The status and error are
+    written last, so that an error part way through still reaches the client."""
+
+    from json import dumps
+    from types import GeneratorType
+
+    if not isinstance(result['data'], GeneratorType):
+        yield encode(result)
+        return
+
+    status, error = result['status'], result['error']
+
+    yield '{"data": ['
+    try:
+        first = True
+        for obj in result['data']:
+            yield (encode(obj) if first else ', ' + encode(obj))
+            first = False
+    except Exception, e:
+        status, error = 2, "%s: %s" % (type(e).__name__, str(e))
+    if 'count' in result:
+        yield '], "count": %s' % dumps(result['count'])
+    else:
+        yield ']'
+    yield ', "status": %s, "error": %s}' % (dumps(status), dumps(error))
+
+def purge_some(classes):
+    """Given a list of classes (or an ApiRegistry), deletes one batch of expired rows from
+    each table with a ttl, and compacts the change log of each table whose changes are tracked."""
+    registry = get_registry(classes)
+    for c in registry.ttl_classes:
+        c.purge_expired(max_batches=1)
+    for c in registry.change_classes:
+        c.compact_changes()
+
+def cookie_headers(cookie, received):
+    """Given the user's cookie, and a dictionary of the values it had when it was received,
+    returns a list of Set-Cookie headers for the values that have been set since."""
+
+    headers = []
+    for key, morsel in cookie.items():
+        if received.get(key) != morsel.value:
+            headers.append(('Set-Cookie', morsel.OutputString()))
+    return headers
+
+def http_status(result):
+    """Given a result from handle_request, returns the matching HTTP status line."""
+
+    status = result.get('status', 1)
+    if status > 0: return '400 Bad Request'
+    if status < 0: return '401 Unauthorized'
+    return '200 OK'
+
+def response_etag(data, classes):
+    """Given the CGI form data and a list of classes and functions (or an ApiRegistry), returns
+    an ETag for the response, or None if the response can't be cached.
+
+    Only views of versioned tables (including any expanded tables) can be cached. The ETag
+    depends on the request parameters and the versions of those tables, so it changes as
+    soon as any of them is written to. Tables with a ttl can't be cached, since their rows
+    expire without anything being written."""
+
+    from hashlib import sha1
+
+    try:
+        keys = sorted(data.keys())
+    except TypeError:
+        # not form data
+        return None
+
+    if 'obj' not in keys or 'batch' in keys:
+        return None
+    if 'action' in keys and data.getfirst('action').lower() != 'view':
+        return None
+
+    tables = get_registry(classes).tables
+
+    titles = [data.getfirst('obj')]
+    if 'expand' in keys:
+        titles += [t for t in data.getfirst('expand').split(',') if t in tables]
+
+    key = sha1()
+    for title in sorted(set(titles)):
+        if title not in tables or not tables[title].versioned or tables[title].table.ttl:
+            return None
+        key.update("%s=%s;" % (title, tables[title].version()))
+
+    for k in keys:
+        for value in data.getlist(k):
+            key.update("%r=%r;" % (k, value))
+
+    return '"%s"' % key.hexdigest()
+
+def request_labels(data, registry):
+    """Given the CGI form data and an ApiRegistry, returns the obj and action labels the
+    request is counted under in spods.metrics."""
+
+    try:
+        keys = data.keys()
+    except TypeError:
+        # not form data
+        return { 'obj': 'unknown', 'action': 'unknown' }
+
+    if 'batch' in keys:
+        return { 'obj': 'batch', 'action': 'batch' }
+
+    # only count objects that exist, so the labels can't be made up by anyone
+    obj = data.getfirst('obj')
+    route = registry.route(obj) if obj else None
+    if route == None:
+        return { 'obj': 'unknown', 'action': 'unknown' }
+    if not hasattr(route, 'linkedclass'):
+        return { 'obj': obj, 'action': 'call' }
+
+    action = (data.getfirst('action') or 'view').lower()
+    if action not in ('new', 'edit', 'delete', 'changes'):
+        action = 'view'
+    return { 'obj': obj, 'action': action }
+
+def metrics_response(environ, data):
+    """Given the request's CGI/WSGI environment variables and form data, returns the response
+    to a request for the metrics: a (HTTP status line, headers, body) tuple."""
+
+    import hmac
+    from json import dumps
+
+    token = data.getfirst('token') or ''
+    authorization = environ.get('HTTP_AUTHORIZATION', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):].strip()
+
+    # compare in constant time, where we can
+    compare = getattr(hmac, 'compare_digest', lambda a, b: a == b)
+    if not compare(str(token), str(metrics_token)):
+        result = { 'status': -1, 'error': 'Invalid metrics token.', 'data': None }
+        return http_status(result), [('Content-Type', 'application/JSON')], dumps(result)
+
+    return '200 OK', [('Content-Type', 'text/plain; version=0.0.4')], render_metrics()
+
+def respond(environ, fp, classes, stream=False):
+    """Given the request's CGI/WSGI environment variables, a file to read the request body from
+    (or None, for standard input) and a list of classes and functions (or an ApiRegistry) to
+    serve, performs the requested action.
+
+    Returns a tuple of (HTTP status line, list of (header, value) pairs, JSON body).
+
+    If stream is True, the body is a generator of strings (see iter_json), and the status
+    line can only report errors that happen before the first object is read.
+
+    Each request is counted in spods.metrics, traced as a 'request' span if tracing is on
+    (see spods.tracing), and has its own memory account if memory profiling is on (see
+    spods.profiling). Streamed views are only counted, traced and accounted for up to the
+    first object."""
+
+    with span('request', method=environ.get('REQUEST_METHOD')) as request_span:
+        with profiler.account('request', query=environ.get('QUERY_STRING')):
+            status, headers, body = build_response(environ, fp, classes, stream)
+        request_span.set('status', status)
+    return status, headers, body
+
+def build_response(environ, fp, classes, stream):
+    """Does the work of respond, returning the same tuple."""
+
+    from cgi import FieldStorage
+    from Cookie import SimpleCookie
+
+    registry = get_registry(classes)
+
+    start = time()
+    statements = metrics.statements()
+
     # get URL data
-    cgi_data = FieldStorage()
+    cgi_data = FieldStorage(fp=fp, environ=environ)
+
+    # the metrics themselves aren't counted
+    if metrics_token != None and cgi_data.list != None and cgi_data.getfirst('obj') == METRICS_OBJ:
+        return metrics_response(environ, cgi_data)
+
+    def finish(status, headers, body, cached=None):
+        """Counts the request in spods.metrics (and whether it was cached, if it could be),
+        and returns the response."""
+
+        if metrics.enabled:
+            labels = request_labels(cgi_data, registry)
+            metrics.observe('spods_request_seconds', labels, time() - start)
+            metrics.count('spods_request_sql_statements_total', labels, metrics.statements() - statements)
+            labels['status'] = status.split()[0]
+            metrics.count('spods_requests_total', labels)
+            if cached:
+                metrics.count('spods_cache_requests_total', { 'result': cached })
+            metrics.flush()
+
+        return status, headers, body
+
+    # get cookies
+    cookie = SimpleCookie()
+    cookie_string = environ.get('HTTP_COOKIE')
+    if cookie_string:
+        cookie.load(cookie_string)
+    received = dict((key, morsel.value) for key, morsel in cookie.items())
+
+    # every so often, tidy up expired rows
+    if random() < PURGE_CHANCE:
+        purge_some(registry)
+
+    # try and get session objects for any of the input classes that have session storage
+    with span('session'):
+        session = load_sessions(cookie, registry)
+
+    headers = []
+
+    # can we skip doing the work?
+    etag = response_etag(cgi_data, registry)
+    if etag:
+        headers.append(('ETag', etag))
+
+        # the client already has it
+        if etag in [t.strip() for t in environ.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            return finish('304 Not Modified', cookie_headers(cookie, received) + headers, '', 'not_modified')
+
+        # we already have it
+        body = response_cache.get(etag[1:-1]) if response_cache != None else None
+        if body != None:
+            headers.append(('Content-Type', 'application/JSON'))
+            return finish('200 OK', cookie_headers(cookie, received) + headers, body, 'hit')
 
     # handle request
-    result = handle_request(cookie, cgi_data, session, args)
-    status = result.get('status', 1)
+    with span('action', **request_labels(cgi_data, registry)) as action_span:
+        result = handle_request(cookie, cgi_data, session, registry, stream)
+        action_span.set('status', result['status'])
+
+    # (sessions used while handling the request may have changed the cookie)
+    headers = cookie_headers(cookie, received) + headers
+
+    if stream:
+        # can't cache what we haven't made yet
+        if etag:
+            headers.remove(('ETag', etag))
+        headers.append(('Content-Type', 'application/JSON'))
+        return finish(http_status(result), headers, iter_json(result), etag and 'miss')
+
+    with span('serialise'):
+        body = encode(result)
+    if profiler.enabled:
+        profiler.charge('response', len(body), check=False)
+
+    if etag:
+        if result['status'] != 0:
+            # don't cache errors
+            headers.remove(('ETag', etag))
+        elif response_cache != None:
+            response_cache.set(etag[1:-1], body)
+
+    headers.append(('Content-Type', 'application/JSON'))
+    return finish(http_status(result), headers, body, etag and 'miss')
+
+def serve_api(*args):
+    """Given a list of LinkedClasses, reads the cookies and form data from the user and
+    tries to perform the specified request.
+
+    Returns a string, representing the content to print to the screen, which includes the
+    HTTP status response code, the cookie data, and the resulting JSON.
+
+    args is a list of classes (representing the Linked Classes to serve) and functions
+    (representing the custom functions to run).
+    """
+
+    from os import environ
+
+    # tracebacks in the browser, for debugging only
+    if environ.get('SPODS_DEBUG'):
+        from cgitb import enable as enable_debug; enable_debug()
+
+    status, headers, body = respond(environ, None, args)
 
     # return appropriate response
-    response = ""
-    if cookie: response += str(cookie)
-
-    # TODO: get the status to return appropriately: is this possible as a CGI script?
-    # response += 'Status: '
-    # if status > 0: response += '400 Bad Request\r\n'
-    # if status < 0: response += '401 Unauthorized\r\n'
-    # se: response += '200 OK\r\n'
-    
-    response += "Content-Type: application/JSON\r\n\r\n"
-    if result: response += dumps(result)
+    response = "Status: %s\r\n" % status
+    for header, value in headers:
+        response += "%s: %s\r\n" % (header, value)
+    response += "\r\n"
+    response += body
 
     return response
+
+def write_api(*args):
+    """Like serve_api, but writes the response to standard output as it is made, rather than
+    returning it. Views are streamed, so large pages of results are never held in memory
+    all at once.
+
+    e.g. if __name__ == "__main__": write_api(Book, Author)
+    """
+
+    import sys
+    from os import environ
+
+    # tracebacks in the browser, for debugging only
+    if environ.get('SPODS_DEBUG'):
+        from cgitb import enable as enable_debug; enable_debug()
+
+    status, headers, body = respond(environ, None, args, stream=True)
+
+    out = sys.stdout
+    out.write("Status: %s\r\n" % status)
+    for header, value in headers:
+        out.write("%s: %s\r\n" % (header, value))
+    out.write("\r\n")
+
+    for chunk in body:
+        out.write(chunk)
+    out.flush()
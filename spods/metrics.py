@@ -0,0 +1,220 @@
+"""Counts what SPODS does (API requests, SQL statements and cache lookups) and how long it
+takes, in Prometheus' text format.
+
+Each process keeps its own counts. CGI processes only live for a single request, so to add up
+the counts of many processes, give them a file to share with share_metrics(): each request
+adds its counts to the file, and render_metrics() reads them back from it."""
+
+import os
+import threading
+
+from bisect import bisect_left
+
+try:
+    import fcntl
+except ImportError:
+    # on Windows, processes sharing a metrics file may (rarely) lose counts
+    fcntl = None
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# metric name --> (type, help text)
+METRICS = {
+    'spods_requests_total': ('counter', "API requests, by obj, action and HTTP status."),
+    'spods_request_seconds': ('histogram', "Time taken to respond to API requests, by obj and action."),
+    'spods_request_sql_statements_total': ('counter', "SQL statements run while responding to API requests, by obj and action."),
+    'spods_sql_statements_total': ('counter', "SQL statements run, by table."),
+    'spods_sql_seconds': ('histogram', "Time taken to run SQL statements, by table."),
+    'spods_cache_requests_total': ('counter', "Cacheable API requests, by result (hit, miss or not_modified).")
+}
+
+def label_key(labels):
+    """Given a dictionary of labels, returns them as a (hashable) sorted tuple of pairs."""
+    return tuple(sorted(labels.items()))
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(key, extra=()):
+    """Given labels as a tuple of pairs, returns them in Prometheus' format, e.g. {table="book"}."""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for name, value in pairs)
+
+def format_number(n):
+    if n == int(n):
+        return str(int(n))
+    return repr(float(n))
+
+class Metrics(object):
+    """The class representing a set of counters and latency histograms.
+
+    Counters are kept as (name, labels) --> value, and histograms as (name, labels) -->
+    [count in each bucket, count above the last bucket, sum of the values]."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.enabled = True
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+
+        # a file to add the counts to (see share_metrics)
+        self.path = None
+
+        self.lock = threading.Lock()
+
+        # SQL statements run by this thread, so a request can tell how many it caused
+        self.local = threading.local()
+
+    def count(self, name, labels, amount=1):
+        """Adds amount to a counter."""
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        """Adds a value (usually a time, in seconds) to a histogram."""
+        key = (name, label_key(labels))
+        with self.lock:
+            self.add_to_histogram(key, seconds)
+
+    def add_to_histogram(self, key, seconds):
+        if key not in self.histograms:
+            self.histograms[key] = [0] * (len(self.buckets) + 2)
+        histogram = self.histograms[key]
+        # in the first bucket it fits in
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def sql(self, table, seconds):
+        """Records a SQL statement run on the given table. (This is run for every statement,
+        so it takes the lock just once.)"""
+
+        labels = (('table', table), )
+        count_key = ('spods_sql_statements_total', labels)
+        with self.lock:
+            self.counters[count_key] = self.counters.get(count_key, 0) + 1
+            self.add_to_histogram(('spods_sql_seconds', labels), seconds)
+
+        local = self.local
+        local.statements = getattr(local, 'statements', 0) + 1
+
+    def statements(self):
+        """Returns the number of SQL statements this thread has run so far."""
+        return getattr(self.local, 'statements', 0)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def dump(self):
+        """Returns the counters and histograms as a JSON-friendly dictionary (see merge)."""
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), values] for (name, labels), values in self.histograms.items()]
+            }
+
+    def merge(self, dumped):
+        """Adds the counts from a dictionary made by dump()."""
+        with self.lock:
+            for name, labels, value in dumped.get('counters', []):
+                key = (name, tuple(tuple(pair) for pair in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in dumped.get('histograms', []):
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if len(values) != len(self.buckets) + 2:
+                    # made with different buckets
+                    continue
+                histogram = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+    def flush(self):
+        """Adds the counts so far to the shared file (if there is one), and starts counting
+        from zero again."""
+
+        if not self.path:
+            return
+
+        import json
+
+        dumped = self.dump()
+        self.clear()
+
+        with open(self.path, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                shared = Metrics(self.buckets)
+                shared.merge(json.loads(f.read() or '{}'))
+                shared.merge(dumped)
+
+                f.seek(0)
+                f.truncate()
+                json.dump(shared.dump(), f)
+                f.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def render(self):
+        """Returns the counters and histograms in Prometheus' text format. If there is a shared
+        file, includes the counts in it."""
+
+        totals = self
+        if self.path and os.path.exists(self.path):
+            import json
+            totals = Metrics(self.buckets)
+            with open(self.path) as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                totals.merge(json.loads(f.read() or '{}'))
+            totals.merge(self.dump())
+
+        with totals.lock:
+            counters = sorted(totals.counters.items())
+            histograms = sorted(totals.histograms.items())
+
+        lines = []
+        for name in sorted(METRICS):
+            kind, help_text = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            if kind == 'counter':
+                for (n, labels), value in counters:
+                    if n == name:
+                        lines.append('%s%s %s' % (name, format_labels(labels), format_number(value)))
+                continue
+
+            for (n, labels), values in histograms:
+                if n != name:
+                    continue
+                # buckets are cumulative
+                total = 0
+                for bound, value in zip(self.buckets, values):
+                    total += value
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', format_number(bound))]), total))
+                total += values[-2]
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', '+Inf')]), total))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_number(values[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), total))
+
+        return '\n'.join(lines) + '\n'
+
+# the metrics kept by this process
+metrics = Metrics()
+
+def share_metrics(path):
+    """Given the path of a file (which every process must be able to write to), or None, sets
+    where this process adds up its counts, e.g. for CGI scripts."""
+    metrics.path = path
+
+def render_metrics():
+    """Returns the metrics in Prometheus' text format, e.g. for an app that serves them itself."""
+    return metrics.render()
@@ -0,0 +1,301 @@
+import sqlite3
+
+from base import Table
+
+# number of rows copied per transaction when rebuilding a table
+DEFAULT_BATCH_SIZE = 1000
+
+# prefix for the temporary table used while rebuilding
+REBUILD_PREFIX = "_spods_new_"
+
+def live_columns(db, title):
+    """Given a database connection and a table name, returns a list of the columns
+    in that table as it currently exists in the DB.
+
+    Each column is a (name, sql_type, not_null, default_sql, pk) tuple. Returns an
+    empty list if the table doesn't exist."""
+
+    c = db.cursor()
+    c.execute("PRAGMA table_info(%s)" % title)
+    columns = [(row[1], row[2] or '', bool(row[3]), row[4], bool(row[5])) for row in c]
+    c.close()
+    return columns
+
+def column_stmt(column):
+    """Given a live column tuple (as returned by live_columns), returns the SQL
+    needed to re-create that column."""
+
+    name, sql_type, not_null, default_sql, pk = column
+
+    query = " %s " % name
+    if sql_type:
+        query += " %s " % sql_type
+    if not_null:
+        query += " NOT NULL "
+    if default_sql != None:
+        query += " DEFAULT %s " % default_sql
+    if pk:
+        query += " PRIMARY KEY "
+
+    return query
+
+class Migration(object):
+    """The class representing a planned set of changes to a single table.
+
+    Each step is a tuple, whose first item is one of:
+        * 'create', for a table that doesn't exist yet
+        * 'add', followed by the Field to add
+        * 'drop', followed by the name of the column to remove
+        * 'rename', followed by the old and new column names
+        * 'retype', followed by the name of the column whose type, nullability or primary key changed
+
+    Adding columns is done with ALTER TABLE. Any other change needs the table to be
+    rebuilt, which is done in batches (see run())."""
+
+    def __init__(self, table, steps, columns):
+        self.table = table
+        self.steps = steps
+
+        # (name, definition, source expression) for each column of the rebuilt table
+        self.columns = columns
+
+    def needs_rebuild(self):
+        for step in self.steps:
+            if step[0] in ('drop', 'rename', 'retype'):
+                return True
+        return False
+
+    def __nonzero__(self):
+        return bool(self.steps)
+
+    def __str__(self):
+        lines = []
+        for step in self.steps:
+            if step[0] == 'create':
+                lines.append("create table %s" % self.table.title)
+            elif step[0] == 'rename':
+                lines.append("rename column %s to %s" % (step[1], step[2]))
+            else:
+                lines.append("%s column %s" % (step[0], step[1]))
+        return "\n".join(lines)
+
+    def run(self, db, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """Applies this migration to the given database connection.
+
+        If the table needs rebuilding, rows are copied across batch_size at a time, each
+        batch in its own transaction, so other connections can keep reading and writing
+        the table while the copy runs.
+
+        If progress is a function, it is called with (rows_copied, total_rows) after each batch."""
+
+        if not self.steps:
+            return
+
+        # we manage transactions ourselves
+        db.isolation_level = None
+
+        if self.steps[0][0] == 'create':
+            db.execute(self.table.create_table_stmt(force=False))
+        elif not self.needs_rebuild():
+            for step in self.steps:
+                db.execute(self.table.add_field_stmt(step[1]))
+        else:
+            rebuild_table(db, self.table.title, self.table.pk.title, self.columns, batch_size, progress)
+
+def plan_migration(table, db, renames=None):
+    """Given a table object and a database connection, compares the table definition
+    against the live schema, and returns a Migration describing the changes needed.
+
+    renames is an optional dictionary of old column name --> new column name. Without it,
+    a renamed column looks like a dropped column plus an added one (and its data is lost).
+
+    Live columns that are not fields of the table are dropped."""
+
+    if renames is None:
+        renames = {}
+    new_names = dict((new, old) for old, new in renames.items())
+
+    live = live_columns(db, table.title)
+    if not live:
+        return Migration(table, [('create', )], [])
+
+    live_map = dict((column[0], column) for column in live)
+
+    steps = []
+    columns = []
+    for field in table.fields:
+        source = new_names.get(field.title, field.title)
+
+        if source not in live_map:
+            # brand new column: fill it with its (static) default
+            steps.append(('add', field))
+            if field.default != None and not hasattr(field.default, '__call__'):
+                expr = "%r" % (field.default, )
+            else:
+                expr = "NULL"
+        else:
+            name, sql_type, not_null, default_sql, pk = live_map[source]
+            expr = source
+
+            if source != field.title:
+                steps.append(('rename', source, field.title))
+
+            if (sql_type.upper() != (field.sql_type or '').upper()
+                    or not_null != (field.null == False)
+                    or pk != bool(field.pk)):
+                steps.append(('retype', field.title))
+                if field.sql_type:
+                    expr = "CAST(%s AS %s)" % (source, field.sql_type)
+
+        columns.append((field.title, Table.field_stmt(field), expr))
+
+    # anything left over is being dropped
+    kept = set(new_names.get(field.title, field.title) for field in table.fields)
+    for column in live:
+        if column[0] not in kept:
+            steps.append(('drop', column[0]))
+
+    return Migration(table, steps, columns)
+
+def migrate(table, db, renames=None, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Given a table object and a database connection, brings the live table in line with
+    the table definition. Returns the Migration that was run.
+
+    See plan_migration() and Migration.run() for the parameters."""
+
+    migration = plan_migration(table, db, renames)
+    migration.run(db, batch_size, progress)
+    return migration
+
+def drop_column(db, title, column_name, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Given a database connection, a table name and a column name, removes that column
+    from the table (keeping all other columns as they are)."""
+
+    live = live_columns(db, title)
+    pk_title = None
+    columns = []
+    for column in live:
+        if column[4]:
+            pk_title = column[0]
+        if column[0] != column_name:
+            columns.append((column[0], column_stmt(column), column[0]))
+
+    if len(columns) == len(live):
+        # nothing to drop
+        return
+
+    db.isolation_level = None
+    rebuild_table(db, title, pk_title, columns, batch_size, progress)
+
+def rebuild_table(db, title, pk_title, columns, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Rebuilds a table with a new set of columns, without holding a write lock for
+    the whole copy.
+
+    columns is a list of (name, definition, source expression) tuples, where the source
+    expression is evaluated against the old table.
+
+    The rebuild works like so:
+        1. make a new table with the new columns
+        2. add triggers so writes to the old table during the copy are mirrored
+        3. copy rows across in primary key order, one batch per transaction
+        4. in a single transaction, drop the old table, rename the new one, and re-create
+           the old table's triggers (e.g. those of versioned=True or track_changes=True)
+        5. re-create any indexes that still apply
+    """
+
+    new_title = REBUILD_PREFIX + title
+    names = ", ".join(column[0] for column in columns)
+    exprs = ", ".join(column[2] for column in columns)
+    new_has_pk = pk_title in [column[0] for column in columns]
+
+    c = db.cursor()
+
+    # remember indexes, since they're dropped along with the old table
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (title, ))
+    indexes = [row[0] for row in c]
+
+    # and triggers, for the same reason
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ? AND sql IS NOT NULL", (title, ))
+    triggers = [row[0] for row in c]
+
+    # 1. make the new table
+    c.execute("DROP TABLE IF EXISTS %s" % new_title)
+    c.execute("CREATE TABLE %s (%s)" % (new_title, ",".join(column[1] for column in columns)))
+
+    # 2. mirror writes
+    copy_row = "INSERT OR REPLACE INTO %s (%s) SELECT %s FROM %s WHERE %s = NEW.%s;" % (new_title, names, exprs, title, pk_title, pk_title)
+    remove_row = "DELETE FROM %s WHERE %s = OLD.%s;" % (new_title, pk_title, pk_title) if new_has_pk else ""
+    c.execute("CREATE TRIGGER %s_ins AFTER INSERT ON %s BEGIN %s END" % (new_title, title, copy_row))
+    c.execute("CREATE TRIGGER %s_upd AFTER UPDATE ON %s BEGIN %s %s END" % (new_title, title, remove_row, copy_row))
+    if new_has_pk:
+        c.execute("CREATE TRIGGER %s_del AFTER DELETE ON %s BEGIN %s END" % (new_title, title, remove_row))
+
+    try:
+        # 3. copy rows in batches (rows inserted after this point are mirrored by the triggers)
+        c.execute("SELECT COUNT(*), MAX(%s) FROM %s" % (pk_title, title))
+        total, max_pk = c.fetchone()
+        copied = 0
+        last_pk = None
+        while max_pk != None:
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                clause = "%s <= ?" % pk_title
+                args = (max_pk, )
+                if last_pk != None:
+                    clause += " AND %s > ?" % pk_title
+                    args += (last_pk, )
+
+                c.execute("SELECT MAX(%s), COUNT(*) FROM (SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT ?)" % (pk_title, pk_title, title, clause, pk_title), args + (batch_size, ))
+                upto, count = c.fetchone()
+
+                if count:
+                    c.execute("INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s WHERE %s AND %s <= ?" % (new_title, names, exprs, title, clause, pk_title), args + (upto, ))
+                c.execute("COMMIT")
+            except:
+                c.execute("ROLLBACK")
+                raise
+
+            if not count:
+                break
+
+            last_pk = upto
+            copied += count
+            if progress:
+                progress(copied, total)
+
+        # 4. swap the tables
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            for suffix in ('ins', 'upd', 'del'):
+                c.execute("DROP TRIGGER IF EXISTS %s_%s" % (new_title, suffix))
+            c.execute("DROP TABLE %s" % title)
+            c.execute("ALTER TABLE %s RENAME TO %s" % (new_title, title))
+
+            # in the same transaction, so no write goes unseen by them
+            for sql in triggers:
+                try:
+                    c.execute(sql)
+                except sqlite3.OperationalError:
+                    # it refers to a dropped or renamed column
+                    pass
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+
+    except:
+        # leave the old table as it was
+        for suffix in ('ins', 'upd', 'del'):
+            c.execute("DROP TRIGGER IF EXISTS %s_%s" % (new_title, suffix))
+        c.execute("DROP TABLE IF EXISTS %s" % new_title)
+        c.close()
+        raise
+
+    # 5. re-create indexes (those referring to dropped or renamed columns will fail)
+    for sql in indexes:
+        try:
+            c.execute(sql)
+        except sqlite3.OperationalError:
+            pass
+
+    c.close()
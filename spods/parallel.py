@@ -0,0 +1,193 @@
+"""Runs a function over every row of a table (or every row matching some criteria) on all of
+the machine's cores, for batch jobs like recomputing fields or exporting a big table.
+
+The rows are split into chunks of consecutive primary keys. Each worker process reads its
+chunks through its own read-only connection, and hands back what the function returned for
+each row. Only the calling process writes to the DB: with write=True, the function returns the
+fields to change, and they are written in batches, one transaction per batch.
+
+Workers are forked from the calling process, so the function can be a lambda or a closure.
+Where processes can't be forked (on Windows), or for in-memory databases (which other
+processes can't open), the chunks are run one by one in the calling process instead."""
+
+import sqlite3
+import sys
+from itertools import count
+
+from push import database_file
+
+# rows per chunk handed to a worker
+DEFAULT_CHUNK = 10000
+
+# rows written per transaction (with write=True)
+WRITE_BATCH = 1000
+
+# seconds a worker waits for the writer to let go of the DB
+WORKER_TIMEOUT = 30
+
+# used to give each job a unique id
+job_ids = count()
+
+# job id --> (class, database file, function, (WHERE clause, arguments)), left for forked workers to find
+jobs = {}
+
+# this worker's job id and class (see start_worker)
+worker = {}
+
+def chunk_ranges(db, table, where, chunk):
+    """Given a database connection, a table, a (WHERE clause, arguments) tuple and a chunk size,
+    returns a list of (after, upto) primary key ranges, each holding chunk of the matching rows
+    (the last one may hold fewer). The first range's after and the last one's upto are None."""
+
+    pk = table.pk.title
+    condition = (where[0] + " AND " if where[0] else " WHERE ") + "%s > ?" % pk
+    first = "SELECT %s FROM %s %s ORDER BY %s LIMIT 1 OFFSET ?" % (pk, table.title, where[0], pk)
+    after = "SELECT %s FROM %s %s ORDER BY %s LIMIT 1 OFFSET ?" % (pk, table.title, condition, pk)
+
+    ranges = []
+    previous = None
+    c = db.cursor()
+    while True:
+        # the last key of the next chunk
+        if previous == None:
+            c.execute(first, where[1] + (chunk - 1, ))
+        else:
+            c.execute(after, where[1] + (previous, chunk - 1))
+        row = c.fetchone()
+        if row == None:
+            break
+        ranges.append((previous, row[0]))
+        previous = row[0]
+    c.close()
+
+    # the rest
+    ranges.append((previous, None))
+    return ranges
+
+def range_query(table, where, after, upto):
+    """Given a table, a (WHERE clause, arguments) tuple and a range of primary keys (see
+    chunk_ranges), returns a (query, arguments) tuple for the matching rows in the range."""
+
+    pk = table.pk.title
+    conditions = [where[0][len(" WHERE "):]] if where[0] else []
+    args = where[1]
+    if after != None:
+        conditions.append("%s > ?" % pk)
+        args += (after, )
+    if upto != None:
+        conditions.append("%s <= ?" % pk)
+        args += (upto, )
+
+    query = "SELECT * FROM %s" % table.title
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY %s" % pk, args
+
+def scan(c, fn, where, after, upto):
+    """Given a linked class, a function, a (WHERE clause, arguments) tuple and a range of
+    primary keys, returns (rows read, [(primary key, result)]) for the matching rows in the
+    range whose result wasn't None."""
+
+    cursor = c.db.cursor()
+    cursor.execute(*range_query(c.table, where, after, upto))
+    # read the whole chunk first, so the writer isn't kept waiting while fn runs
+    rows = cursor.fetchall()
+    cursor.close()
+
+    results = []
+    for row in rows:
+        obj = c.from_row(row)
+        result = fn(obj)
+        if result != None:
+            results.append((row[c.table.pk.title], result))
+    return len(rows), results
+
+def start_worker(job_id):
+    """Run in each worker process as it starts: links the job's table to a read-only connection
+    of its own (the calling process's connection can't be shared with a forked process)."""
+
+    from table_linker import link_table
+
+    c, path, fn, where = jobs[job_id]
+    db = sqlite3.connect(path, timeout=WORKER_TIMEOUT)
+    db.execute("PRAGMA query_only = 1")
+
+    # the table already exists, so linking it doesn't write anything (and anything fn tries to
+    # write through its objects fails)
+    worker['class'] = link_table(c.table, db, lazy=False)
+    worker['job'] = job_id
+
+def scan_in_worker(key_range):
+    """Given a range of primary keys, scans it in a worker process (see scan)."""
+    c, path, fn, where = jobs[worker['job']]
+    return scan(worker['class'], fn, where, key_range[0], key_range[1])
+
+def can_fork():
+    return sys.platform != 'win32'
+
+def parallel_map(c, fn, where, workers=None, chunk=DEFAULT_CHUNK, write=None, progress=None):
+    """Given a linked class, a function to call with each of its objects, a (WHERE clause,
+    arguments) tuple for the rows to call it with, the number of worker processes (or None, for
+    one per core) and the rows per chunk, returns a list of (primary key, result) tuples for
+    every row whose result wasn't None, in primary key order.
+
+    If write is given, it is called with batches of those tuples (at most WRITE_BATCH at a
+    time) as they arrive, instead of collecting them, and the number of results is returned.
+    If progress is given, it is called with (rows done, total rows) after each chunk."""
+
+    import multiprocessing
+
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+
+    c.link()
+    db = c.db
+    total = db.execute("SELECT COUNT(*) FROM %s %s" % (c.table.title, where[0]), where[1]).fetchone()[0]
+    ranges = chunk_ranges(db, c.table, where, chunk)
+    path = database_file(db)
+
+    results = []
+    batch = []
+    state = { 'done': 0, 'results': 0 }
+
+    def collect(chunk_result):
+        rows, chunk_results = chunk_result
+        state['done'] += rows
+        state['results'] += len(chunk_results)
+
+        if write:
+            batch.extend(chunk_results)
+            while len(batch) >= WRITE_BATCH:
+                write(batch[:WRITE_BATCH])
+                del batch[:WRITE_BATCH]
+        else:
+            results.extend(chunk_results)
+
+        if progress:
+            progress(state['done'], total)
+
+    if workers <= 1 or len(ranges) <= 1 or not path or not can_fork():
+        # one by one, in this process
+        for after, upto in ranges:
+            collect(scan(c, fn, where, after, upto))
+    else:
+        job_id = next(job_ids)
+        jobs[job_id] = (c, path, fn, where)
+        pool = multiprocessing.Pool(min(workers, len(ranges)), start_worker, (job_id, ))
+        try:
+            # in order, so the results come back in primary key order
+            for chunk_result in pool.imap(scan_in_worker, ranges):
+                collect(chunk_result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            del jobs[job_id]
+
+    if write:
+        if batch:
+            write(batch)
+        return state['results']
+    return results
@@ -0,0 +1,180 @@
+"""Accounts for the memory used by each API request and each get_all() call, broken down into
+rows read from the DB (and the objects made from them), the output of out masks, and the
+serialised response. With a hard cap, a request that would use too much memory is stopped
+with a clear error, before the process runs out.
+
+Profiling is off until it is turned on:
+
+    >>> spods.profile_memory(max_bytes=200 * 1024 * 1024)
+
+Where tracemalloc can be imported, each request's peak memory (as Python sees it) is
+reported too. Otherwise (as on Python 2), sizes are estimated from the objects themselves
+with sys.getsizeof, which undercounts a little but costs much less."""
+
+import sys
+import threading
+from collections import deque
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# most recent accounts kept in MemoryProfiler.reports
+MAX_REPORTS = 100
+
+# the kinds of memory that are accounted for
+KINDS = ('rows', 'masks', 'response')
+
+class MemoryLimitExceeded(Exception):
+    """Raised when a request (or get_all call) would use more memory than the profiler's cap."""
+
+def value_size(value):
+    """Returns the estimated size of a single value, in bytes."""
+    return sys.getsizeof(value)
+
+def row_size(row):
+    """Returns the estimated size of a row read from the DB (or a list of values), in bytes."""
+    return sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+
+def object_size(obj):
+    """Returns the estimated size of a linked object and its values, in bytes."""
+    return sys.getsizeof(obj) + sys.getsizeof(obj.data) + sum(sys.getsizeof(v) for v in obj.data.values())
+
+class NoAccount(object):
+    """The account handed out while profiling is off: a context manager that does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, tb):
+        return False
+
+NO_ACCOUNT = NoAccount()
+
+class Account(object):
+    """The class representing the memory used by one request or get_all call. Use it as a
+    context manager: memory charged while it is open (see MemoryProfiler.charge) is added to
+    it, and to any account it is inside."""
+
+    def __init__(self, profiler, name, attributes):
+        self.profiler = profiler
+        self.name = name
+        self.attributes = attributes
+
+        # rows read, and bytes of each kind
+        self.rows = 0
+        self.bytes = dict((kind, 0) for kind in KINDS)
+
+        # as measured by tracemalloc (for the outermost account only)
+        self.traced_start = None
+        self.peak_bytes = None
+
+    @property
+    def total(self):
+        """Returns the total bytes charged to this account."""
+        return sum(self.bytes.values())
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        if tracemalloc and not stack:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+        stack.append(self)
+        return self
+
+    def __exit__(self, error_type, error, tb):
+        stack = self.profiler.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if self.traced_start != None:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1] - self.traced_start
+        self.profiler.finish(self)
+        return False
+
+    def to_dict(self):
+        result = {
+            'name': self.name,
+            'attributes': self.attributes,
+            'rows': self.rows,
+            'total_bytes': self.total,
+            'peak_bytes': self.peak_bytes
+        }
+        for kind in KINDS:
+            result[kind + '_bytes'] = self.bytes[kind]
+        return result
+
+class MemoryProfiler(object):
+    """The class representing the memory accounts of each thread, and what to do with them
+    when they are finished."""
+
+    def __init__(self):
+        self.enabled = False
+
+        # most bytes an account can be charged, or None for no limit
+        self.max_bytes = None
+
+        # called with each finished account, if set
+        self.report = None
+
+        # the most recent finished accounts
+        self.reports = deque(maxlen=MAX_REPORTS)
+
+        self.local = threading.local()
+
+    def stack(self):
+        """Returns the list of this thread's open accounts, innermost last."""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def account(self, name, **attributes):
+        """Returns a new account (or NO_ACCOUNT, if profiling is off), to be used with 'with'."""
+        if not self.enabled:
+            return NO_ACCOUNT
+        return Account(self, name, attributes)
+
+    def charge(self, kind, size, rows=0, check=True):
+        """Adds size bytes of the given kind (and the given number of rows) to this thread's open
+        accounts. If check is True and any of them goes over the cap, raises
+        MemoryLimitExceeded."""
+
+        stack = self.stack()
+        for account in stack:
+            account.bytes[kind] += size
+            account.rows += rows
+
+        if not check or self.max_bytes == None or not stack:
+            return
+
+        outermost = stack[0]
+        used = outermost.total
+        if outermost.traced_start != None:
+            used = max(used, tracemalloc.get_traced_memory()[0] - outermost.traced_start)
+        if used > self.max_bytes:
+            raise MemoryLimitExceeded("This %s needs more than %d bytes of memory (%d rows so far); "
+                                      "try asking for fewer rows, or expanding fewer levels."
+                                      % (outermost.name, self.max_bytes, outermost.rows))
+
+    def finish(self, account):
+        self.reports.append(account.to_dict())
+        if self.report:
+            self.report(account.to_dict())
+
+# the profiler used by SPODS
+profiler = MemoryProfiler()
+
+def profile_memory(on=True, max_bytes=None, report=None):
+    """Turns memory profiling on (or off, if on is False).
+
+    max_bytes is the most memory a request (or a get_all call outside of a request) may use
+    before it is stopped with MemoryLimitExceeded, or None for no limit. report is an optional
+    function, called with a dictionary describing each finished request and get_all call. The
+    most recent ones are also kept in spods.profiling.profiler.reports."""
+
+    profiler.enabled = on
+    profiler.max_bytes = max_bytes
+    profiler.report = report
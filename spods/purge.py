@@ -0,0 +1,99 @@
+"""Deletes the expired rows of every table with a ttl served by an API script, and compacts
+the change log of every table whose changes are tracked (see link_table's track_changes).
+
+Usage:
+    python -m spods.purge [options] api_script
+
+api_script is the path to a Python script (or the name of a module) that links its tables at
+the top level, like the demo cgi-bin/api.py scripts. Rows are deleted a batch at a time, with a
+pause between batches, so the API can keep writing to the tables while this runs (e.g. from cron).
+"""
+
+import imp
+import os
+import sys
+import time
+
+from changes import DEFAULT_KEEP
+from table_linker import PURGE_BATCH_SIZE
+
+# seconds to wait between batches, so other writers can get in
+DEFAULT_PAUSE = 0.05
+
+def linked_classes(script):
+    """Given the path to an API script (or the name of a module), loads it and returns the
+    linked classes it defines."""
+
+    path = script
+    if not os.path.isfile(path):
+        module_file, path, description = imp.find_module(script)
+        if module_file:
+            module_file.close()
+
+    module = imp.load_source('_spods_purge', path)
+
+    classes = []
+    for value in vars(module).values():
+        if hasattr(value, 'linkedclass') and value not in classes:
+            classes.append(value)
+    return classes
+
+def purge(classes, batch_size=PURGE_BATCH_SIZE, pause=DEFAULT_PAUSE, verbose=False):
+    """Given a list of linked classes, deletes all of their expired rows, pausing between
+    batches. Returns the total number of rows deleted."""
+
+    total = 0
+    for c in classes:
+        deleted = 0
+        while True:
+            removed = c.purge_expired(batch_size, max_batches=1)
+            deleted += removed
+            if removed < batch_size:
+                break
+            time.sleep(pause)
+
+        if verbose:
+            print "%s: deleted %d expired rows" % (c.table.title, deleted)
+        total += deleted
+
+    return total
+
+def compact(classes, keep=DEFAULT_KEEP, verbose=False):
+    """Given a list of linked classes, forgets all but the latest keep changes of each one
+    whose changes are tracked. Returns the total number of changes forgotten."""
+
+    total = 0
+    for c in classes:
+        if not c.track_changes:
+            continue
+        forgotten = c.compact_changes(keep)
+        if verbose:
+            print "%s: forgot %d old changes" % (c.table.title, forgotten)
+        total += forgotten
+    return total
+
+def main(args):
+    import optparse
+
+    parser = optparse.OptionParser(usage="python -m spods.purge [options] api_script")
+    parser.add_option('--batch-size', type='int', default=PURGE_BATCH_SIZE, help="rows deleted per transaction")
+    parser.add_option('--pause', type='float', default=DEFAULT_PAUSE, help="seconds to wait between batches")
+    parser.add_option('--keep-changes', type='int', default=DEFAULT_KEEP, help="changes kept per tracked table")
+    parser.add_option('--quiet', action='store_true', default=False, help="don't print what was deleted")
+    options, args = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error("please give the API script whose tables to purge")
+
+    classes = linked_classes(args[0])
+    expiring = [c for c in classes if c.table.ttl]
+    tracked = [c for c in classes if c.track_changes]
+    if not expiring and not tracked:
+        print "%s has no tables with a ttl or tracked changes" % args[0]
+        return
+
+    purge(expiring, options.batch_size, options.pause, not options.quiet)
+    compact(tracked, options.keep_changes, not options.quiet)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,327 @@
+"""Pushes changes to tables linked with track_changes=True to the clients that subscribe to
+them, from long-lived servers (see wsgi_app), so browsers don't have to keep polling.
+
+A client subscribes with action=subscribe, naming one or more tables in obj (e.g.
+obj=book,author), the sequence number to start after in since (see action=changes), and
+optionally field=value filters (only changed rows with those values are sent; deletes always
+are). It then gets:
+    * with an 'Accept: text/event-stream' header, a stream of Server-Sent Events, one per
+      change (with the change's seq as its id, so browsers reconnect where they left off)
+    * otherwise, a long-poll: a JSON response (like action=changes) as soon as something
+      changes, or with no changes after the timeout
+
+Subscribers are woken as soon as a tracked table is written to in this process, and by a
+thread watching each database file's PRAGMA data_version for writes from other processes.
+
+Each subscriber keeps one of the server's threads busy until it is answered. So that ordinary
+requests always have threads left, only a few subscribers (see limit_subscribers) are served at
+once; the rest are turned away with '503 Service Unavailable' and a Retry-After header."""
+
+import sqlite3
+import threading
+import time
+
+from registry import get_registry
+
+# seconds between checks of PRAGMA data_version, for writes from other processes
+POLL_INTERVAL = 0.5
+
+# longest a long-poll waits for changes (clients may ask for less, with timeout)
+LONG_POLL_TIMEOUT = 25
+
+# longest an event stream stays open (browsers reconnect after it ends), and how often it
+# sends something to keep the connection alive
+MAX_STREAM_SECONDS = 300
+KEEPALIVE_SECONDS = 15
+
+# most changes read per table at once
+MAX_EVENTS = 100
+
+# milliseconds browsers should wait before reconnecting an event stream
+RETRY_MS = 2000
+
+# most subscribers served at once, per process (keep it below the server's number of threads)
+DEFAULT_MAX_SUBSCRIBERS = 2
+
+# seconds clients turned away for being over the limit are asked to wait
+BUSY_RETRY_SECONDS = 5
+
+def database_file(db):
+    """Given a database connection, returns the path of its main database file, or '' for an
+    in-memory database."""
+
+    for row in db.execute("PRAGMA database_list"):
+        if row[1] == 'main':
+            return row[2] or ''
+    return ''
+
+class Notifier(object):
+    """The class representing every subscriber waiting for a change. notify() wakes them all,
+    and they check whether anything they subscribed to has changed."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+
+        # subscribers being served, and the most allowed at once (or None, for no limit)
+        self.subscribers = 0
+        self.max_subscribers = DEFAULT_MAX_SUBSCRIBERS
+
+        # database file --> the thread watching it
+        self.watchers = {}
+        self.lock = threading.Lock()
+
+    def notify(self):
+        """Wakes every subscriber."""
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Given the generation a subscriber last saw, waits up to timeout seconds for notify()
+        (returning straight away if it has been called since). Returns the current generation."""
+        with self.condition:
+            if self.generation == generation:
+                self.condition.wait(timeout)
+            return self.generation
+
+    def join(self):
+        """Counts a new subscriber in, returning False (and not counting it) if there are
+        already max_subscribers."""
+        with self.condition:
+            if self.max_subscribers != None and self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def leave(self):
+        """Counts a subscriber out."""
+        with self.condition:
+            self.subscribers -= 1
+
+    def watch(self, db):
+        """Given a database connection, makes sure its file is watched for writes from other
+        processes (in-memory databases can only be written to by this process)."""
+
+        path = database_file(db)
+        if not path:
+            return
+        with self.lock:
+            if path not in self.watchers:
+                watcher = self.watchers[path] = DataVersionWatcher(self, path)
+                watcher.start()
+
+class DataVersionWatcher(threading.Thread):
+    """A thread that calls notify() whenever a database file is written to by another
+    connection (in this process or another one)."""
+
+    def __init__(self, notifier, path):
+        threading.Thread.__init__(self, name='spods-watcher')
+        self.daemon = True
+        self.notifier = notifier
+        self.path = path
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        version = None
+        while True:
+            try:
+                current = db.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.Error:
+                # e.g. locked: try again next time
+                current = version
+            if version != None and current != version:
+                self.notifier.notify()
+            version = current
+            time.sleep(POLL_INTERVAL)
+
+# the notifier used by SPODS
+notifier = Notifier()
+
+def limit_subscribers(limit):
+    """Given a number of subscribers, or None for no limit, sets how many subscribers this
+    process serves at once (DEFAULT_MAX_SUBSCRIBERS, by default). Keep it below the number of
+    threads serving requests, or subscribers can leave none for anything else."""
+    notifier.max_subscribers = limit
+
+class Subscribed(object):
+    """A streamed response body, which counts its subscriber out when the server closes it."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.left = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.chunks.close()
+        if not self.left:
+            self.left = True
+            notifier.leave()
+
+class Subscription(object):
+    """The class representing one client's subscription: the classes, filters and sequence
+    number it started from."""
+
+    def __init__(self, classes, filters, since):
+        self.classes = classes
+        self.filters = filters
+        self.since = since
+
+    def matches(self, c, obj):
+        """Given a class and one of its changed objects, returns True if it passes the filters."""
+        for field, value in self.filters.items():
+            if c.table.is_field(field) and unicode(obj.data[field]) != value:
+                return False
+        return True
+
+    def poll(self):
+        """Returns a list of change events (dictionaries) since the last poll, in order, and
+        moves the subscription's sequence number on past them."""
+
+        changes = []
+        horizon = None
+        for c in self.classes:
+            table_changes = c.changes(self.since, MAX_EVENTS)
+            if len(table_changes) == MAX_EVENTS:
+                # there may be more: only go as far as this table's last one for now
+                horizon = table_changes[-1][0] if horizon == None else min(horizon, table_changes[-1][0])
+            changes += [(seq, c, op, pk, obj) for seq, op, pk, obj in table_changes]
+
+        changes.sort(key=lambda change: change[0])
+        if horizon != None:
+            changes = [change for change in changes if change[0] <= horizon]
+
+        events = []
+        for seq, c, op, pk, obj in changes:
+            if obj != None and not self.matches(c, obj):
+                continue
+            events.append({
+                'seq': seq,
+                'table': c.table.title,
+                'op': op,
+                'pk': pk,
+                'obj': c.serialise(obj) if obj != None else None
+            })
+
+        if changes:
+            self.since = changes[-1][0]
+        return events
+
+def is_subscription(environ):
+    """Given a request's WSGI environment, returns True if it asks to subscribe to changes."""
+    query = environ.get('QUERY_STRING', '')
+    if 'subscribe' not in query:
+        return False
+
+    from urlparse import parse_qs
+    return parse_qs(query).get('action', [''])[0].lower() == 'subscribe'
+
+def subscribe(environ, start_response, classes, lock):
+    """Given a subscription request's WSGI environment, its start_response, a list of classes
+    (or an ApiRegistry) and the lock that must be held while using their connections, responds
+    with a long-poll or an event stream (see the top of this module). Returns the WSGI body."""
+
+    from json import dumps
+    from urlparse import parse_qs
+    from serialiser import encode
+
+    params = dict((k, v[0]) for k, v in parse_qs(environ.get('QUERY_STRING', '')).items())
+    registry = get_registry(classes)
+
+    def error(message, status='400 Bad Request', headers=[]):
+        body = dumps({ 'status': 1, 'error': message, 'data': None })
+        start_response(status, [('Content-Type', 'application/JSON'), ('Content-Length', str(len(body)))] + headers)
+        return [body]
+
+    # what to subscribe to
+    subscribed = []
+    for title in params.get('obj', '').split(','):
+        if title not in registry.tables or not registry.tables[title].track_changes:
+            return error("Can't subscribe to %s." % title)
+        subscribed.append(registry.tables[title])
+
+    since = environ.get('HTTP_LAST_EVENT_ID') or params.get('since', '')
+    if not since.isdigit():
+        return error('Invalid sequence number.')
+
+    # only filter by fields of the subscribed tables
+    filters = {}
+    for param, value in params.items():
+        if any(registry.field(c.table.title, param) == (param, False) for c in subscribed):
+            filters[param] = value
+
+    subscription = Subscription(subscribed, filters, int(since))
+
+    # leave threads for everything else
+    if not notifier.join():
+        return error('Too many subscribers; try again later.', '503 Service Unavailable',
+                     [('Retry-After', str(BUSY_RETRY_SECONDS))])
+
+    def poll():
+        with lock:
+            return subscription.poll()
+
+    try:
+        with lock:
+            for c in subscribed:
+                notifier.watch(c.db)
+
+        if 'text/event-stream' in environ.get('HTTP_ACCEPT', ''):
+            start_response('200 OK', [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')])
+
+            # counted out when the server closes the stream
+            return Subscribed(stream_events(subscription, poll))
+
+        # long-poll: wait for something to send
+        timeout = LONG_POLL_TIMEOUT
+        if params.get('timeout', '').isdigit():
+            timeout = min(int(params['timeout']), LONG_POLL_TIMEOUT)
+        deadline = time.time() + timeout
+
+        generation = notifier.generation
+        events = poll()
+        while not events and time.time() < deadline:
+            generation = notifier.wait(generation, deadline - time.time())
+            events = poll()
+    except Exception, e:
+        notifier.leave()
+        return error("%s: %s" % (type(e).__name__, str(e)))
+    notifier.leave()
+
+    body = encode({ 'status': 0, 'error': '', 'seq': subscription.since, 'data': events })
+    start_response('200 OK', [('Content-Type', 'application/JSON'), ('Content-Length', str(len(body)))])
+    return [body]
+
+def stream_events(subscription, poll):
+    """Given a subscription and a function that polls it, returns a generator of Server-Sent
+    Events for its changes, until MAX_STREAM_SECONDS have passed."""
+
+    from json import dumps
+    from serialiser import encode
+
+    yield "retry: %d\n\n" % RETRY_MS
+
+    deadline = time.time() + MAX_STREAM_SECONDS
+    last_sent = time.time()
+    generation = notifier.generation
+    while time.time() < deadline:
+        try:
+            events = poll()
+        except Exception, e:
+            yield "event: error\ndata: %s\n\n" % dumps("%s: %s" % (type(e).__name__, str(e)))
+            return
+
+        if events:
+            yield ''.join("id: %d\nevent: change\ndata: %s\n\n" % (event['seq'], encode(event)) for event in events)
+            last_sent = time.time()
+
+            # there may be more to send straight away
+            continue
+
+        if time.time() - last_sent >= KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+
+        generation = notifier.wait(generation, max(0, min(KEEPALIVE_SECONDS, deadline - time.time())))
@@ -0,0 +1,93 @@
+"""The classes and functions served by the JSON API, indexed once so each request can be
+routed with dictionary lookups rather than by searching through them all."""
+
+# registries made by get_registry, by the tuple of classes and functions they serve
+registries = {}
+
+class ApiRegistry(object):
+    """The class representing the linked classes and custom functions served by the JSON API.
+
+    It remembers each table's fields, and looks at them again if relations are added later
+    (with has_one)."""
+
+    def __init__(self, classes):
+        # as given, for custom functions (their _classes parameter)
+        self.classes = list(classes)
+
+        # obj parameter --> custom function or linked class (the first given wins)
+        self.routes = {}
+
+        # table name --> linked class
+        self.tables = {}
+
+        # table name --> { field name --> Field }, and how many fields the table had when it was mapped
+        self.fields = {}
+        self.field_counts = {}
+
+        # linked classes with session storage, with expiring rows, and with tracked changes
+        self.session_classes = []
+        self.ttl_classes = []
+        self.change_classes = []
+
+        # distinct database connections, in the order their classes were given
+        self.databases = []
+
+        for c in self.classes:
+            if hasattr(c, 'linkedclass'):
+                title = c.table.title
+                self.routes.setdefault(title, c)
+                self.tables.setdefault(title, c)
+                self.fields[title] = c.table.field_map()
+                self.field_counts[title] = len(c.table.fields)
+
+                if c.session_field:
+                    self.session_classes.append(c)
+                if c.table.ttl:
+                    self.ttl_classes.append(c)
+                if c.track_changes:
+                    self.change_classes.append(c)
+                # (sharded classes have one per shard)
+                for db in getattr(c, 'databases', [c.db]):
+                    if not any(db is known for known in self.databases):
+                        self.databases.append(db)
+            else:
+                self.routes.setdefault(c.__name__, c)
+
+    def route(self, obj):
+        """Given the obj parameter of a request, returns the matching linked class or custom
+        function, or None."""
+        return self.routes.get(obj)
+
+    def field(self, title, param):
+        """Given a table name and a request parameter, returns a (field name, is search) tuple
+        if the parameter names one of the table's fields (e.g. 'title', or 'title*' to search
+        by it), or None."""
+
+        fields = self.fields[title]
+        table = self.tables[title].table
+        if len(table.fields) != self.field_counts[title]:
+            # a relation was added since
+            fields = self.fields[title] = table.field_map()
+            self.field_counts[title] = len(table.fields)
+
+        if param in fields:
+            return param, False
+        if param.strip('*') in fields:
+            return param.strip('*'), True
+        return None
+
+def get_registry(classes):
+    """Given an ApiRegistry, or a list of classes and functions, returns the matching
+    ApiRegistry, only building each one once."""
+
+    if isinstance(classes, ApiRegistry):
+        return classes
+
+    # e.g. serve_api(registry)
+    if len(classes) == 1 and isinstance(classes[0], ApiRegistry):
+        return classes[0]
+
+    key = tuple(classes)
+    if key not in registries:
+        registries[key] = ApiRegistry(key)
+    return registries[key]
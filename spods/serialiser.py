@@ -0,0 +1,62 @@
+"""Turns rows straight into JSON, without building a dictionary for each one first."""
+
+from base import blank_fn
+from profiling import profiler, value_size
+
+class RawJSON(str):
+    """A string of JSON that has already been encoded, which encode() includes as it is."""
+
+def compile_serialiser(fields):
+    """Given a table's list of fields, returns a function that takes a row of their values (in
+    the same order) and returns the row as a RawJSON object.
+
+    Out masks are only applied for the fields that have one (and their output is charged to
+    the memory profiler, if it's on)."""
+
+    # json is only imported when a table is first serialised
+    from json import dumps
+    from json.encoder import encode_basestring_ascii
+
+    def encode_value(value):
+        value_type = type(value)
+        if value is None:
+            return 'null'
+        if value_type is unicode or value_type is str:
+            return encode_basestring_ascii(value)
+        if value_type is int or value_type is long:
+            return str(value)
+        return dumps(value)
+
+    template = "{%s}" % ", ".join("%s: %%s" % dumps(f.title) for f in fields)
+    masks = [(i, f.out_mask) for i, f in enumerate(fields) if f.out_mask is not blank_fn]
+
+    def serialise(row):
+        if masks:
+            row = list(row)
+            for i, mask in masks:
+                row[i] = mask(row[i])
+            if profiler.enabled:
+                profiler.charge('masks', sum(value_size(row[i]) for i, mask in masks))
+        return RawJSON(template % tuple([encode_value(value) for value in row]))
+
+    return serialise
+
+def encode(obj):
+    """Given a Python object, which may contain RawJSON objects in its lists and dictionaries
+    (such as a result from handle_request), returns its JSON."""
+
+    if isinstance(obj, RawJSON):
+        return obj
+
+    from json import dumps
+
+    def encode_part(obj):
+        if isinstance(obj, RawJSON):
+            return obj
+        if isinstance(obj, (list, tuple)):
+            return "[%s]" % ", ".join([encode_part(x) for x in obj])
+        if isinstance(obj, dict):
+            return "{%s}" % ", ".join(["%s: %s" % (dumps(unicode(k)), encode_part(v)) for k, v in obj.items()])
+        return dumps(obj)
+
+    return encode_part(obj)
@@ -0,0 +1,365 @@
+"""A built-in HTTP/1.1 server for the JSON API.
+
+Usage:
+    python -m spods.serve [options] api_script
+
+api_script is the path to a Python script (or the name of a module) that defines a WSGI
+application called `application`, e.g.:
+
+    application = spods.wsgi_app(Book, Author, credit_checksum)
+
+Connections are accepted by a single thread, and queued for a fixed pool of worker threads.
+Each worker loads its own copy of the API script, so each has its own linked classes and
+database connections, and serves one connection at a time (including keep-alive requests).
+
+If the queue is full, new connections are turned away with '503 Service Unavailable' rather
+than piling up. Subscriptions to changes (see spods.push) each keep a worker busy, so only
+--subscribers of them (half the workers, by default) are served at once. On SIGINT or
+SIGTERM, the server stops accepting connections, finishes the ones it has, and exits.
+"""
+
+import BaseHTTPServer
+import Queue
+import imp
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+import urllib
+from StringIO import StringIO
+
+from push import limit_subscribers
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_WORKERS = 4
+
+# number of accepted connections that can wait for a worker
+DEFAULT_QUEUE_SIZE = 64
+
+# seconds to wait for a request (or the next keep-alive request) before giving up
+DEFAULT_TIMEOUT = 10
+
+# seconds to wait for workers to finish when shutting down
+DEFAULT_GRACE = 10
+
+# largest request body accepted, in bytes
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+BUSY_RESPONSE = ("HTTP/1.1 503 Service Unavailable\r\n"
+                 "Content-Type: text/plain\r\n"
+                 "Content-Length: 12\r\n"
+                 "Retry-After: 1\r\n"
+                 "Connection: close\r\n\r\n"
+                 "Server busy\n")
+
+def load_application(script, name):
+    """Given the path to an API script (or the name of a module), loads a fresh copy of it
+    under the given module name, and returns its WSGI application."""
+
+    path = script
+    if not os.path.isfile(path):
+        module_file, path, description = imp.find_module(script)
+        if module_file:
+            module_file.close()
+
+    module = imp.load_source(name, path)
+    if not hasattr(module, 'application'):
+        raise AttributeError("%s does not define an application (e.g. application = spods.wsgi_app(...))" % script)
+    return module.application
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the requests on a single connection, by calling a worker's WSGI application."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # buffer the headers and body, so small responses go out in a single packet
+    wbufsize = -1
+
+    def setup(self):
+        self.timeout = self.server.timeout
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        self.run_wsgi()
+
+    def do_POST(self):
+        self.run_wsgi()
+
+    def do_HEAD(self):
+        self.run_wsgi()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def wsgi_environ(self, body):
+        """Returns the WSGI environment for the current request."""
+
+        path, _, query = self.path.partition('?')
+
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.getheader('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+
+        for header in self.headers:
+            key = 'HTTP_' + header.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = ','.join(self.headers.getheaders(header))
+
+        return environ
+
+    def run_wsgi(self):
+        # read the whole body, so nothing is left over for the next keep-alive request
+        length = self.headers.getheader('content-length')
+        if length and (not length.isdigit() or int(length) > MAX_BODY_SIZE):
+            self.send_error(413)
+            self.close_connection = 1
+            return
+        body = self.rfile.read(int(length)) if length else ''
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return self.wfile.write
+
+        try:
+            chunks = self.server.application(self.wsgi_environ(body), start_response)
+        except Exception:
+            self.log_error("Error running application: %s", sys.exc_info()[1])
+            self.send_error(500)
+            self.close_connection = 1
+            return
+
+        try:
+            self.write_response(response['status'], response['headers'], chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def write_response(self, status, headers, chunks):
+        """Writes the status line, headers and body, chunking the body if the application
+        didn't give a Content-Length."""
+
+        code, _, message = status.partition(' ')
+        self.send_response(int(code), message)
+
+        has_length = False
+        for header, value in headers:
+            if header.lower() == 'content-length':
+                has_length = True
+            self.send_header(header, value)
+
+        # HTTP/1.0 clients don't understand chunking: close the connection to end the body instead
+        chunked = not has_length and self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        if not has_length and not chunked:
+            self.close_connection = 1
+
+        # don't keep connections alive while shutting down
+        if self.server.stopping.is_set():
+            self.close_connection = 1
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        if self.command == 'HEAD':
+            return
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if chunked:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+            self.wfile.flush()
+
+        if chunked:
+            self.wfile.write("0\r\n\r\n")
+
+class Worker(threading.Thread):
+    """A thread that serves queued connections with its own copy of the API script."""
+
+    def __init__(self, server, number):
+        threading.Thread.__init__(self, name='spods-worker-%d' % number)
+        self.daemon = True
+
+        self.number = number
+        self.connections = server.connections
+        self.stopping = server.stopping
+        self.script = server.script
+        self.server_name = server.server_name
+        self.server_port = server.server_port
+        self.timeout = server.timeout
+        self.verbose = server.verbose
+
+        self.application = None
+        self.error = None
+        self.loaded = threading.Event()
+
+    def run(self):
+        # load the script in this thread, so its database connections belong to it
+        try:
+            self.application = load_application(self.script, '_spods_worker_%d' % self.number)
+        except Exception, e:
+            self.error = e
+            return
+        finally:
+            self.loaded.set()
+
+        while True:
+            item = self.connections.get()
+            if item is None:
+                # asked to stop
+                return
+
+            connection, address = item
+            try:
+                RequestHandler(connection, address, self)
+            except socket.error:
+                # client went away, or timed out
+                pass
+            except Exception:
+                # a bug handling this connection shouldn't take the worker down with it
+                sys.stderr.write("Error serving %s:\n%s" % (address[0], traceback.format_exc()))
+            finally:
+                try:
+                    connection.close()
+                except socket.error:
+                    pass
+
+class Server(object):
+    """The class representing the listening socket, the connection queue and the worker pool."""
+
+    def __init__(self, script, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_TIMEOUT, verbose=False, subscribers=None):
+        self.script = os.path.abspath(script) if os.path.isfile(script) else script
+        self.timeout = timeout
+        self.verbose = verbose
+
+        self.connections = Queue.Queue(queue_size)
+        self.stopping = threading.Event()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(queue_size)
+
+        self.server_name = socket.getfqdn(host)
+        self.server_port = self.socket.getsockname()[1]
+
+        self.workers = [Worker(self, i) for i in range(workers)]
+
+        # the workers share one process: keep some of them free of subscribers
+        if subscribers == None:
+            subscribers = workers // 2
+        limit_subscribers(min(subscribers, workers - 1))
+
+    def start(self):
+        """Starts the workers, and waits for them to load the API script."""
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            worker.loaded.wait()
+            if worker.error:
+                self.stop()
+                raise worker.error
+
+    def serve_forever(self):
+        """Accepts connections until stop() is called."""
+
+        # wake up regularly to check whether we're stopping
+        self.socket.settimeout(0.5)
+
+        while not self.stopping.is_set():
+            try:
+                connection, address = self.socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                # interrupted by a signal
+                continue
+
+            connection.settimeout(None)
+            try:
+                self.connections.put_nowait((connection, address))
+            except Queue.Full:
+                # too busy: turn the client away straight away
+                try:
+                    connection.sendall(BUSY_RESPONSE)
+                except socket.error:
+                    pass
+                connection.close()
+
+    def stop(self):
+        """Stops accepting connections."""
+        self.stopping.set()
+
+    def shutdown(self, grace=DEFAULT_GRACE):
+        """Closes the listening socket, lets the workers finish any queued connections, and
+        waits up to grace seconds for them to exit."""
+
+        self.stop()
+        self.socket.close()
+
+        for worker in self.workers:
+            self.connections.put(None)
+        for worker in self.workers:
+            worker.join(grace)
+
+def main(args):
+    import optparse
+
+    parser = optparse.OptionParser(usage="python -m spods.serve [options] api_script")
+    parser.add_option('--host', default=DEFAULT_HOST, help="address to listen on")
+    parser.add_option('--port', type='int', default=DEFAULT_PORT, help="port to listen on")
+    parser.add_option('--workers', type='int', default=DEFAULT_WORKERS, help="number of worker threads")
+    parser.add_option('--queue', type='int', default=DEFAULT_QUEUE_SIZE, help="connections that can wait for a worker")
+    parser.add_option('--timeout', type='float', default=DEFAULT_TIMEOUT, help="seconds to wait for a request")
+    parser.add_option('--subscribers', type='int', default=None, help="subscriptions served at once (default: half the workers)")
+    parser.add_option('--grace', type='float', default=DEFAULT_GRACE, help="seconds to wait for workers on shutdown")
+    parser.add_option('--verbose', action='store_true', default=False, help="log every request")
+    options, args = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error("please give the API script to serve")
+
+    server = Server(args[0], options.host, options.port, options.workers, options.queue, options.timeout, options.verbose,
+                    options.subscribers)
+    server.start()
+
+    def stop(signum, frame):
+        server.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    print "Serving %s on http://%s:%d/ with %d workers" % (args[0], options.host, server.server_port, options.workers)
+    sys.stdout.flush()
+
+    server.serve_forever()
+    server.shutdown(options.grace)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,148 @@
+"""Signed session cookies, so sessions can be checked without going to the DB.
+
+When a class is linked with a session_secret, the user's cookie holds the session object's
+primary key and an expiry time, signed with an HMAC. A valid cookie is trusted as is, and the
+session row is only read (or, for a new visitor, created) when the request actually uses it.
+"""
+
+import hashlib
+import hmac
+import time
+
+# seconds a signed session lasts, unless link_table is given a session_ttl
+DEFAULT_SESSION_TTL = 30 * 24 * 60 * 60
+
+def session_cookie_name(cls):
+    """Given a linked class with session storage, returns the name of its cookie."""
+    return cls.table.title + '_' + cls.session_field
+
+def token_signature(cls, payload):
+    """Given a linked class and a token payload, returns the payload's signature."""
+    return hmac.new(cls.session_secret, "%s:%s" % (cls.table.title, payload), hashlib.sha256).hexdigest()
+
+def make_token(cls, pk, expires):
+    """Given a linked class, a primary key and an expiry time, returns a signed token."""
+    payload = "%s.%d" % (pk, expires)
+    return "%s.%s" % (payload, token_signature(cls, payload))
+
+def read_token(cls, token, now):
+    """Given a linked class, a token from a cookie and the current time, returns a
+    (primary key, expiry time) tuple, or None if the token is invalid or has expired."""
+
+    parts = token.rsplit('.', 2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        return None
+
+    pk, expires, signature = parts
+    if not hmac.compare_digest(signature, token_signature(cls, pk + '.' + expires)):
+        return None
+    if int(expires) <= now:
+        return None
+
+    if cls.table.pk.python_type == int:
+        pk = int(pk)
+    return pk, int(expires)
+
+def set_session_cookie(cookie, cls, pk, now):
+    """Saves a new signed token for the given primary key into the user's cookie."""
+
+    name = session_cookie_name(cls)
+    cookie[name] = make_token(cls, pk, now + cls.session_ttl)
+    cookie[name]['max-age'] = cls.session_ttl
+    cookie[name]['httponly'] = True
+
+def load_signed_session(cls, cookie):
+    """Given a linked class with a session_secret and the user's cookie, returns a
+    SessionProxy for the user's session, or None if they don't have one (and one isn't forced).
+
+    Tokens past half of their lifetime are renewed."""
+
+    now = int(time.time())
+    token = cookie.get(session_cookie_name(cls))
+    found = read_token(cls, token.value, now) if token else None
+
+    if found:
+        pk, expires = found
+        if expires - now < cls.session_ttl / 2:
+            set_session_cookie(cookie, cls, pk, now)
+        return SessionProxy(cls, cookie, pk)
+
+    if cls.force_session:
+        # don't make the row until it's needed
+        return SessionProxy(cls, cookie)
+
+    return None
+
+class SessionProxy(object):
+    """The class standing in for a session object from a signed cookie.
+
+    The primary key is known straight away; anything else reads the object from the DB (or,
+    for a new session, creates it and saves its token to the cookie) the first time it is used."""
+
+    def __init__(self, cls, cookie, pk=None):
+        self.__dict__['cls'] = cls
+        self.__dict__['cookie'] = cookie
+        self.__dict__['pk'] = pk
+        self.__dict__['obj'] = None
+
+        # so this can be assigned to relations without loading it
+        self.__dict__['table'] = cls.table
+
+    def get_object(self):
+        """Returns the session object, reading or creating it if needed."""
+
+        if self.obj is None:
+            cls = self.cls
+            if self.pk is not None:
+                self.__dict__['obj'] = cls.get_one(**{ cls.table.pk.title: self.pk })
+
+            if self.obj is None:
+                if not cls.force_session:
+                    raise Exception("Your session has expired.")
+
+                # new (or deleted) session
+                self.__dict__['obj'] = cls()
+                self.__dict__['pk'] = self.obj[cls.table.pk.title]
+                set_session_cookie(self.cookie, cls, self.pk, int(time.time()))
+
+        return self.obj
+
+    def __getattr__(self, key):
+        return getattr(self.get_object(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self.get_object(), key, value)
+
+    def __getitem__(self, key):
+        if key == self.table.pk.title and self.pk is not None:
+            return self.pk
+        return self.get_object()[key]
+
+    def __setitem__(self, key, value):
+        self.get_object()[key] = value
+
+    def __delitem__(self, key):
+        del self.get_object()[key]
+
+    def __contains__(self, key):
+        return key in self.get_object()
+
+    def __iter__(self):
+        return iter(self.get_object())
+
+    def __len__(self):
+        return len(self.get_object())
+
+    def __nonzero__(self):
+        return True
+
+    def __eq__(self, other):
+        if isinstance(other, SessionProxy):
+            other = other.get_object()
+        return self.get_object() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.get_object())
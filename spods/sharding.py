@@ -0,0 +1,378 @@
+"""Spreads a table's rows over several SQLite files (shards), so writes to different shards
+don't wait for each other, and no one file has to hold the whole table.
+
+Link the table with a ShardSpec instead of a database connection:
+
+    >>> Book = link_table(book_table, ShardSpec([sqlite3.connect('books-%d.db' % i) for i in range(4)]))
+
+Every row's id says which shard it is in (shard i of n holds ids i + 1, i + 1 + n, ...), so ids
+are unique across the shards, and objects are found by id without looking in every shard.
+Other queries ask every shard (or, if they give a value of the spec's field, just the shard
+holding rows with that value), and what comes back is merged in order.
+
+Start with empty files: rows already in them won't be where their ids say they are."""
+
+import random
+from heapq import merge
+from itertools import islice
+from zlib import crc32
+
+from profiling import profiler
+
+def hash_key(value):
+    """Given a value, returns a number made from it, which is the same in every process (and
+    the same for a number as for the same number as text, e.g. from the JSON API)."""
+    return crc32(unicode(value).encode('utf-8')) & 0xffffffff
+
+class ShardSpec(object):
+    """The class representing how a table is split into shards: a list of database connections
+    (one per shard, in the same order every time), and how to pick the shard for a new row.
+
+    If field is given, each new row goes in the shard picked by key (a function, given the
+    field's value, that returns a number; a stable hash, by default). Queries giving the field's
+    value then only go to that shard. The field must be set when the row is made (or have a
+    default), and never changed. Otherwise, new rows are spread over the shards at random."""
+
+    def __init__(self, dbs, field=None, key=hash_key):
+        if not dbs:
+            raise Exception("A sharded table needs at least one shard.")
+        self.dbs = list(dbs)
+        self.field = field
+        self.key = key
+
+    def shard_of_pk(self, pk):
+        """Given a primary key, returns the number of the shard holding it, or None if it
+        isn't a valid id."""
+        try:
+            pk = int(pk)
+        except (TypeError, ValueError):
+            return None
+        if pk < 1:
+            return None
+        return (pk - 1) % len(self.dbs)
+
+    def shard_of_value(self, value):
+        """Given a value of the spec's field, returns the number of the shard it belongs in."""
+        return self.key(value) % len(self.dbs)
+
+class Descending(object):
+    """Wraps a value so it sorts the other way round, for merging descending results."""
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+def merge_ordered(results, field, reverse=False):
+    """Given a list of iterables of objects, each already ordered by the given field, returns a
+    generator of all of their objects, in that order."""
+
+    def decorated(i, objs):
+        # (the shard and position break ties, so objects are never compared)
+        for n, obj in enumerate(objs):
+            value = obj.data[field]
+            yield (Descending(value) if reverse else value, i, n, obj)
+
+    for value, i, n, obj in merge(*[decorated(i, objs) for i, objs in enumerate(results)]):
+        yield obj
+
+def link_sharded(table, spec, **options):
+    """Given a table object, a ShardSpec and the options for link_table, links the table to
+    each of the spec's shards, and returns a class like a linked class that routes each call
+    to the right shards (see the top of this module)."""
+
+    from table_linker import link_table, transaction
+
+    if table.pk.python_type != int:
+        raise Exception("Sharded tables need an integer primary key.")
+    if options.get('track_changes'):
+        raise Exception("Changes to sharded tables can't be tracked.")
+
+    n = len(spec.dbs)
+    shards = [link_table(table, db, shard=(i, n), **options) for i, db in enumerate(spec.dbs)]
+    pk = table.pk.title
+
+    def shards_for(kw):
+        """Given a dictionary of criteria, returns the classes of the shards that can hold
+        matching rows."""
+
+        if kw.get(pk) != None:
+            i = spec.shard_of_pk(kw[pk])
+            return [shards[i]] if i != None else []
+        if spec.field and kw.get(spec.field) != None:
+            return [shards[spec.shard_of_value(kw[spec.field])]]
+        return shards
+
+    def new_shard(kw):
+        """Given the values of a new object, returns the class of the shard it belongs in,
+        filling in the spec's field with its default if it wasn't given."""
+
+        if not spec.field:
+            return random.choice(shards)
+
+        if kw.get(spec.field) == None:
+            default = table.get_field(spec.field).default
+            kw[spec.field] = default() if hasattr(default, '__call__') else default
+        return shards[spec.shard_of_value(kw[spec.field])]
+
+    def change_limited(kw, change):
+        """Given criteria with a _limit (and maybe a _start) and a function that changes one row
+        of a shard, given the shard's class and the row's primary key, changes just the rows
+        get_all would return (not _limit of every shard's), in one transaction per shard.
+        Returns the changed rows."""
+
+        wanted = {}
+        for obj in ShardedClass.iter_all(**kw):
+            wanted.setdefault(spec.shard_of_pk(obj.data[pk]), []).append(obj.data[pk])
+
+        rows = []
+        for i, keys in sorted(wanted.items()):
+            with transaction(shards[i].db):
+                for key in keys:
+                    rows += change(shards[i], key)
+        return rows
+
+    class ShardedClass(object):
+        """The class representing a table split over several shards. Making an object, or
+        finding one by its primary key, returns an object of the class of the shard it is
+        in."""
+
+        locals()['table'] = table
+        locals()['session_field'] = options.get('session_field')
+        locals()['force_session'] = options.get('force_session', False)
+        locals()['session_secret'] = options.get('session_secret')
+        locals()['session_ttl'] = shards[0].session_ttl
+        locals()['versioned'] = options.get('versioned', False)
+        locals()['track_changes'] = False
+        locals()['hot'] = options.get('hot', False)
+
+        # the first shard's connection, and all of them (see ApiRegistry.databases)
+        locals()['db'] = spec.dbs[0]
+        locals()['databases'] = spec.dbs
+
+        # the class linked to each shard, and how they were split
+        locals()['shards'] = shards
+        locals()['spec'] = spec
+
+        locals()['linkedclass'] = True
+
+        # the shards all have the same fields
+        locals()['serialiser'] = staticmethod(shards[0].serialiser)
+        locals()['serialise'] = staticmethod(shards[0].serialise)
+        locals()['fk_field'] = staticmethod(shards[0].fk_field)
+
+        def __new__(cls, **kw):
+            if pk in kw:
+                found = shards_for(kw)
+                if not found:
+                    raise Exception("No record found with ID '%s'." % kw[pk])
+                return found[0](**kw)
+            return new_shard(kw)(**kw)
+
+        @staticmethod
+        def link():
+            for c in shards:
+                c.link()
+
+        @staticmethod
+        def get_one(**kw):
+            """Returns a single object that matches the given criteria, or None (see
+            get_all)."""
+
+            kw['_start'] = 0
+            kw['_limit'] = 1
+
+            objs = ShardedClass.get_all(**kw)
+            if objs:
+                return objs[0]
+            return None
+
+        @staticmethod
+        def get_all(**kw):
+            """Returns a list of objects from the shards that match the given criteria (as for
+            a linked class). Without an _order, they are ordered by primary key."""
+            with profiler.account('get_all', table=table.title):
+                return list(ShardedClass.iter_all(**kw))
+
+        @staticmethod
+        def iter_all(**kw):
+            """Like get_all(), but returns a generator. Each shard is asked for the first
+            _start + _limit matching rows, in order, and they are merged."""
+
+            found = shards_for(kw)
+            if len(found) == 1:
+                return found[0].iter_all(**kw)
+
+            shard_kw = dict(kw)
+            shard_kw.setdefault('_order', pk)
+            start, stop = 0, None
+            if '_limit' in kw:
+                start = int(kw.get('_start', 0))
+                stop = start + int(kw['_limit'])
+                shard_kw['_start'], shard_kw['_limit'] = 0, stop
+            else:
+                # as for a linked class, _start means nothing without _limit
+                shard_kw.pop('_start', None)
+
+            results = [c.iter_all(**shard_kw) for c in found]
+            return islice(merge_ordered(results, shard_kw['_order'], shard_kw.get('_reverse')), start, stop)
+
+        @staticmethod
+        def iter_serialised(**kw):
+            """Like iter_all(), but yields each row as a RawJSON object (see spods.serialiser)."""
+
+            found = shards_for(kw)
+            if len(found) == 1:
+                return found[0].iter_serialised(**kw)
+            return (ShardedClass.serialise(obj) for obj in ShardedClass.iter_all(**kw))
+
+        @staticmethod
+        def count_all(**kw):
+            """Returns the number of objects in the shards matching the given criteria."""
+            return sum(c.count_all(**kw) for c in shards_for(kw))
+
+        @staticmethod
+        def update_all(values, **kw):
+            """Sets the given fields of every matching object (see a linked class's
+            update_all), in one transaction per shard. Returns the updated rows."""
+
+            found = shards_for(kw)
+            if len(found) > 1 and '_limit' in kw:
+                return change_limited(kw, lambda c, key: c.update_all(values, **{pk: key}))
+
+            rows = []
+            for c in found:
+                rows += c.update_all(values, **kw)
+            return rows
+
+        @staticmethod
+        def delete_all(**kw):
+            """Deletes every matching object, in one transaction per shard. Returns the deleted
+            rows."""
+
+            found = shards_for(kw)
+            if len(found) > 1 and '_limit' in kw:
+                return change_limited(kw, lambda c, key: c.delete_all(**{pk: key}))
+
+            rows = []
+            for c in found:
+                rows += c.delete_all(**kw)
+            return rows
+
+        @staticmethod
+        def get_many(pks):
+            """Given a list of primary key values, returns a dictionary of primary key --> object
+            for each one found, with one query per shard holding any of them."""
+
+            wanted = {}
+            for key in pks:
+                i = spec.shard_of_pk(key)
+                if i != None:
+                    wanted.setdefault(i, []).append(key)
+
+            objs = {}
+            for i, keys in wanted.items():
+                objs.update(shards[i].get_many(keys))
+            return objs
+
+        @staticmethod
+        def from_row(row):
+            """Given a row read from this table, returns the matching object (of its shard's
+            class)."""
+            return shards[spec.shard_of_pk(row[pk])].from_row(row)
+
+        @staticmethod
+        def parallel_map(fn, workers=None, chunk=None, write=False, progress=None, **kw):
+            """Runs a linked class's parallel_map() on each shard in turn. Results are merged
+            in primary key order, and progress counts the rows of every shard."""
+
+            found = shards_for(kw)
+            options = {'workers': workers, 'write': write}
+            if chunk:
+                options['chunk'] = chunk
+            if progress:
+                total = sum(c.count_all(**kw) for c in found)
+                done = [0]
+
+                def shard_progress(rows, shard_total):
+                    progress(done[0] + rows, total)
+
+                options['progress'] = shard_progress
+
+            results = []
+            for c in found:
+                results.append(c.parallel_map(fn, **dict(options, **kw)))
+                if progress:
+                    done[0] += c.count_all(**kw)
+
+            if write:
+                return sum(results)
+            return list(merge(*results))
+
+        @staticmethod
+        def flush():
+            """Writes the journalled changes to every shard of a hot table into its database
+            file straight away (see a linked class's flush). Returns the number written."""
+            return sum(c.flush() for c in shards)
+
+        @staticmethod
+        def purge_expired(batch_size=None, max_batches=None):
+            """Deletes expired rows from every shard (see a linked class's purge_expired).
+            Returns the number of rows deleted."""
+
+            options = {'max_batches': max_batches}
+            if batch_size:
+                options['batch_size'] = batch_size
+            return sum(c.purge_expired(**options) for c in shards)
+
+        @staticmethod
+        def version():
+            """Returns the table's current version, made from each shard's, or None if the
+            table wasn't linked with versioned=True."""
+
+            if not ShardedClass.versioned:
+                return None
+            return ".".join(str(c.version()) for c in shards)
+
+        @staticmethod
+        def changes(since=0, limit=None):
+            raise Exception("Changes to %s aren't tracked." % table.title)
+
+        @staticmethod
+        def latest_change():
+            return None
+
+        @staticmethod
+        def compact_changes(keep=None):
+            return 0
+
+        @staticmethod
+        def has_one(class_var, new_field_name=None, clear_existing=False):
+            """Creates ownership of this class over another class, in every shard (see a linked
+            class's has_one)."""
+
+            from table_linker import relation_field
+
+            new_field = relation_field(table, class_var, new_field_name)
+            ShardedClass.add_column(new_field, clear_existing)
+
+            # the shards share the table object, so it only gets the field once
+            table.fields.append(new_field)
+
+        @staticmethod
+        def add_column(new_field, clear_existing=False):
+            """Adds a column for the given field to every shard (see a linked class's
+            add_column)."""
+            for c in shards:
+                c.add_column(new_field, clear_existing)
+
+    return ShardedClass
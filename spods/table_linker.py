@@ -1,14 +1,95 @@
 # use SQLite for now
 import sqlite3
+import threading
 
 from UserDict import IterableUserDict
-
-from base import Field, Table
+from contextlib import contextmanager
+from itertools import count
+from time import time
+
+from base import Field, Table, now
+from changes import DEFAULT_KEEP, changes_since, compact_changes, install_change_triggers, latest_change
+from hot import FLUSH_INTERVAL, hot_store, lock as hot_lock
+from metrics import metrics
+from migrate import drop_column
+from profiling import object_size, profiler, row_size
+from push import notifier
+from serialiser import compile_serialiser
+from sharding import ShardSpec, link_sharded
+from session import DEFAULT_SESSION_TTL
+from tracing import tracer
+from versioning import install_version_triggers, table_version
 
 # TODO: this is duplicately defined in base. Put them both in a common include
 is_function = lambda f: hasattr(f, '__call__')
 
-def link_table(table, db, clear_existing=False, session_field=None, force_session=False):
+# used to give each savepoint a unique name
+savepoint_ids = count()
+
+# most values bound in a single IN (...) query (SQLite allows at most 999 by default)
+MAX_QUERY_ARGS = 500
+
+# number of expired rows deleted per transaction (see purge_expired)
+PURGE_BATCH_SIZE = 100
+
+# UPDATE/DELETE ... RETURNING needs SQLite 3.35 or later
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# most row counts remembered per versioned table (see count_all)
+MAX_CACHED_COUNTS = 100
+
+def analysed_rows(db, title):
+    """Given a database connection and a table name, returns the number of rows in the table
+    when ANALYZE was last run, or None if it hasn't been."""
+
+    c = db.cursor()
+    try:
+        c.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ?", (title, ))
+        stats = [row[0] for row in c]
+    except sqlite3.OperationalError:
+        # never analysed
+        stats = []
+    c.close()
+
+    # each stat starts with the number of rows (in the table, or in one of its indexes)
+    counts = [int(stat.split()[0]) for stat in stats if stat and stat.split()[0].isdigit()]
+    if not counts:
+        return None
+    return max(counts)
+
+@contextmanager
+def transaction(db):
+    """Runs the body of a with statement in a transaction on the given connection: the
+    changes are committed if it finishes, or rolled back if it raises an exception.
+
+    Transactions can be nested; only the outermost one commits."""
+
+    name = "spods_%d" % next(savepoint_ids)
+    db.execute("SAVEPOINT %s" % name)
+    try:
+        yield db
+    except:
+        db.execute("ROLLBACK TO %s" % name)
+        db.execute("RELEASE %s" % name)
+        raise
+    db.execute("RELEASE %s" % name)
+
+def relation_field(table, class_var, new_field_name=None):
+    """Given a table, the linked class it will have one of, and the name of the field holding
+    the relation (or None, for e.g. 'author_id'), returns the new field."""
+
+    # set default new field name to 'table_id'
+    if new_field_name == None:
+        new_field_name = class_var.table.title + "_"
+
+        # get PK of this table (e.g. ID) and add it to new field name
+        new_field_name += table.pk.title
+
+    return Field(new_field_name, int, fk=class_var)
+
+def link_table(table, db, clear_existing=False, session_field=None, force_session=False, lazy=True, versioned=False,
+               session_secret=None, session_ttl=DEFAULT_SESSION_TTL, track_changes=False, shard=None,
+               hot=False):
     """Given a table object and a database connection, returns a class that
     represents rows within that table, linked to the database.
     
@@ -16,6 +97,26 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
 
     If clear_existing is True, deletes the table (if it exists) before linking it.
 
+    If lazy is True, the table isn't touched in the database (created, cleared, or given
+    new relation columns) until the class is first used. Call link() on the class to do this
+    straight away.
+
+    If versioned is True, the table keeps a version number, which changes every time the
+    table is written to (see version()). The JSON API uses it to cache responses.
+
+    If track_changes is True, every insert, update and delete on the table is logged, so
+    clients can ask for just the rows changed since they last looked (see changes()).
+
+    If db is a ShardSpec instead of a connection, the table is split over several database
+    files, and the class returned routes each call to the right ones (see spods.sharding).
+    shard is used for each of them: a (shard number, number of shards) tuple, so the ids of
+    new rows are interleaved with the other shards'.
+
+    If hot is True (or a number of seconds), the table is kept in memory, so reading it never
+    goes to the disk, and writes are journalled and copied into the database file every second
+    (or that many seconds), or sooner after many writes (see spods.hot and flush()). Keep hot
+    tables small, and only link them in one long-lived process (e.g. with wsgi_app).
+
 
     The following parameters apply during the API stage:
 
@@ -25,13 +126,61 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
 
     If force_session is True, a new object is created if no matching object is found
     for a particular user's session, and that session is saved to that user.
+
+    If session_secret is a string, the user's cookie holds the session object's primary key,
+    signed with this secret, instead of its session_field. Sessions are then checked without
+    going to the DB, and new session objects are only made when they are first used. Signed
+    sessions expire after session_ttl seconds.
     """
 
+    if isinstance(db, ShardSpec):
+        if shard:
+            raise Exception("A ShardSpec already says which shard each database is.")
+        return link_sharded(table, db, clear_existing=clear_existing, session_field=session_field,
+                            force_session=force_session, lazy=lazy, versioned=versioned,
+                            session_secret=session_secret, session_ttl=session_ttl, track_changes=track_changes,
+                            hot=hot)
+
+    # the hot tables of the database file (see spods.hot), which this one joins when it is linked
+    store = None
+    if hot:
+        if versioned or track_changes:
+            raise Exception("Hot tables can't be versioned, or track changes.")
+        store = hot_store(db)
+        db = store.db
+
     # helper functions that, through closure, are specific to this table
+    def execute(cursor, query, replacements=tuple()):
+        """Runs a query on the given cursor, counting it (and timing it) in spods.metrics, and
+        tracing it as a 'query' span if tracing is on (see spods.tracing)."""
+        if tracer.exporters:
+            with tracer.span('query', table=table.title, sql=query):
+                result = count_query(cursor, query, replacements)
+        else:
+            result = count_query(cursor, query, replacements)
+
+        # wake anyone waiting for changes to the table (see spods.push)
+        if track_changes and not query.startswith("SELECT"):
+            notifier.notify()
+
+        # count writes to hot tables, to flush them sooner when there are many
+        if store and not query.startswith("SELECT"):
+            store.wrote()
+        return result
+
+    def count_query(cursor, query, replacements):
+        if not metrics.enabled:
+            return cursor.execute(query, replacements)
+        start = time()
+        try:
+            return cursor.execute(query, replacements)
+        finally:
+            metrics.sql(table.title, time() - start)
+
     def run_query(query, replacements=tuple()):
         """Opens a cursor and runs a query. Does not return anything."""
         cur = db.cursor()
-        cur.execute(query, replacements)
+        execute(cur, query, replacements)
         # cur.commit()
         cur.close()
 
@@ -41,12 +190,257 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
     # turn on autocommits
     db.isolation_level = None
 
-    # clear the table, if we want
-    if clear_existing:
-        run_query(table.delete_table_stmt(force=False))
+    # the SQL used by this class, prepared when the table is linked
+    statements = {}
+
+    # the row serialiser (and how many fields it was compiled for), kept apart from statements
+    # since it can be compiled before the table is linked
+    compiled = {}
+
+    # relation columns added with has_one() before the table was linked
+    pending_fields = []
+
+    # held while linking, so threads sharing a lazy class link it once
+    link_lock = threading.Lock()
+
+    # (WHERE clause, arguments) --> (table version, row count), for versioned tables
+    counts = {}
+
+    def add_field(new_field, clear_existing_field):
+        """Adds a column to the table in the DB, for the given field."""
+        try:
+            run_query(table.add_field_stmt(new_field))
+
+        except sqlite3.OperationalError:
+            
+            # column already exists
+            if clear_existing_field:
+                # delete column and run it again
+                drop_column(db, table.title, new_field.title)
+                run_query(table.add_field_stmt(new_field))
+
+    def update_stmt(key):
+        """Returns the query for updating a single field of a single row."""
+        if key not in statements['update']:
+            statements['update'][key] = "UPDATE %s SET %s = ? WHERE %s = ?" % (table.title, key, table.pk.title)
+        return statements['update'][key]
+
+    def ttl_clause():
+        """Returns a (condition, arguments) tuple matching rows that haven't expired, or None
+        if the table's rows don't expire."""
+        if not table.ttl:
+            return None
+        return " %s > ? " % table.ttl_field, [now() - table.ttl]
+
+    def where_clause(kw):
+        """Given a dictionary of field --> value criteria, returns a (WHERE clause, arguments)
+        tuple for the matching rows (leaving out expired rows). The clause is empty if there
+        are no conditions."""
+
+        # TODO: prevent fields from being called _start, _limit, etc (the reserved values)
+
+        # build up qualifiers for the WHERE clause
+        query_clause = ""
+        query_args = []
+        for k in kw:
+            if table.is_field(k):
+                if query_clause:
+                    query_clause += " AND "
+
+                # treat 'None' differently
+                if kw[k] == None:
+                    query_clause += " %s IS NULL " % (k)
+                else:
+                    query_clause += " %s = ? " % (k)
+                    query_args.append(table.get_field(k).in_mask(kw[k]))
+
+        unexpired = ttl_clause()
+        if unexpired:
+            if query_clause:
+                query_clause += " AND "
+            query_clause += unexpired[0]
+            query_args += unexpired[1]
 
-    # attempt to make the table, if it doesn't already exist
-    run_query(table.create_table_stmt(force=False))
+        if query_clause:
+            query_clause = " WHERE " + query_clause
+        return query_clause, tuple(query_args)
+
+    def select_query(columns, kw):
+        """Given the columns to select and a dictionary of criteria (as for get_all), returns
+        a (query, arguments) tuple.
+
+        The start and limit are passed as arguments, so queries of the same shape share the
+        same SQL (and SQLite can reuse the compiled statement). The SQL for each shape is
+        only built once."""
+
+        query_clause, query_args = where_clause(kw)
+
+        shape = (columns, query_clause, kw.get('_order'), kw.get('_reverse'), '_start' in kw, '_limit' in kw)
+        if shape not in statements['select_all']:
+            query = "SELECT %s FROM %s %s" % (columns, table.title, query_clause)
+
+            # was an ordering specified?
+            if '_order' in kw:
+                query += " ORDER BY %s " % (kw['_order'])
+                if '_reverse' in kw:
+                    query += " %s " % ('DESC' if kw['_reverse'] else 'ASC')
+
+            # was start/limit specified?
+            if '_start' in kw and '_limit' in kw:
+                query += " LIMIT ?, ? "
+            elif '_limit' in kw:
+                query += " LIMIT ? "
+
+            statements['select_all'][shape] = query
+
+        if '_start' in kw and '_limit' in kw:
+            query_args += (int(kw['_start']), int(kw['_limit']))
+        elif '_limit' in kw:
+            query_args += (int(kw['_limit']), )
+
+        return statements['select_all'][shape], query_args
+
+    def serialiser():
+        """Returns the function that turns a row of this table's fields (in order) into JSON,
+        compiling it if the fields have changed."""
+        if compiled.get('fields') != len(table.fields):
+            compiled['serialiser'] = compile_serialiser(list(table.fields))
+            compiled['fields'] = len(table.fields)
+        return compiled['serialiser']
+
+    def change_all(change, change_args, kw):
+        """Given an UPDATE or DELETE statement (without its WHERE clause) and its arguments,
+        runs it on every row matching the criteria in kw (as for get_all), in one transaction.
+
+        Returns the changed rows, with the table's fields in order: as they are afterwards for
+        an UPDATE, or as they were for a DELETE."""
+
+        columns = ", ".join(f.title for f in table.fields)
+        subquery, subquery_args = select_query(table.pk.title, kw)
+        deleting = change.startswith("DELETE")
+
+        c = db.cursor()
+        try:
+            with transaction(db):
+                if HAS_RETURNING:
+                    execute(c, "%s WHERE %s IN (%s) RETURNING %s" % (change, table.pk.title, subquery, columns),
+                              tuple(change_args) + subquery_args)
+                    return c.fetchall()
+
+                # no RETURNING: find the rows first, then change them
+                execute(c, subquery, subquery_args)
+                pks = [row[0] for row in c]
+
+                rows = []
+                for i in range(0, len(pks), MAX_QUERY_ARGS):
+                    chunk = tuple(pks[i:i + MAX_QUERY_ARGS])
+                    in_clause = " WHERE %s IN (%s)" % (table.pk.title, ",".join("?" * len(chunk)))
+                    if deleting:
+                        execute(c, "SELECT %s FROM %s %s" % (columns, table.title, in_clause), chunk)
+                        rows += c.fetchall()
+                    execute(c, change + in_clause, tuple(change_args) + chunk)
+                    if not deleting:
+                        execute(c, "SELECT %s FROM %s %s" % (columns, table.title, in_clause), chunk)
+                        rows += c.fetchall()
+                return rows
+        finally:
+            c.close()
+
+    def write_back(updates):
+        """Given a list of (primary key, dictionary of field --> value) tuples, sets those fields
+        of each row, in one transaction."""
+
+        c = db.cursor()
+        try:
+            with transaction(db):
+                for pk, values in updates:
+                    keys = [k for k in values if table.is_field(k)]
+                    if not keys:
+                        continue
+                    execute(c, "UPDATE %s SET %s WHERE %s = ?" % (table.title, ", ".join("%s = ?" % k for k in keys), table.pk.title),
+                            tuple(table.get_field(k).in_mask(values[k]) for k in keys) + (pk, ))
+        finally:
+            c.close()
+
+    def link():
+        """Creates the table in the DB (clearing it, if needed), adds any pending relation
+        columns, and prepares the SQL used by this class.
+
+        Only does anything the first time it is called."""
+
+        if statements:
+            return
+
+        if store:
+            # every class linked to the same hot table shares its in-memory copy (see spods.hot)
+            hot_lock.acquire()
+        try:
+            with link_lock:
+                if not statements:
+                    link_once()
+        finally:
+            if store:
+                hot_lock.release()
+
+    def link_once():
+        # clear the table, if we want (a hot table already in memory was cleared when it was
+        # first linked, and dropping it now would drop the in-memory copy)
+        if clear_existing and not (store and table.title in store.tables):
+            run_query(table.delete_table_stmt(force=False))
+
+        # attempt to make the table, if it doesn't already exist
+        run_query(table.create_table_stmt(force=False))
+
+        if table.ttl:
+            # tables linked before they had a ttl need the column
+            try:
+                run_query(table.add_field_stmt(table.get_field(table.ttl_field)))
+            except sqlite3.OperationalError:
+                # already there
+                pass
+            else:
+                # existing rows start to expire from now
+                run_query("UPDATE %s SET %s = ?" % (table.title, table.ttl_field), (now(), ))
+
+            run_query("CREATE INDEX IF NOT EXISTS _spods_ttl_%s ON %s (%s)" % (table.title, table.title, table.ttl_field))
+
+        # sessions are looked up by their session field
+        if session_field:
+            run_query("CREATE INDEX IF NOT EXISTS _spods_session_%s ON %s (%s)" % (table.title, table.title, session_field))
+
+        # add any relations we were given before now
+        for new_field, clear_existing_field in pending_fields:
+            add_field(new_field, clear_existing_field)
+        del pending_fields[:]
+
+        # (after the relations, since dropping a column rebuilds the table)
+        if versioned:
+            install_version_triggers(db, table.title)
+
+        if track_changes:
+            install_change_triggers(db, table.title, table.pk.title)
+
+        if store:
+            # from now on, queries find the in-memory copy of the table first
+            indexed = [f for f in (table.ttl and table.ttl_field, session_field) if f]
+            store.add_table(table, FLUSH_INTERVAL if hot is True else hot, indexed)
+
+        insert = "INSERT INTO %s (%s) VALUES (NULL)" % (table.title, table.pk.title)
+        if shard:
+            # shard i of n makes ids i + 1, i + 1 + n, ... (see spods.sharding)
+            insert = "INSERT INTO %s (%s) SELECT COALESCE(MAX(%s), %d) + %d FROM %s" % (
+                table.title, table.pk.title, table.pk.title, shard[0] + 1 - shard[1], shard[1], table.title)
+
+        # other threads use the class as soon as statements isn't empty, so fill it all at once
+        statements.update({
+            'insert': insert,
+            'select': "SELECT * FROM %s WHERE %s = ? LIMIT 1" % (table.title, table.pk.title),
+            'delete': "DELETE FROM %s WHERE %s = ?" % (table.title, table.pk.title),
+            'select_all': {},
+            'update': {}
+        })
+        for field in table.fields:
+            update_stmt(field.title)
     
     class LinkedClass(IterableUserDict, object):
         """The class representing a dynamically-linked object.
@@ -57,10 +451,22 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
         locals()['table'] = table
         locals()['session_field'] = session_field
         locals()['force_session'] = force_session
+        locals()['session_secret'] = session_secret
+        locals()['session_ttl'] = session_ttl
+        locals()['db'] = db
+        locals()['versioned'] = versioned
+        locals()['track_changes'] = track_changes
+        locals()['hot'] = hot
 
         # a hack to tell that this is a linked class
         locals()['linkedclass'] = True
 
+        # links the table to the DB, if it isn't already
+        locals()['link'] = staticmethod(link)
+
+        # turns rows of this table's fields into JSON (see spods.serialiser)
+        locals()['serialiser'] = staticmethod(serialiser)
+
         ## Static methods for getting/setting values with the attribute interface
         # ie. obj.key = val
         def get_item_wrapper(self, key):
@@ -128,8 +534,8 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
                         local_fk_field = field.title
 
                         # is this a valid link? (e.g. x['book'] is going to be stored in table 'book')
-                        if value != None and key != type(value).table.title:
-                            raise AttributeError(str(key) + " is not a valid type for table " + type(value).table.title)
+                        if value != None and key != value.table.title:
+                            raise AttributeError(str(key) + " is not a valid type for table " + value.table.title)
 
                         # overwrite the foreign key, either with 0 or with the corresponding PK value
                         if value == None:
@@ -148,7 +554,7 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
             new_value = table.get_field(key).in_mask(value)
             
             # update db & save
-            run_query("UPDATE %s SET %s = ? WHERE %s = ?" % (table.title, key, table.pk.title), (new_value, self[table.pk.title]))
+            run_query(update_stmt(key), (new_value, self[table.pk.title]))
             self.data[key] = new_value
 
         def __delitem__(self, key):
@@ -158,12 +564,12 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
 
             # is this the PK? If so, delete the record
             if table.is_pk(key):
-                run_query("DELETE FROM %s WHERE %s = ?" % (table.title, table.pk.title), (self.id, ))
+                run_query(statements['delete'], (self.data[table.pk.title], ))
             else:
-                run_query("UPDATE %s SET %s = NULL WHERE %s = ? LIMIT 1" % (table.title, key, table.pk.title), (self.id, ))
+                run_query(update_stmt(key), (None, self.data[table.pk.title]))
 
             # either way, set the key to none
-            self[key] = None
+            self.data[key] = None
 
         ## Initialiser
         def __init__(self, **kw):
@@ -174,12 +580,13 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
 
             If the primary key is provided, loads this existing record, rather than creating a new one."""
             
+            link()
             self.data = {}
 
             if table.pk.title not in kw:
                 # create new record in db (with default values)
                 c = db.cursor()
-                c.execute("INSERT INTO %s (%s) VALUES (NULL)" % (table.title, table.pk.title))
+                execute(c, statements['insert'])
                 
                 # save id
                 self.data[table.pk.title] = c.lastrowid
@@ -194,7 +601,10 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
             # save initialised values (and defaults, for non-initialised values)
             # TODO: do this with a query, in a single DB call, in the INSERT statement above
             for field in table.fields:
-                if field.title in kw:
+                if field.pk and table.pk.title in kw:
+                    # loading an existing record: its primary key is already saved
+                    continue
+                elif field.title in kw:
                     self[field.title] = kw[field.title]
                 elif field.default and table.pk.title not in kw:
                     # making a new record: save defaults
@@ -209,7 +619,7 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
             Relies on the ID of the object to match the data in the DB."""
             
             c = db.cursor()
-            c.execute("SELECT * FROM %s WHERE id = ? LIMIT 1" % table.title, (self.id, ))
+            execute(c, statements['select'], (self.id, ))
             row = c.fetchone()
             c.close()
 
@@ -269,57 +679,305 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
                 * _order, which specifies the field to order by
                 * _reverse, which specifies ascending (False) or desending (True) for the ordering
             
+
+            If memory profiling is on (see spods.profiling), the call has its own account.
             """
-            # TODO: prevent fields from being called _start, _limit, etc (the reserved values)
-
-            # build up qualifiers for the WHERE clause
-            query_clause = ""
-            query_args = []
-            for k in kw:
-                if table.is_field(k):
-                    if query_clause:
-                        query_clause += " AND "
-
-                    # treat 'None' differently
-                    if kw[k] == None:
-                        query_clause += " %s IS NULL " % (k)
-                    else:
-                        query_clause += " %s = ? " % (k)
-                        query_args.append(table.get_field(k).in_mask(kw[k]))
-
-            # search to get primary keys
-            query = "SELECT %s FROM %s " % (table.pk.title, table.title)
-            if query_clause:
-                query += " WHERE "
-                query += query_clause
+            with profiler.account('get_all', table=table.title):
+                return list(LinkedClass.iter_all(**kw))
 
-            # was start/limit specified?
-            if '_start' in kw and '_limit' in kw:
-                query += " LIMIT %s, %s " % (kw['_start'], kw['_limit'])
-            elif '_limit' in kw:
-                query += " LIMIT %s " % kw['_limit']
+        @staticmethod
+        def iter_all(**kw):
+            """Like get_all(), but returns a generator that yields each object as it is read
+            from the DB, rather than building the whole list first."""
 
-            # was an ordering specified?
-            if '_order' in kw:
-                query += " ORDER BY %s " % (kw['_order'])
-                if '_reverse' in kw:
-                    query += " %s " % ('DESC' if kw['_reverse'] else 'ASC')
+            link()
+
+            query, query_args = select_query("*", kw)
 
             # run query
             c = db.cursor()
-            c.execute(query, tuple(query_args))
+            execute(c, query, query_args)
             
-            # build objects
-            # TODO: could make an offline object system, to prevent the N calls that are about to happen in our DB
-            objs = []
-            for row in c:
-                pk = row[table.pk.title]
-                objs.append(LinkedClass(**{ table.pk.title: pk }))
-                
-            # clean up
+            # build objects straight from the rows
+            try:
+                for row in c:
+                    obj = LinkedClass.from_row(row)
+                    if profiler.enabled:
+                        profiler.charge('rows', object_size(obj), rows=1)
+                    yield obj
+            finally:
+                # clean up
+                c.close()
+
+        @staticmethod
+        def iter_serialised(**kw):
+            """Like iter_all(), but yields each row as a RawJSON object (see spods.serialiser),
+            straight from the cursor, without making objects."""
+
+            link()
+
+            serialise = serialiser()
+            query, query_args = select_query(", ".join(f.title for f in table.fields), kw)
+
+            c = db.cursor()
+            execute(c, query, query_args)
+            try:
+                for row in c:
+                    if profiler.enabled:
+                        profiler.charge('rows', row_size(row), rows=1)
+                    yield serialise(row)
+            finally:
+                c.close()
+
+        @staticmethod
+        def parallel_map(fn, workers=None, chunk=None, write=False, progress=None, **kw):
+            """Calls fn with every object in the DB matching the given criteria (as for get_all,
+            but _start, _limit and _order are ignored), spread over worker processes (one per
+            core, unless workers is given), each reading chunk rows (or DEFAULT_CHUNK) at a time
+            through a read-only connection of its own (see spods.parallel).
+
+            Returns a list of (primary key, result) tuples for each object fn didn't return None
+            for, in primary key order. If write is True, fn returns a dictionary of field -->
+            value to set instead (or None, to leave the row alone): the changes are written by
+            this process, in batches, and the number of rows changed is returned.
+
+            If progress is given, it is called with (rows done, total rows) after each chunk."""
+
+            # multiprocessing is only imported for batch jobs
+            import parallel
+
+            link()
+
+            # the workers read the file, so a hot table's journal needs to be in it
+            LinkedClass.flush()
+            return parallel.parallel_map(LinkedClass, fn, where_clause(kw), workers, chunk or parallel.DEFAULT_CHUNK,
+                                         write_back if write else None, progress)
+
+        @staticmethod
+        def serialise(obj):
+            """Given an object of this class, returns its values as a RawJSON object."""
+            return serialiser()([obj.data[f.title] for f in table.fields])
+
+        @staticmethod
+        def count_all(**kw):
+            """Returns the number of objects in the DB that match the given criteria (as for
+            get_all, but _start, _limit and _order are ignored).
+
+            If _approximate is True and there are no criteria, returns the number of rows the
+            last ANALYZE found instead (if it has been run), which is much quicker for very large
+            tables.
+
+            For versioned tables, each count is remembered until the table is next written to."""
+
+            link()
+
+            query_clause, query_args = where_clause(kw)
+
+            if kw.get('_approximate') and not query_clause:
+                estimate = analysed_rows(db, table.title)
+                if estimate != None:
+                    return estimate
+
+            key = (query_clause, query_args)
+            if versioned:
+                version = table_version(db, table.title)
+                if key in counts and counts[key][0] == version:
+                    return counts[key][1]
+
+            c = db.cursor()
+            execute(c, "SELECT COUNT(*) FROM %s %s" % (table.title, query_clause), query_args)
+            total = c.fetchone()[0]
             c.close()
+
+            if versioned:
+                if len(counts) >= MAX_CACHED_COUNTS:
+                    counts.clear()
+                counts[key] = (version, total)
+
+            return total
+
+        @staticmethod
+        def update_all(values, **kw):
+            """Given a dictionary of field --> value, sets those fields of every object in the DB
+            matching the given criteria (as for get_all), with a single UPDATE.
+
+            In masks are applied once per value. Returns the updated rows (see serialiser())."""
+
+            link()
+
+            values = dict((k, v) for k, v in values.items() if table.is_field(k))
+            if not values:
+                # nothing to change
+                c = db.cursor()
+                execute(c, *select_query(", ".join(f.title for f in table.fields), kw))
+                rows = c.fetchall()
+                c.close()
+                return rows
+
+            keys = values.keys()
+            change = "UPDATE %s SET %s" % (table.title, ", ".join("%s = ?" % k for k in keys))
+            return change_all(change, [table.get_field(k).in_mask(values[k]) for k in keys], kw)
+
+        @staticmethod
+        def delete_all(**kw):
+            """Deletes every object in the DB matching the given criteria (as for get_all), with
+            a single DELETE. Returns the deleted rows (see serialiser())."""
+
+            link()
+            return change_all("DELETE FROM %s" % table.title, [], kw)
+
+        @staticmethod
+        def get_many(pks):
+            """Given a list of primary key values, returns a dictionary of primary key --> object
+            for each one found in the DB, using as few queries as possible."""
+
+            link()
+
+            pks = list(set(pks))
+            objs = {}
+
+            query = "SELECT * FROM %s WHERE %s IN (%%s)" % (table.title, table.pk.title)
+            unexpired = ttl_clause()
+            if unexpired:
+                query += " AND " + unexpired[0]
+
+            c = db.cursor()
+            for i in range(0, len(pks), MAX_QUERY_ARGS):
+                chunk = pks[i:i + MAX_QUERY_ARGS]
+                execute(c, query % ",".join("?" * len(chunk)), chunk + (unexpired[1] if unexpired else []))
+                for row in c:
+                    obj = objs[row[table.pk.title]] = LinkedClass.from_row(row)
+                    if profiler.enabled:
+                        profiler.charge('rows', object_size(obj), rows=1)
+            c.close()
+
             return objs
+
+        @staticmethod
+        def from_row(row):
+            """Given a row read from this table (with all of its columns), returns the matching
+            object, without going back to the DB."""
+
+            obj = LinkedClass.__new__(LinkedClass)
+            obj.data = {}
+            for f in table.fields:
+                obj.data[f.title] = row[f.title]
+            return obj
+
+        @staticmethod
+        def fk_field(title):
+            """Given the name of another table, returns the field in this table that holds a
+            foreign key to it, or None if there isn't one."""
+
+            for field in table.fks():
+                if field.fk.table.title == title:
+                    return field
+            return None
             
+        @staticmethod
+        def purge_expired(batch_size=PURGE_BATCH_SIZE, max_batches=None):
+            """Deletes expired rows (see Table), batch_size rows per transaction, so other
+            writers are never held up for long. Stops after max_batches batches, if given.
+
+            Returns the number of rows deleted."""
+
+            if not table.ttl:
+                return 0
+
+            link()
+
+            query = "DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s <= ? LIMIT ?)" % (
+                table.title, table.pk.title, table.pk.title, table.title, table.ttl_field)
+
+            deleted = 0
+            batches = 0
+            while max_batches == None or batches < max_batches:
+                c = db.cursor()
+                execute(c, query, (now() - table.ttl, batch_size))
+                removed = c.rowcount
+                c.close()
+
+                deleted += removed
+                batches += 1
+                if removed < batch_size:
+                    # nothing left
+                    break
+
+            return deleted
+
+        @staticmethod
+        def version():
+            """Returns the table's current version, a number that changes every time the
+            table is written to, or None if the table wasn't linked with versioned=True."""
+
+            if not versioned:
+                return None
+
+            link()
+            return table_version(db, table.title)
+
+        @staticmethod
+        def changes(since=0, limit=None):
+            """Returns a list of (seq, op, primary key, object) tuples for the rows changed since
+            the given sequence number, in order. Each row is listed once, with its latest change:
+            'insert', 'update' or 'delete' (whose object is None). Give the last seq as since
+            next time to get the changes after it.
+
+            Raises spods.changes.ChangesCompacted if the changes since then are no longer kept.
+            Only works for tables linked with track_changes=True."""
+
+            if not track_changes:
+                raise Exception("Changes to %s aren't tracked." % table.title)
+
+            link()
+
+            rows = changes_since(db, table.title, since, limit)
+            objs = LinkedClass.get_many([pk for seq, pk, op in rows if op != 'delete'])
+
+            result = []
+            for seq, pk, op in rows:
+                obj = objs.get(pk)
+                if obj == None:
+                    # deleted (or expired) since
+                    op = 'delete'
+                result.append((seq, op, pk, obj))
+            return result
+
+        @staticmethod
+        def latest_change():
+            """Returns the sequence number of the table's latest change, to ask for the changes
+            after it later (see changes()), or None if the table's changes aren't tracked."""
+
+            if not track_changes:
+                return None
+
+            link()
+            return latest_change(db, table.title)
+
+        @staticmethod
+        def compact_changes(keep=DEFAULT_KEEP):
+            """Forgets all but the latest keep changes to the table (see changes()), so the log
+            doesn't grow forever. Returns the number of changes forgotten."""
+
+            if not track_changes:
+                return 0
+
+            link()
+            with transaction(db):
+                return compact_changes(db, table.title, keep)
+
+        @staticmethod
+        def flush():
+            """Writes the journalled changes to a hot table into its database file straight away,
+            rather than waiting for the next flush. Returns the number of changes written (0,
+            for a table that isn't hot)."""
+
+            if not store:
+                return 0
+
+            link()
+            return store.flush([table.title])
+
         @staticmethod
         def has_one(class_var, new_field_name = None, clear_existing = False):
             """Creates ownership of this class over another class.
@@ -328,28 +986,27 @@ def link_table(table, db, clear_existing=False, session_field=None, force_sessio
 
             class_var should be an instance of LinkedClass (created from the link_table() function)."""
 
-            # set default new field name to 'table_id'
-            if new_field_name == None:
-                new_field_name = class_var.table.title + "_"
-                
-                # get PK of this table (e.g. ID) and add it to new field name
-                new_field_name += table.pk.title
+            new_field = relation_field(table, class_var, new_field_name)
+            LinkedClass.add_column(new_field, clear_existing)
+
+            # add column to all new object instances
+            table.fields.append(new_field)
 
-            new_field = Field(new_field_name, int, fk=class_var)
+        @staticmethod
+        def add_column(new_field, clear_existing=False):
+            """Adds a column for the given field to the table in the DB (now, or when the table
+            is linked), e.g. for a relation (see has_one). The field must also be added to the
+            table object."""
 
-            # add the field to the DB
-            try:
-                run_query(table.add_field_stmt(new_field))
+            if statements and store:
+                raise Exception("Relations must be added to hot tables before they are used.")
 
-            except sqlite3.OperationalError:
-                
-                # column already exists
-                if clear_existing:
-                    # delete column and run it again
-                    # TODO
-                    pass
+            if statements:
+                add_field(new_field, clear_existing)
+            else:
+                pending_fields.append((new_field, clear_existing))
 
-            # add column to all new object instances
-            table.fields.append(new_field)
+    if not lazy:
+        link()
 
     return LinkedClass
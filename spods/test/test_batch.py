@@ -0,0 +1,61 @@
+import json
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.test.util import call, call_json
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.Author = link_table(Table('author', [Field('id', int, pk=True), Field('name', str)]), self.db)
+        self.Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str),
+                                              Field('author_id', int)]), self.db)
+        self.app = wsgi_app(self.Author, self.Book)
+
+    def batch(self, operations):
+        return call_json(self.app, batch=json.dumps(operations))
+
+    def test_references(self):
+        result = self.batch([
+            { 'obj': 'author', 'action': 'new', 'name': 'L. Frank Baum' },
+            { 'obj': 'book', 'action': 'new', 'title': 'Ozma of Oz', 'author_id': '$0.id' },
+            { 'obj': 'book', 'action': 'new', 'title': '$$5', 'author_id': '$1.author_id' }
+        ])
+        self.assertEqual(result['status'], 0)
+
+        author_id = result['data'][0]['data'][0]['id']
+        books = self.Book.get_all(_order='id')
+        self.assertEqual([(b.title, b.author_id) for b in books], [('Ozma of Oz', author_id), ('$5', author_id)])
+
+    def test_failure_rolls_back(self):
+        result = self.batch([
+            { 'obj': 'author', 'action': 'new', 'name': 'Nobody' },
+            { 'obj': 'book', 'action': 'new', 'title': 'By nobody', 'author_id': '$0.id' },
+            { 'obj': 'shelf', 'action': 'new' }
+        ])
+        self.assertNotEqual(result['status'], 0)
+        self.assertTrue(result['error'].startswith('Operation 2:'))
+        self.assertEqual(self.Author.count_all(), 0)
+        self.assertEqual(self.Book.count_all(), 0)
+
+        # the connection is left usable
+        self.Author(name='Somebody')
+        self.assertEqual(self.Author.count_all(), 1)
+
+    def test_bad_reference(self):
+        result = self.batch([{ 'obj': 'book', 'action': 'new', 'title': 'x', 'author_id': '$3.id' }])
+        self.assertEqual(result['status'], 1)
+
+    def test_not_a_list(self):
+        self.assertEqual(self.batch({ 'obj': 'author' })['status'], 1)
+        self.assertEqual(call_json(self.app, batch='[')['status'], 1)
+
+    def test_repeated_batch_parameter(self):
+        status, headers, body = call(self.app, query='batch=1&batch=2')
+        self.assertEqual(status, '400 Bad Request')
+        self.assertEqual(json.loads(body), { 'status': 1, 'error': 'Only one batch can be sent at a time.', 'data': None })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app, cache_responses, ResponseCache
+from spods.test.util import call
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_go_first(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('1', None, '3'))
+
+    def test_threads(self):
+        cache = ResponseCache(max_entries=50)
+        errors = []
+
+        def use(n):
+            try:
+                for i in range(2000):
+                    cache.set('%d-%d' % (n, i % 100), 'x')
+                    cache.get('%d-%d' % (n, (i * 7) % 100))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use, args=(n, )) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache.entries), 50)
+
+class CachedResponsesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+        cache_responses(self.cache)
+        self.db = sqlite3.connect(':memory:')
+
+    def tearDown(self):
+        cache_responses(None)
+
+    def test_versioned_views_are_cached(self):
+        Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str)]), self.db, versioned=True)
+        app = wsgi_app(Book)
+        Book(title='Ozma of Oz')
+
+        status, headers, body = call(app, { 'obj': 'book' })
+        self.assertIn('ETag', dict(headers))
+        self.assertEqual(len(self.cache.entries), 1)
+
+        # served from the cache, until the table changes
+        key = dict(headers)['ETag'][1:-1]
+        self.cache.set(key, 'cached')
+        self.assertEqual(call(app, { 'obj': 'book' })[2], 'cached')
+        Book(title='Rinkitink in Oz')
+        self.assertIn('Rinkitink', call(app, { 'obj': 'book' })[2])
+
+    def test_ttl_tables_are_not_cached(self):
+        Token = link_table(Table('token', [Field('id', int, pk=True)], ttl=60), self.db, versioned=True)
+        app = wsgi_app(Token)
+        Token()
+
+        status, headers, body = call(app, { 'obj': 'token' })
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('ETag', dict(headers))
+        self.assertEqual(len(self.cache.entries), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app, ChangesCompacted
+from spods.test.util import call_json
+
+class ChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str)]), self.db, track_changes=True)
+
+    def ops(self, since=0, limit=None):
+        return [(op, pk) for seq, op, pk, obj in self.Book.changes(since, limit)]
+
+    def test_each_row_once_with_its_latest_change(self):
+        self.assertEqual(self.Book.latest_change(), 0)
+        a = self.Book(title='Ozma of Oz')
+        b = self.Book(title='Glinda of Oz')
+        start = self.Book.latest_change()
+
+        a.title = 'Ozma of Oz (2nd edition)'
+        c = self.Book(title='Rinkitink in Oz')
+        c.title = 'Rinkitink'
+        self.Book.delete_all(id=b.id)
+
+        # in the order of their latest changes, and rows made and then changed are still new
+        self.assertEqual(self.ops(), [('insert', 1), ('insert', 3), ('delete', 2)])
+        self.assertEqual(self.ops(start), [('update', 1), ('insert', 3), ('delete', 2)])
+        self.assertEqual(self.ops(start, limit=1), [('update', 1)])
+
+        seq, op, pk, obj = self.Book.changes(start)[0]
+        self.assertEqual(obj.title, 'Ozma of Oz (2nd edition)')
+        self.assertEqual(self.Book.changes(start)[2][3], None)
+        self.assertEqual(self.ops(self.Book.latest_change()), [])
+
+    def test_writes_outside_spods_are_logged(self):
+        self.Book.link()
+        self.db.execute("INSERT INTO book (title) VALUES ('The Lost Princess of Oz')")
+        self.db.execute("UPDATE book SET id = 10 WHERE id = 1")
+        self.assertEqual(self.ops(), [('delete', 1), ('insert', 10)])
+
+    def test_compaction(self):
+        self.Book.link()
+        self.db.executemany("INSERT INTO book (title) VALUES (?)", [('Book %d' % i, ) for i in range(10)])
+        latest = self.Book.latest_change()
+        self.assertEqual(latest, 10)
+
+        self.assertEqual(self.Book.compact_changes(keep=4), 6)
+        self.assertRaises(ChangesCompacted, self.Book.changes, 5)
+        self.assertEqual(self.ops(6), [('insert', 7), ('insert', 8), ('insert', 9), ('insert', 10)])
+        self.assertEqual(self.Book.latest_change(), latest)
+        self.assertEqual(self.Book.compact_changes(keep=4), 0)
+
+        # compacting everything still remembers where the log got to
+        self.Book.compact_changes(keep=0)
+        self.assertEqual(self.Book.latest_change(), latest)
+        self.assertEqual(self.ops(latest), [])
+        self.Book(title='One more')
+        self.assertEqual(self.ops(latest), [('insert', 11)])
+
+    def test_api(self):
+        app = wsgi_app(self.Book)
+        start = call_json(app, obj='book', action='changes')
+        self.assertEqual((start['status'], start['seq'], start['data']), (0, 0, []))
+
+        self.Book(title='Ozma of Oz')
+        seq = self.Book.latest_change()
+        result = call_json(app, obj='book', action='changes', since=start['seq'])
+        self.assertEqual(result['data'], [{ 'seq': seq, 'op': 'insert', 'pk': 1, 'obj': { 'id': 1, 'title': 'Ozma of Oz' } }])
+        self.assertEqual(result['seq'], seq)
+
+        self.Book(title='Glinda of Oz')
+        self.Book.compact_changes(keep=1)
+        result = call_json(app, obj='book', action='changes', since=0)
+        self.assertNotEqual(result['status'], 0)
+        self.assertIn('ChangesCompacted', result['error'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.json_api import MAX_EXPAND_DEPTH, expand_objects
+from spods.serialiser import encode
+from spods.test.util import call_json
+
+class ExpandTest(unittest.TestCase):
+
+    def setUp(self):
+        # each person can point at another (e.g. who they report to)
+        self.Person = link_table(Table('person', [Field('id', int, pk=True), Field('name', str)]), sqlite3.connect(':memory:'))
+        self.Person.has_one(self.Person)
+
+        # a chain: p1 -> p2 -> ... -> p8
+        self.chain = [self.Person(name='p%d' % (i + 1)) for i in range(8)]
+        for person, boss in zip(self.chain, self.chain[1:]):
+            person['person_id'] = boss.id
+
+    def expand(self, objs, depth):
+        return json.loads(encode(expand_objects(objs, [self.Person], depth)))
+
+    def names(self, value):
+        """Returns the names down a chain of expanded people."""
+        names = [value['name']]
+        while 'person' in value:
+            value = value['person']
+            names.append(value['name'])
+        return names
+
+    def test_depth(self):
+        self.assertEqual(self.names(self.expand([self.chain[0]], 0)[0]), ['p1'])
+        self.assertEqual(self.names(self.expand([self.chain[0]], 3)[0]), ['p1', 'p2', 'p3', 'p4'])
+
+        # the last one expanded still has its foreign key
+        self.assertEqual(self.expand([self.chain[0]], 1)[0]['person']['person_id'], self.chain[2].id)
+
+    def test_cycles_are_cut(self):
+        a, b = self.chain[6], self.chain[7]
+        b['person_id'] = a.id
+        self.chain[5]['person_id'] = self.chain[5].id
+
+        expanded = self.expand([a], 5)[0]
+        self.assertEqual(self.names(expanded), ['p7', 'p8'])
+        self.assertEqual(expanded['person']['person_id'], a.id)
+
+        # someone who reports to themselves isn't expanded inside themselves
+        self.assertFalse('person' in self.expand([self.chain[5]], 5)[0])
+
+    def test_objects_read_once(self):
+        loaded = {}
+        expanded = json.loads(encode(expand_objects(self.chain[:3], [self.Person], 2, loaded)))
+        self.assertEqual([self.names(e) for e in expanded], [['p1', 'p2', 'p3'], ['p2', 'p3', 'p4'], ['p3', 'p4', 'p5']])
+        self.assertEqual(sorted(pk for title, pk in loaded), [c.id for c in self.chain[1:5]])
+
+    def test_api_depth(self):
+        app = wsgi_app(self.Person)
+        result = call_json(app, obj='person', id=self.chain[0].id, expand='person', depth=2)
+        self.assertEqual(self.names(result['data'][0]), ['p1', 'p2', 'p3'])
+
+        # no deeper than MAX_EXPAND_DEPTH, however deep is asked for
+        result = call_json(app, obj='person', id=self.chain[0].id, expand='person', depth=100)
+        self.assertEqual(len(self.names(result['data'][0])), MAX_EXPAND_DEPTH + 1)
+
+        # streamed responses expand the same way
+        stream = wsgi_app(self.Person, stream=True)
+        result = call_json(stream, obj='person', id=self.chain[0].id, expand='person', depth=2)
+        self.assertEqual(self.names(result['data'][0]), ['p1', 'p2', 'p3'])
+
+if __name__ == '__main__':
+    unittest.main()
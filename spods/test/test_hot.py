@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app
+from spods import hot
+from spods.test.util import TempDirTest, call_json
+
+def setting_table():
+    return Table('setting', [Field('id', int, pk=True), Field('name', str), Field('value', str)])
+
+class HotTest(TempDirTest):
+
+    def tearDown(self):
+        # stop this test's stores, so their threads don't outlive its directory
+        for path in [path for path in hot.stores if path.startswith(self.directory)]:
+            hot.stores.pop(path).close()
+        TempDirTest.tearDown(self)
+
+    def link(self, **options):
+        return link_table(setting_table(), sqlite3.connect(self.path('settings.db')), hot=60, **options)
+
+    def on_disk(self):
+        db = sqlite3.connect(self.path('settings.db'))
+        return sorted(db.execute("SELECT name, value FROM setting"))
+
+    def test_written_back_by_flush(self):
+        Setting = self.link()
+        Setting(name='colour', value='red')
+        dark = Setting(name='theme', value='light')
+        dark.value = 'dark'
+        self.assertEqual(self.on_disk(), [])
+
+        self.assertTrue(Setting.flush() > 0)
+        self.assertEqual(self.on_disk(), [(u'colour', u'red'), (u'theme', u'dark')])
+
+        Setting.delete_all(name='colour')
+        Setting.flush()
+        self.assertEqual(self.on_disk(), [(u'theme', u'dark')])
+        self.assertEqual(Setting.flush(), 0)
+
+    def test_journal_replayed_after_crash(self):
+        Setting = self.link()
+        Setting(name='colour', value='red')
+
+        # the process "stops": its store goes away without flushing
+        store = hot.stores.pop(self.path('settings.db'))
+        store.closed = True
+        store.wake.set()
+        store.thread.join()
+        self.assertEqual(self.on_disk(), [])
+
+        # replayed when the table is next linked (its first use)
+        Setting = self.link()
+        self.assertEqual(Setting.get_one(name='colour').value, 'red')
+        self.assertEqual(self.on_disk(), [(u'colour', u'red')])
+
+    def test_linked_twice(self):
+        # e.g. once by each of spods.serve's workers
+        First = self.link()
+        First(name='colour', value='red')
+        Second = self.link()
+        Second(name='theme', value='dark')
+
+        self.assertTrue(First.db is Second.db)
+        self.assertEqual(First.count_all(), 2)
+        self.assertEqual(Second.get_one(name='colour').value, 'red')
+        Second.flush()
+        self.assertEqual(self.on_disk(), [(u'colour', u'red'), (u'theme', u'dark')])
+
+    def test_linked_twice_clearing_existing(self):
+        # the second link mustn't drop the in-memory copy (or its journal triggers)
+        First = self.link(clear_existing=True)
+        First(name='colour', value='red')
+        Second = self.link(clear_existing=True)
+        Second(name='theme', value='dark')
+
+        self.assertEqual(Second.count_all(), 2)
+        First.flush()
+        self.assertEqual(self.on_disk(), [(u'colour', u'red'), (u'theme', u'dark')])
+        self.assertEqual(First.count_all(), 2)
+
+    def test_applications_share_the_lock(self):
+        apps = [wsgi_app(self.link()) for i in range(3)]
+        errors = []
+
+        def use(app, n):
+            try:
+                for i in range(50):
+                    call_json(app, obj='setting', action='new', name='%d-%d' % (n, i), value='x')
+                    call_json(app, obj='setting', name='%d-%d' % (n, i))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use, args=(app, n)) for n, app in enumerate(apps)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(call_json(apps[0], obj='setting', limit=1000)['data']), 150)
+
+        # a request waits while another thread holds the lock
+        done = threading.Event()
+        with hot.lock:
+            thread = threading.Thread(target=lambda: (call_json(apps[1], obj='setting'), done.set()))
+            thread.start()
+            self.assertFalse(done.wait(0.2))
+        thread.join()
+        self.assertTrue(done.is_set())
+
+    def test_close(self):
+        Setting = self.link()
+        Setting(name='colour', value='red')
+
+        store = hot.stores[self.path('settings.db')]
+        store.close()
+        self.assertFalse(store.thread.is_alive())
+        self.assertEqual(self.on_disk(), [(u'colour', u'red')])
+
+        # closing again does nothing
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import json
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.test.util import call_json
+
+def book_table():
+    return Table('book', [Field('id', int, pk=True), Field('title', str)])
+
+class LazyLinkTest(unittest.TestCase):
+    """The first thing a lazily linked class is asked to do must link it, whatever it is."""
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute("CREATE TABLE book (id INTEGER PRIMARY KEY, title TEXT)")
+        self.db.executemany("INSERT INTO book (title) VALUES (?)", [('Ozma of Oz', ), ('Glinda of Oz', )])
+
+    def test_first_request_is_an_edit(self):
+        app = wsgi_app(link_table(book_table(), self.db))
+        result = call_json(app, obj='book', action='edit', fetch='one', title='Changed', **{ 'id*': 1 })
+        self.assertEqual(result['status'], 0)
+        self.assertEqual(result['data'], [{ 'id': 1, 'title': 'Changed' }])
+        self.assertEqual(len(call_json(app, obj='book')['data']), 2)
+
+    def test_first_request_is_a_delete(self):
+        app = wsgi_app(link_table(book_table(), self.db))
+        result = call_json(app, obj='book', action='delete', id=2)
+        self.assertEqual(result['status'], 0)
+        self.assertEqual(result['data'], [{ 'id': 2, 'title': 'Glinda of Oz' }])
+        self.assertEqual(call_json(app, obj='book')['data'], [{ 'id': 1, 'title': 'Ozma of Oz' }])
+
+    def test_serialiser_before_link(self):
+        Book = link_table(book_table(), self.db)
+        serialise = Book.serialiser()
+        self.assertEqual(Book.count_all(), 2)
+        row = self.db.execute("SELECT id, title FROM book WHERE id = 1").fetchone()
+        self.assertEqual(json.loads(serialise(row)), { 'id': 1, 'title': 'Ozma of Oz' })
+
+if __name__ == '__main__':
+    unittest.main()
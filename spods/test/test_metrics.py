@@ -0,0 +1,95 @@
+import json
+import sqlite3
+import unittest
+from StringIO import StringIO
+
+from spods import Field, Table, link_table, wsgi_app, expose_metrics, Metrics
+from spods.metrics import metrics
+from spods.test.util import TempDirTest, call
+
+def get(application, query, authorization=None):
+    """Calls the application with a GET request, and returns its (status, body)."""
+    environ = { 'REQUEST_METHOD': 'GET', 'QUERY_STRING': query, 'wsgi.input': StringIO('') }
+    if authorization:
+        environ['HTTP_AUTHORIZATION'] = authorization
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+    body = ''.join(application(environ, start_response))
+    return response['status'], body
+
+class MetricsEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.clear()
+        self.Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str)]), sqlite3.connect(':memory:'))
+        self.Book(title='Dune')
+        self.app = wsgi_app(self.Book)
+
+    def tearDown(self):
+        expose_metrics(None)
+        metrics.clear()
+
+    def test_hidden_by_default(self):
+        status, body = get(self.app, 'obj=_metrics')
+        self.assertNotEqual(status, '200 OK')
+        self.assertFalse('spods_requests_total' in body)
+
+    def test_needs_the_token(self):
+        expose_metrics('s3cret')
+        for query, authorization in [('obj=_metrics', None), ('obj=_metrics&token=wrong', None),
+                                      ('obj=_metrics', 'Bearer wrong')]:
+            status, body = get(self.app, query, authorization)
+            self.assertEqual(status, '401 Unauthorized')
+            self.assertEqual(json.loads(body)['error'], 'Invalid metrics token.')
+
+        self.assertEqual(get(self.app, 'obj=_metrics&token=s3cret')[0], '200 OK')
+        self.assertEqual(get(self.app, 'obj=_metrics', 'Bearer s3cret')[0], '200 OK')
+
+    def test_requests_counted(self):
+        expose_metrics('s3cret')
+        call(self.app, { 'obj': 'book' })
+        call(self.app, { 'obj': 'book' })
+
+        status, body = get(self.app, 'obj=_metrics&token=s3cret')
+        lines = body.splitlines()
+        self.assertTrue('# TYPE spods_request_seconds histogram' in lines)
+        self.assertTrue('spods_requests_total{action="view",obj="book",status="200"} 2' in lines)
+        self.assertTrue('spods_request_seconds_count{action="view",obj="book"} 2' in lines)
+        self.assertTrue(any(line.startswith('spods_sql_statements_total{table="book"} ') for line in lines))
+
+        # the metrics requests themselves aren't counted
+        self.assertFalse('_metrics' in body)
+
+class HistogramTest(TempDirTest):
+
+    def test_buckets(self):
+        m = Metrics(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.5, 0.5, 2):
+            m.observe('spods_sql_seconds', { 'table': 'book' }, seconds)
+
+        lines = [line for line in m.render().splitlines() if line.startswith('spods_sql_seconds')]
+        self.assertEqual(lines, [
+            'spods_sql_seconds_bucket{table="book",le="0.1"} 1',
+            'spods_sql_seconds_bucket{table="book",le="1"} 3',
+            'spods_sql_seconds_bucket{table="book",le="+Inf"} 4',
+            'spods_sql_seconds_sum{table="book"} 3.05',
+            'spods_sql_seconds_count{table="book"} 4'
+        ])
+
+    def test_shared_file(self):
+        # e.g. two CGI processes
+        first, second = Metrics(), Metrics()
+        first.path = second.path = self.path('metrics.json')
+        first.count('spods_requests_total', { 'obj': 'book' })
+        first.flush()
+        second.count('spods_requests_total', { 'obj': 'book' }, 2)
+        second.flush()
+
+        reader = Metrics()
+        reader.path = self.path('metrics.json')
+        self.assertTrue('spods_requests_total{obj="book"} 3' in reader.render().splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
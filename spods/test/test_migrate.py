@@ -0,0 +1,78 @@
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, plan_migration, migrate
+from spods.migrate import live_columns
+
+def book_table(*extra):
+    return Table('book', [Field('id', int, pk=True), Field('title', str)] + list(extra))
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        migrate(book_table(Field('isbn', str)), self.db)
+        self.db.executemany("INSERT INTO book (title, isbn) VALUES (?, ?)", [('t%d' % i, 'i%d' % i) for i in range(25)])
+
+    def columns(self):
+        return [column[0] for column in live_columns(self.db, 'book')]
+
+    def test_create(self):
+        db = sqlite3.connect(':memory:')
+        migration = plan_migration(book_table(), db)
+        self.assertEqual(migration.steps, [('create', )])
+        migration.run(db)
+        self.assertEqual([column[0] for column in live_columns(db, 'book')], ['id', 'title'])
+        self.assertFalse(plan_migration(book_table(), db))
+
+    def test_add_column_keeps_rows(self):
+        migration = migrate(book_table(Field('isbn', str), Field('pages', int, default=100)), self.db)
+        self.assertEqual([step[0] for step in migration.steps], ['add'])
+        self.assertFalse(migration.needs_rebuild())
+        self.assertEqual(self.db.execute("SELECT COUNT(*), MIN(pages) FROM book").fetchone(), (25, 100))
+
+    def test_rename_keeps_data(self):
+        migrate(book_table(Field('code', str)), self.db, renames={'isbn': 'code'}, batch_size=7)
+        self.assertEqual(self.columns(), ['id', 'title', 'code'])
+        self.assertEqual(self.db.execute("SELECT code FROM book WHERE id = 3").fetchone(), ('i2', ))
+
+    def test_drop_and_progress(self):
+        progress = []
+        migrate(book_table(), self.db, batch_size=10, progress=lambda copied, total: progress.append((copied, total)))
+        self.assertEqual(self.columns(), ['id', 'title'])
+        self.assertEqual(progress, [(10, 25), (20, 25), (25, 25)])
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM book").fetchone(), (25, ))
+
+    def test_retype_casts_and_keeps_indexes(self):
+        self.db.execute("CREATE INDEX book_title ON book (title)")
+        self.db.execute("UPDATE book SET isbn = '42' WHERE id = 1")
+        migration = migrate(book_table(Field('isbn', int)), self.db)
+        self.assertEqual(migration.steps, [('retype', 'isbn')])
+        self.assertEqual(self.db.execute("SELECT isbn, typeof(isbn) FROM book WHERE id = 1").fetchone(), (42, 'integer'))
+        indexes = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'book'").fetchall()
+        self.assertEqual(indexes, [('book_title', )])
+
+    def test_rebuild_keeps_triggers(self):
+        Book = link_table(book_table(Field('isbn', int)), self.db, versioned=True, track_changes=True)
+        Book(title='first')
+        version, seq = Book.version(), Book.changes()[-1][0]
+
+        # retyping isbn rebuilds the table
+        self.assertTrue(migrate(Book.table, self.db).needs_rebuild())
+        Book.update_all({ 'title': 'renamed' }, id=1)
+        self.assertTrue(Book.version() > version)
+        self.assertEqual([(op, pk) for s, op, pk, obj in Book.changes(seq)], [('update', 1)])
+
+    def test_relation_cleared_before_linking_keeps_triggers(self):
+        Author = link_table(Table('author', [Field('id', int, pk=True), Field('name', str)]), self.db)
+        self.db.execute("ALTER TABLE book ADD COLUMN author_id INTEGER")
+
+        # the column is dropped and added again as the table is linked
+        Book = link_table(book_table(Field('isbn', str)), self.db, versioned=True, track_changes=True)
+        Book.has_one(Author, clear_existing=True)
+        Book.update_all({ 'title': 'renamed' }, id=1)
+        self.assertEqual(Book.version(), 1)
+        self.assertEqual([(op, pk) for s, op, pk, obj in Book.changes()], [('update', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
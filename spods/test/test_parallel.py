@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table
+from spods import parallel
+from spods.test.util import TempDirTest
+
+def number_table():
+    return Table('number', [Field('id', int, pk=True), Field('value', int), Field('square', int)])
+
+class ParallelMapTest(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.db = sqlite3.connect(self.path('numbers.db'))
+        self.Number = link_table(number_table(), self.db, lazy=False)
+        self.db.executemany("INSERT INTO number (value) VALUES (?)", [(i, ) for i in range(100)])
+
+    def test_results_in_order(self):
+        progress = []
+        results = self.Number.parallel_map(lambda n: n.value * 2 if n.value % 3 else None, workers=3, chunk=7,
+                                           progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(results, [(i + 1, i * 2) for i in range(100) if i % 3])
+        self.assertEqual(progress[-1], (100, 100))
+        self.assertEqual(len(progress), 15)
+
+    def test_runs_in_workers(self):
+        pids = set(pid for pk, pid in self.Number.parallel_map(lambda n: os.getpid(), workers=3, chunk=10))
+        self.assertTrue(len(pids) > 1)
+        self.assertFalse(os.getpid() in pids)
+
+    def test_criteria(self):
+        self.db.execute("UPDATE number SET square = 0 WHERE value < 10")
+        results = self.Number.parallel_map(lambda n: n.value, workers=2, chunk=3, square=0)
+        self.assertEqual([result for pk, result in results], range(10))
+
+    def test_write_back(self):
+        changed = self.Number.parallel_map(lambda n: { 'square': n.value ** 2 } if n.value % 2 else None,
+                                           workers=3, chunk=9, write=True)
+        self.assertEqual(changed, 50)
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM number WHERE square = value * value").fetchone()[0], 50)
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM number WHERE square IS NULL").fetchone()[0], 50)
+
+    def test_error_in_worker(self):
+        def fail(n):
+            if n.value == 42:
+                raise ValueError("no 42s")
+            return { 'square': 1 }
+
+        self.assertRaises(ValueError, self.Number.parallel_map, fail, workers=3, chunk=10, write=True)
+        self.assertEqual(parallel.jobs, {})
+
+        # workers can only read
+        def write(n):
+            n.value = 0
+        self.assertRaises(sqlite3.OperationalError, self.Number.parallel_map, write, workers=2, chunk=50)
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM number WHERE value = 0").fetchone()[0], 1)
+
+    def test_in_memory(self):
+        # other processes can't open it, so the chunks run in this process
+        Number = link_table(number_table(), sqlite3.connect(':memory:'))
+        for i in range(5):
+            Number(value=i)
+        self.assertEqual(Number.parallel_map(lambda n: n.value, workers=3, chunk=2), [(i + 1, i) for i in range(5)])
+
+if __name__ == '__main__':
+    unittest.main()
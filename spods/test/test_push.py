@@ -0,0 +1,108 @@
+import json
+import sqlite3
+import threading
+import time
+import unittest
+from StringIO import StringIO
+from urllib import urlencode
+
+from spods import Field, Table, link_table, wsgi_app, limit_subscribers
+from spods.push import DEFAULT_MAX_SUBSCRIBERS, notifier
+from spods.test.util import call
+
+def subscribe(app, accept=None, **params):
+    """Starts a subscription, returning (status, headers, body iterable)."""
+
+    params['action'] = 'subscribe'
+    environ = { 'REQUEST_METHOD': 'GET', 'QUERY_STRING': urlencode(params), 'wsgi.input': StringIO('') }
+    if accept:
+        environ['HTTP_ACCEPT'] = accept
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+
+    body = app(environ, start_response)
+    return response['status'], dict(response['headers']), body
+
+class PushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str), Field('shelf', int)]),
+                               self.db, track_changes=True)
+        self.Note = link_table(Table('note', [Field('id', int, pk=True), Field('text', str)]), self.db)
+        self.app = wsgi_app(self.Book, self.Note)
+
+    def tearDown(self):
+        limit_subscribers(DEFAULT_MAX_SUBSCRIBERS)
+
+    def long_poll(self, **params):
+        status, headers, body = subscribe(self.app, **params)
+        return status, headers, json.loads(''.join(body))
+
+    def test_long_poll_returns_pending_changes(self):
+        self.Book(title='Ozma of Oz', shelf=1)
+        self.Book(title='Glinda of Oz', shelf=2)
+        status, headers, result = self.long_poll(obj='book', since=0, shelf=2)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([(e['op'], e['obj']['title']) for e in result['data']], [('insert', 'Glinda of Oz')])
+        self.assertEqual(result['seq'], self.Book.latest_change())
+
+    def test_long_poll_waits_for_a_change(self):
+        since = self.Book.latest_change()
+        results = []
+        waiting = threading.Thread(target=lambda: results.append(self.long_poll(obj='book', since=since, timeout=10)))
+        start = time.time()
+        waiting.start()
+        time.sleep(0.2)
+        self.Book(title='Rinkitink in Oz')
+        waiting.join()
+
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual([e['obj']['title'] for e in results[0][2]['data']], ['Rinkitink in Oz'])
+        self.assertEqual(notifier.subscribers, 0)
+
+    def test_long_poll_timeout(self):
+        status, headers, result = self.long_poll(obj='book', since=self.Book.latest_change(), timeout=0)
+        self.assertEqual((status, result['data']), ('200 OK', []))
+
+    def test_bad_subscriptions(self):
+        self.assertEqual(self.long_poll(obj='note', since=0)[0], '400 Bad Request')
+        self.assertEqual(self.long_poll(obj='book', since='x')[0], '400 Bad Request')
+        self.assertEqual(notifier.subscribers, 0)
+
+    def test_event_stream(self):
+        self.Book(title='Ozma of Oz')
+        status, headers, body = subscribe(self.app, 'text/event-stream', obj='book', since=0)
+        self.assertEqual(headers['Content-Type'], 'text/event-stream')
+        self.assertEqual(notifier.subscribers, 1)
+
+        chunks = iter(body)
+        self.assertTrue(next(chunks).startswith('retry:'))
+        event = next(chunks)
+        self.assertTrue(event.startswith('id: %d\nevent: change\n' % self.Book.latest_change()))
+        self.assertEqual(json.loads(event.split('data: ', 1)[1])['obj']['title'], 'Ozma of Oz')
+
+        body.close()
+        self.assertEqual(notifier.subscribers, 0)
+
+    def test_subscribers_are_limited(self):
+        limit_subscribers(1)
+        status, headers, stream = subscribe(self.app, 'text/event-stream', obj='book', since=0)
+        self.assertEqual(status, '200 OK')
+
+        # the next one is turned away, but everything else still works
+        status, headers, result = self.long_poll(obj='book', since=0, timeout=0)
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertIn('Retry-After', headers)
+        self.assertEqual(result['status'], 1)
+        self.assertEqual(call(self.app, { 'obj': 'book' })[0], '200 OK')
+
+        # until the stream is closed, even if it was never read
+        stream.close()
+        self.assertEqual(self.long_poll(obj='book', since=0, timeout=0)[0], '200 OK')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.test.util import call_json
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.Author = link_table(Table('author', [Field('id', int, pk=True), Field('name', str)]), self.db)
+        self.Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str)]), self.db)
+        self.app = wsgi_app(self.Author, self.Book)
+
+    def test_relations_added_after_serving(self):
+        # the registry is built by the first request
+        self.assertEqual(call_json(self.app, obj='book')['data'], [])
+
+        self.Book.has_one(self.Author)
+        author = call_json(self.app, obj='author', action='new', name='L. Frank Baum')['data'][0]
+        book = call_json(self.app, obj='book', action='new', title='Ozma of Oz', author_id=author['id'])['data'][0]
+        self.assertEqual(int(book['author_id']), author['id'])
+
+        result = call_json(self.app, obj='book', expand='author', **{ 'author_id*': author['id'] })
+        self.assertEqual(result['data'], [{ 'id': 1, 'title': 'Ozma of Oz', 'author_id': author['id'], 'author': author }])
+
+if __name__ == '__main__':
+    unittest.main()
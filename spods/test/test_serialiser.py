@@ -0,0 +1,65 @@
+import json
+import sqlite3
+import unittest
+from collections import OrderedDict
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.serialiser import RawJSON, compile_serialiser, encode
+from spods.test.util import call
+
+FIELDS = [Field('id', int, pk=True), Field('title', str), Field('price', int), Field('secret', str, out_mask=lambda v: v and '*' * len(v))]
+
+# awkward values for each field (quotes, backslashes, control characters, non-ASCII and HTML)
+ROWS = [
+    (1, u'plain', 9.5, u'hunter2'),
+    (2, u'"quoted" \\ back\\slash', 0.1, None),
+    (3, u'tab\tnew\nline\r\x00\x1f', -1e20, u''),
+    (4, u'caf\xe9 \u2603 \U0001f600', None, u'\u2603'),
+    (2 ** 40, u'</script><!--', 3.0, u'x'),
+    (5, 'bytes', 1.5, 'abc'),
+    (None, None, float('1e-7'), None)
+]
+
+def expected(row):
+    """The row as json.dumps would write it, with the out mask applied."""
+    values = list(row)
+    values[3] = FIELDS[3].out_mask(values[3])
+    return json.dumps(OrderedDict(zip([f.title for f in FIELDS], values)))
+
+class SerialiserTest(unittest.TestCase):
+
+    def test_same_as_json_dumps(self):
+        serialise = compile_serialiser(FIELDS)
+        for row in ROWS:
+            serialised = serialise(row)
+            self.assertTrue(isinstance(serialised, RawJSON))
+            self.assertEqual(serialised, expected(row))
+
+    def test_out_masks(self):
+        serialise = compile_serialiser(FIELDS)
+        self.assertEqual(json.loads(serialise(ROWS[0]))['secret'], '*******')
+
+        # the row itself isn't changed
+        row = list(ROWS[0])
+        serialise(row)
+        self.assertEqual(row[3], u'hunter2')
+
+    def test_encode(self):
+        raw = compile_serialiser(FIELDS)(ROWS[1])
+        result = OrderedDict([('status', 0), ('error', u'caf\xe9'), ('data', [raw, raw]), ('count', 2)])
+        self.assertEqual(json.loads(encode(result)), json.loads(json.dumps(dict(result, data=[json.loads(raw)] * 2))))
+        self.assertTrue(encode(raw) is raw)
+        self.assertEqual(encode([1, None, u'\u2603', (True, 2.5)]), json.dumps([1, None, u'\u2603', [True, 2.5]]))
+
+    def test_api(self):
+        Item = link_table(Table('item', list(FIELDS)), sqlite3.connect(':memory:'))
+        for row in ROWS[:5]:
+            Item(title=row[1], secret=row[3])
+
+        body = call(wsgi_app(Item), { 'obj': 'item' })[2]
+        data = json.loads(body)['data']
+        self.assertEqual([item['title'] for item in data], [row[1] for row in ROWS[:5]])
+        self.assertEqual([item['secret'] for item in data], ['*******', None, '', '*', '*'])
+
+if __name__ == '__main__':
+    unittest.main()
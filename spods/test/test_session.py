@@ -0,0 +1,87 @@
+import sqlite3
+import time
+import unittest
+from Cookie import SimpleCookie
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.session import make_token, read_token
+from spods.test.util import call
+
+SECRET = 'not a very good secret'
+
+class SignedSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.Session = link_table(Table('session', [Field('id', int, pk=True), Field('key', str), Field('visits', int, default=0)]),
+                                  self.db, session_field='key', force_session=True, session_secret=SECRET, session_ttl=100)
+
+        def visit(**kw):
+            session = kw['_session']['session']
+            session.visits += 1
+            return session.visits
+
+        def hello(**kw):
+            return 'hello'
+
+        self.app = wsgi_app(self.Session, visit, hello)
+
+    def call(self, obj, cookie=None):
+        """Returns the call's JSON body, and the value of the session cookie it set (if any)."""
+        status, headers, body = call(self.app, { 'obj': obj }, cookie=cookie)
+        sent = SimpleCookie()
+        for header, value in headers:
+            if header == 'Set-Cookie':
+                sent.load(value)
+        return body, sent['session_key'].value if 'session_key' in sent else None
+
+    def test_tokens(self):
+        now = int(time.time())
+        token = make_token(self.Session, 7, now + 10)
+        self.assertEqual(read_token(self.Session, token, now), (7, now + 10))
+
+        # expired, tampered with, or signed with another secret
+        self.assertEqual(read_token(self.Session, token, now + 10), None)
+        self.assertEqual(read_token(self.Session, token.replace('7.', '8.', 1), now), None)
+        self.Session.session_secret = 'another secret'
+        try:
+            self.assertEqual(read_token(self.Session, token, now), None)
+        finally:
+            self.Session.session_secret = SECRET
+
+    def test_new_sessions_are_only_made_when_used(self):
+        body, token = self.call('hello')
+        self.assertEqual(token, None)
+        self.assertEqual(self.Session.count_all(), 0)
+
+        body, token = self.call('visit')
+        self.assertIn('"data": 1', body)
+        self.assertTrue(token)
+        self.assertEqual(self.Session.count_all(), 1)
+
+        # the cookie is trusted without a query, and brings back the same row
+        body, again = self.call('visit', 'session_key=' + token)
+        self.assertIn('"data": 2', body)
+        self.assertEqual(again, None)
+        self.assertEqual(self.Session.count_all(), 1)
+
+    def test_forged_cookies_get_a_new_session(self):
+        body, token = self.call('visit')
+        forged = token.rsplit('.', 1)[0] + '.' + '0' * 64
+        body, new_token = self.call('visit', 'session_key=' + forged)
+        self.assertIn('"data": 1', body)
+        self.assertNotEqual(new_token, token)
+        self.assertEqual(self.Session.count_all(), 2)
+
+    def test_tokens_are_renewed_half_way(self):
+        self.Session(visits=0)
+        old = make_token(self.Session, 1, int(time.time()) + 40)
+        body, token = self.call('visit', 'session_key=' + old)
+        self.assertIn('"data": 1', body)
+        now = int(time.time())
+        pk, expires = read_token(self.Session, token, now)
+        self.assertEqual(pk, 1)
+        self.assertTrue(expires > now + 50)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app, ShardSpec
+from spods.test.util import TempDirTest, call_json
+
+def book_table():
+    return Table('book', [Field('id', int, pk=True), Field('title', str), Field('shelf', int)])
+
+class ShardingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbs = [sqlite3.connect(':memory:') for i in range(3)]
+        # (not lazy, so every shard has the table, even if no rows go in it)
+        self.Book = link_table(book_table(), ShardSpec(self.dbs, field='shelf'), lazy=False)
+
+        # titles out of step with ids, so ordering by title really merges
+        self.titles = ['t%02d' % ((i * 7) % 30) for i in range(30)]
+        self.books = [self.Book(title=title, shelf=i % 5) for i, title in enumerate(self.titles)]
+
+    def shard_counts(self):
+        return [db.execute("SELECT COUNT(*) FROM book").fetchone()[0] for db in self.dbs]
+
+    def test_ids_say_where_rows_are(self):
+        ids = sorted(b.id for b in self.books)
+        self.assertEqual(len(set(ids)), 30)
+        for i, db in enumerate(self.dbs):
+            for (pk, ) in db.execute("SELECT id FROM book"):
+                self.assertEqual((pk - 1) % 3, i)
+
+        # each shelf is only in one shard
+        for shelf in range(5):
+            self.assertEqual(len([db for db in self.dbs if db.execute("SELECT 1 FROM book WHERE shelf = ?", (shelf, )).fetchone()]), 1)
+
+        book = self.Book(id=self.books[4].id)
+        self.assertEqual(book.title, self.books[4].title)
+        self.assertEqual(self.Book.get_one(id=999), None)
+        self.assertEqual(sorted(self.Book.get_many([self.books[0].id, 999]).keys()), [self.books[0].id])
+
+    def test_ordered_merge(self):
+        self.assertEqual([b.id for b in self.Book.get_all()], sorted(b.id for b in self.books))
+        self.assertEqual([b.title for b in self.Book.get_all(_order='title')], sorted(self.titles))
+        self.assertEqual([b.title for b in self.Book.get_all(_order='title', _reverse=True)], sorted(self.titles, reverse=True))
+
+    def test_limits(self):
+        self.assertEqual([b.title for b in self.Book.get_all(_order='title', _start=3, _limit=5)], sorted(self.titles)[3:8])
+        self.assertEqual([b.title for b in self.Book.get_all(_order='title', _reverse=True, _limit=4)],
+                         sorted(self.titles, reverse=True)[:4])
+        self.assertEqual(len(self.Book.get_all(_start=28, _limit=5)), 2)
+        self.assertEqual(self.Book.get_one(_order='title').title, 't00')
+
+    def test_queries_by_field_go_to_one_shard(self):
+        self.assertEqual(self.Book.count_all(), 30)
+        self.assertEqual(self.Book.count_all(shelf=2), 6)
+        self.assertEqual(set(b.shelf for b in self.Book.get_all(shelf=2)), set([2]))
+
+        self.assertEqual(len(self.Book.update_all({ 'title': 'x' }, shelf=1)), 6)
+        self.assertEqual(self.Book.count_all(title='x'), 6)
+        self.assertEqual(len(self.Book.delete_all(shelf=1)), 6)
+        self.assertEqual(sum(self.shard_counts()), 24)
+
+    def test_limited_changes(self):
+        # every shard has more than enough matching rows, but only _limit of them change
+        ordered = sorted(self.titles)
+        first = dict((b.title, b.id) for b in self.books)
+        rows = self.Book.update_all({ 'title': 'x' }, _order='title', _start=1, _limit=3)
+        self.assertEqual(sorted(row['id'] for row in rows), sorted(first[title] for title in ordered[1:4]))
+        self.assertEqual(sorted(b.id for b in self.Book.get_all(title='x')), sorted(first[title] for title in ordered[1:4]))
+
+        rows = self.Book.delete_all(_limit=2)
+        self.assertEqual(sorted(row['id'] for row in rows), sorted(b.id for b in self.books)[:2])
+        self.assertEqual(sum(self.shard_counts()), 28)
+
+        # and through the API
+        app = wsgi_app(self.Book)
+        call_json(app, obj='book', action='edit', limit=1, title='edited')
+        self.assertEqual(self.Book.count_all(title='edited'), 1)
+        call_json(app, obj='book', action='delete', limit=2)
+        self.assertEqual(sum(self.shard_counts()), 26)
+
+    def test_relations(self):
+        Author = link_table(Table('author', [Field('id', int, pk=True), Field('name', str)]), ShardSpec(self.dbs), lazy=False)
+        self.Book.has_one(Author)
+        self.assertEqual([f.title for f in self.Book.table.fields], ['id', 'title', 'shelf', 'author_id'])
+
+        author = Author(name='L. Frank Baum')
+        book = self.Book(title='Ozma of Oz', shelf=3, author_id=author.id)
+        self.assertEqual(self.Book(id=book.id)['author'].name, 'L. Frank Baum')
+        for db in self.dbs:
+            self.assertIn('author_id', [row[1] for row in db.execute("PRAGMA table_info(book)")])
+
+    def test_api(self):
+        app = wsgi_app(self.Book)
+        result = call_json(app, obj='book', start=2, limit=3)
+        self.assertEqual([b['id'] for b in result['data']], sorted(b.id for b in self.books)[2:5])
+
+        new = call_json(app, obj='book', action='new', title='zz', shelf=4)['data'][0]
+        self.assertEqual(call_json(app, obj='book', id=new['id'])['data'][0]['title'], 'zz')
+
+class HotShardingTest(TempDirTest):
+
+    def test_hot_shards(self):
+        dbs = [sqlite3.connect(self.path('book-%d.db' % i)) for i in range(2)]
+        Book = link_table(book_table(), ShardSpec(dbs), hot=True)
+        self.assertTrue(Book.hot)
+        for i in range(10):
+            Book(title='t%d' % i, shelf=i)
+
+        # kept in memory until flushed
+        Book.flush()
+        self.assertEqual(sum(sqlite3.connect(self.path('book-%d.db' % i)).execute("SELECT COUNT(*) FROM book").fetchone()[0]
+                             for i in range(2)), 10)
+
+if __name__ == '__main__':
+    unittest.main()
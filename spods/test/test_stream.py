@@ -0,0 +1,65 @@
+import json
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table, wsgi_app
+from spods.json_api import iter_json
+from spods.test.util import call
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.Book = link_table(Table('book', [Field('id', int, pk=True), Field('title', str)]), sqlite3.connect(':memory:'))
+        for i in range(5):
+            self.Book(title='t%d' % i)
+        self.app = wsgi_app(self.Book, stream=True)
+
+    def view(self, **params):
+        status, headers, body = call(self.app, dict(obj='book', **params))
+        return status, dict(headers), json.loads(body)
+
+    def test_streamed_view(self):
+        status, headers, result = self.view(limit=3)
+        self.assertEqual(status, '200 OK')
+        self.assertFalse('Content-Length' in headers)
+        self.assertEqual(result, {
+            'data': [{ 'id': i + 1, 'title': 't%d' % i } for i in range(3)],
+            'status': 0,
+            'error': ''
+        })
+
+    def test_streamed_view_with_count(self):
+        status, headers, result = self.view(limit=2, count='1')
+        self.assertEqual(result['count'], 5)
+        self.assertEqual([obj['title'] for obj in result['data']], ['t0', 't1'])
+        self.assertEqual(result['status'], 0)
+
+    def test_error_part_way(self):
+        def rows(**kw):
+            yield self.Book.serialise(self.Book(id=1))
+            raise ValueError("disk gone")
+
+        # (each test links its own class)
+        self.Book.iter_serialised = staticmethod(rows)
+        status, headers, result = self.view(count='1')
+
+        # the headers went out before the error, but the body still says what happened
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(result['data'], [{ 'id': 1, 'title': 't0' }])
+        self.assertEqual(result['count'], 5)
+        self.assertEqual((result['status'], result['error']), (2, 'ValueError: disk gone'))
+
+    def test_iter_json(self):
+        def objs():
+            yield { 'a': 1 }
+            yield { 'b': u'\u2603' }
+
+        chunks = list(iter_json({ 'status': 0, 'error': '', 'data': objs() }))
+        self.assertTrue(len(chunks) > 2)
+        self.assertEqual(json.loads(''.join(chunks)), { 'data': [{ 'a': 1 }, { 'b': u'\u2603' }], 'status': 0, 'error': '' })
+
+        # results that aren't streamed are encoded in one go
+        self.assertEqual(len(list(iter_json({ 'status': 1, 'error': 'x', 'data': None }))), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import sqlite3
+import unittest
+
+from spods import Field, Table, link_table
+from spods.base import now
+from spods.purge import main, purge
+from spods.test.util import TempDirTest
+
+def token_table():
+    return Table('token', [Field('id', int, pk=True), Field('owner', str)], ttl=60)
+
+class TtlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.Token = link_table(token_table(), self.db)
+
+        # ten fresh tokens, and five that expired a while ago
+        self.fresh = [self.Token(owner='fresh') for i in range(10)]
+        self.stale = [self.Token(owner='stale', created=now() - 120) for i in range(5)]
+
+    def test_expired_rows_are_hidden(self):
+        self.assertEqual(self.Token.count_all(), 10)
+        self.assertEqual(set(t.owner for t in self.Token.get_all()), set(['fresh']))
+        self.assertEqual(self.Token.get_one(owner='stale'), None)
+        self.assertEqual(self.Token.get_one(id=self.stale[0].id), None)
+        self.assertEqual(sorted(self.Token.get_many([self.fresh[0].id, self.stale[0].id]).keys()), [self.fresh[0].id])
+
+        # but they are still in the table until they are purged
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM token").fetchone()[0], 15)
+
+    def test_purge_expired(self):
+        self.assertEqual(self.Token.purge_expired(batch_size=2, max_batches=1), 2)
+        self.assertEqual(self.Token.purge_expired(batch_size=2), 3)
+        self.assertEqual(self.Token.purge_expired(), 0)
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM token").fetchone()[0], 10)
+
+    def test_purge_in_batches(self):
+        Note = link_table(Table('note', [Field('id', int, pk=True)]), self.db)
+        Note()
+
+        # tables without a ttl are left alone
+        self.assertEqual(purge([self.Token, Note], batch_size=2, pause=0), 5)
+        self.assertEqual(self.Token.count_all(), 10)
+        self.assertEqual(Note.count_all(), 1)
+
+class PurgeScriptTest(TempDirTest):
+
+    def test_main(self):
+        script = self.path('api.py')
+        with open(script, 'w') as f:
+            f.write("import sqlite3\n"
+                    "from spods import Field, Table, link_table\n"
+                    "Token = link_table(Table('token', [Field('id', int, pk=True)], ttl=60), sqlite3.connect(%r))\n"
+                    % self.path('test.db'))
+
+        db = sqlite3.connect(self.path('test.db'))
+        db.execute("CREATE TABLE token (id INTEGER PRIMARY KEY, created INTEGER)")
+        db.executemany("INSERT INTO token (created) VALUES (?)", [(now() - 120, )] * 3 + [(now(), )])
+        db.commit()
+
+        main(['--quiet', '--pause', '0', '--batch-size', '2', script])
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM token").fetchone(), (1, ))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Helpers shared by the tests."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib
+from StringIO import StringIO
+
+def call(application, params=None, query='', body='', cookie=None, method='GET'):
+    """Given a WSGI application and the request's parameters (or a query string), calls it,
+    and returns its (status, headers, body)."""
+
+    if params != None:
+        query = urllib.urlencode(params)
+    environ = {
+        'REQUEST_METHOD': method,
+        'QUERY_STRING': query,
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO(body)
+    }
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+
+    chunks = application(environ, start_response)
+    try:
+        body = ''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], body
+
+def call_json(application, **params):
+    """Like call, but returns the decoded JSON body."""
+    return json.loads(call(application, params)[2])
+
+class TempDirTest(unittest.TestCase):
+    """A test case with a fresh directory (self.directory) for its database files."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='spods-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
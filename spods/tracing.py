@@ -0,0 +1,161 @@
+"""Traces where the time goes while responding to a request, as nested spans: the request,
+loading its sessions, running its action, each SQL query, expanding related objects, and
+turning the result into JSON.
+
+Tracing is off until it is given somewhere to send finished spans:
+
+    >>> spods.trace_to(spods.JsonlExporter('/tmp/spods-trace.jsonl'))
+
+Until then, span() hands back the same do-nothing span every time, so it costs next to
+nothing."""
+
+import os
+import threading
+from time import time
+
+class NoSpan(object):
+    """The span handed out while tracing is off: a context manager that does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+NO_SPAN = NoSpan()
+
+class Span(object):
+    """The class representing one timed step of a request. Use it as a context manager: the
+    step starts when it is entered, and is exported when it is exited.
+
+    Each span has a name (e.g. 'query'), a dictionary of attributes (e.g. the SQL), and the id
+    of its parent span (or None, for the root span of a trace)."""
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = None
+        self.span_id = None
+        self.parent_id = None
+        self.start = None
+        self.end = None
+
+    def set(self, key, value):
+        """Sets an attribute of the span."""
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        """Returns how long the span took, in seconds (or None, if it hasn't finished)."""
+        if self.end == None:
+            return None
+        return self.end - self.start
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        if stack:
+            self.trace_id, self.parent_id = stack[-1].trace_id, stack[-1].span_id
+        else:
+            self.trace_id = self.tracer.new_id()
+        self.span_id = self.tracer.new_id()
+        stack.append(self)
+        self.start = time()
+        return self
+
+    def __exit__(self, error_type, error, tb):
+        self.end = time()
+        if error_type != None:
+            self.attributes['error'] = "%s: %s" % (error_type.__name__, error)
+
+        stack = self.tracer.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+
+        self.tracer.export(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes
+        }
+
+class MemoryExporter(object):
+    """Keeps finished spans in a list (its spans attribute), e.g. for tests."""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def clear(self):
+        del self.spans[:]
+
+class JsonlExporter(object):
+    """Appends each finished span to a file, as a line of JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        from json import dumps
+        line = dumps(span.to_dict(), default=repr) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+class Tracer(object):
+    """The class representing where spans are sent (its exporters). Spans started while
+    another span of the same thread is open become its children."""
+
+    def __init__(self):
+        self.exporters = []
+        self.local = threading.local()
+        self.ids = 0
+        self.lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        """Returns a new span (or NO_SPAN, if tracing is off), to be used with 'with'."""
+        if not self.exporters:
+            return NO_SPAN
+        return Span(self, name, attributes)
+
+    def stack(self):
+        """Returns the list of this thread's open spans, innermost last."""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def new_id(self):
+        """Returns an id for a span or trace, unique among this process's spans."""
+        with self.lock:
+            self.ids += 1
+            return "%x-%x" % (os.getpid(), self.ids)
+
+    def export(self, span):
+        for exporter in self.exporters:
+            exporter.export(span)
+
+# the tracer used by SPODS
+tracer = Tracer()
+
+def trace_to(*exporters):
+    """Given any number of exporters (such as a MemoryExporter or JsonlExporter), sends every
+    finished span to them. With none, turns tracing off."""
+    tracer.exporters = list(exporters)
+
+def span(name, **attributes):
+    """Returns a new span with the given name and attributes, to be used with 'with'. Does
+    nothing unless tracing is on (see trace_to)."""
+    return tracer.span(name, **attributes)
@@ -0,0 +1,29 @@
+# table versions are kept in this table, one row per versioned table
+VERSION_TABLE = "_spods_version"
+
+def install_version_triggers(db, title):
+    """Given a database connection and a table name, makes sure the table has a row in the
+    version table, and adds triggers that bump its version on every insert, update or delete
+    (whether it was made through SPODS or not)."""
+
+    c = db.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS %s (title TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)" % VERSION_TABLE)
+    c.execute("INSERT OR IGNORE INTO %s (title) VALUES (?)" % VERSION_TABLE, (title, ))
+
+    for op in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute("CREATE TRIGGER IF NOT EXISTS %s_%s_%s AFTER %s ON %s BEGIN UPDATE %s SET version = version + 1 WHERE title = '%s'; END"
+                  % (VERSION_TABLE, title, op.lower(), op, title, VERSION_TABLE, title))
+    c.close()
+
+def table_version(db, title):
+    """Given a database connection and a table name, returns the table's current version
+    (a number that changes every time the table is written to)."""
+
+    c = db.cursor()
+    c.execute("SELECT version FROM %s WHERE title = ?" % VERSION_TABLE, (title, ))
+    row = c.fetchone()
+    c.close()
+
+    if row == None:
+        return None
+    return row[0]
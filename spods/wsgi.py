@@ -0,0 +1,75 @@
+import threading
+
+import hot
+from json_api import respond
+from push import is_subscription, subscribe
+from registry import get_registry
+
+def wsgi_app(*args, **options):
+    """Given a list of LinkedClasses and functions (just like serve_api), returns a WSGI
+    application that serves them.
+
+    Unlike a CGI script, the application runs inside a long-lived process, so the classes are
+    linked, and their connections opened, just once: every request after the first reuses them.
+
+    Requests are handled one at a time, since the classes share their database connections.
+    To serve from a multi-threaded server, open connections with check_same_thread=False. If
+    any of the classes is hot, every application shares one lock (spods.hot.lock), since every
+    class linked to a hot table shares one connection to its file (see spods.hot).
+
+    If the stream option is True, views are sent as they are read from the DB, without a
+    Content-Length (so HTTP/1.1 servers send them chunked).
+
+    Clients can subscribe to tables linked with track_changes=True (see spods.push). A
+    subscription only holds the lock while it checks for changes, not while it waits for them,
+    but it does keep a thread of a multi-threaded server busy, so only a few are served at once
+    (see spods.push.limit_subscribers)."""
+
+    stream = options.get('stream', False)
+    if any(c.hot for c in get_registry(args).tables.values()):
+        lock = hot.lock
+    else:
+        lock = threading.Lock()
+
+    class Streamed(object):
+        """A streamed response body, which keeps hold of the lock until the server closes it."""
+
+        def __init__(self, chunks):
+            self.chunks = chunks
+            self.released = False
+
+        def __iter__(self):
+            return iter(self.chunks)
+
+        def close(self):
+            self.chunks.close()
+            if not self.released:
+                self.released = True
+                lock.release()
+
+    def application(environ, start_response):
+        if is_subscription(environ):
+            return subscribe(environ, start_response, args, lock)
+
+        if stream:
+            lock.acquire()
+            try:
+                status, headers, body = respond(environ, environ['wsgi.input'], args, stream=True)
+            except:
+                lock.release()
+                raise
+
+            start_response(status, headers)
+            if isinstance(body, str):
+                lock.release()
+                return [body]
+            return Streamed(body)
+
+        with lock:
+            status, headers, body = respond(environ, environ['wsgi.input'], args)
+
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+    return application